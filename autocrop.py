@@ -0,0 +1,109 @@
+"""
+Recorte automático de la zona expuesta de una placa CR.
+
+Se arma una máscara de píxeles expuestos (ni sub-expuestos ni saturados) en una
+sola pasada sobre toda la imagen y se reduce por filas y por columnas. La zona
+expuesta es el tramo contiguo más largo de filas en el que al menos
+`min_fraction` de los píxeles están expuestos (uniendo huecos cortos), y en
+columnas va de la primera a la última columna expuesta, así un borde del chasis,
+un artefacto en una columna o los huecos entre piquetes no cortan la imagen.
+Los umbrales se escalan con la profundidad de bits (BitsStored) de la imagen.
+"""
+import numpy as np
+
+# Umbral histórico de crop_dicom: 1000 sobre 4095 (12 bits)
+LOW_FRACTION = 1000 / 4095
+
+
+def exposure_thresholds(bits_stored=12, low_fraction=LOW_FRACTION):
+    """
+    Returns the default exposure thresholds for an image depth.
+
+    Args:
+        bits_stored (int): BitsStored of the image.
+        low_fraction (float): Lower threshold as a fraction of the maximum value.
+
+    Returns:
+        tuple: (low, saturation). Pixels in [low, saturation) are exposed.
+    """
+    saturation = (1 << int(bits_stored)) - 1
+    return int(round(low_fraction * saturation)), saturation
+
+
+def _exposed_run(flags, max_gap=None):
+    """
+    Returns the slice of the exposed run of a profile, or None.
+
+    With `max_gap` it is the longest run of True values, bridging gaps of up to `max_gap` False values (a saturated
+    column, a scratch). Without it, it is the extent from the first to the last True value, which keeps the gaps
+    between pickets inside the region.
+    """
+    edges = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return None
+    if max_gap is None:
+        return slice(int(starts[0]), int(stops[-1]))
+
+    # Unir tramos separados por huecos cortos
+    group = np.concatenate(([0], np.cumsum(starts[1:] - stops[:-1] > max_gap)))
+    first = np.flatnonzero(np.diff(np.concatenate(([-1], group))))
+    last = np.concatenate((first[1:], [len(group)])) - 1
+    i = np.argmax(stops[last] - starts[first])
+    return slice(int(starts[first[i]]), int(stops[last[i]]))
+
+
+def find_exposed_region(pixel_array, bits_stored=12, low=None, saturation=None, min_fraction=0.5, crop_columns=True,
+                        row_max_gap=16, column_max_gap=None):
+    """
+    Finds the contiguous exposed region of an image from its row and column projection profiles.
+
+    Args:
+        pixel_array (numpy.ndarray): 2D image.
+        bits_stored (int): BitsStored of the image, used for the default thresholds.
+        low (int, optional): Pixels below this value are not exposed. Defaults to `exposure_thresholds`.
+        saturation (int, optional): Pixels at or above this value are saturated. Defaults to `exposure_thresholds`.
+        min_fraction (float): Minimum fraction of exposed pixels for a row/column to belong to the region.
+        crop_columns (bool): Whether to crop columns too, or only rows as the original crop_dicom did.
+        row_max_gap (int or None): Longest gap of unexposed rows bridged inside the region, see `_exposed_run`.
+        column_max_gap (int or None): Same for columns. None keeps everything between the first and last exposed
+            column, so the unexposed gaps between pickets stay in the image.
+
+    Returns:
+        tuple: (row slice, column slice) of the region.
+
+    Raises:
+        ValueError: If no row (or column) is exposed enough.
+    """
+    default_low, default_saturation = exposure_thresholds(bits_stored)
+    low = default_low if low is None else low
+    saturation = default_saturation if saturation is None else saturation
+
+    exposed = (pixel_array >= low) & (pixel_array < saturation)
+    rows = _exposed_run(np.count_nonzero(exposed, axis=1) >= min_fraction * exposed.shape[1], row_max_gap)
+    if rows is None:
+        raise ValueError("No se encontró una zona expuesta en la imagen.")
+    if not crop_columns:
+        return rows, slice(0, pixel_array.shape[1])
+
+    # Perfil de columnas sólo sobre las filas expuestas, para que el borde no lo diluya
+    columns = _exposed_run(np.count_nonzero(exposed[rows], axis=0) >= min_fraction * (rows.stop - rows.start), column_max_gap)
+    if columns is None:
+        raise ValueError("No se encontró una zona expuesta en la imagen.")
+    return rows, columns
+
+
+def crop_exposed(pixel_array, **kwargs):
+    """
+    Returns the exposed region of an image as a view (no copy), see `find_exposed_region`.
+
+    Args:
+        pixel_array (numpy.ndarray): 2D image.
+        **kwargs: Passed to `find_exposed_region`.
+
+    Returns:
+        numpy.ndarray: A view of `pixel_array`.
+    """
+    rows, columns = find_exposed_region(pixel_array, **kwargs)
+    return pixel_array[rows, columns]
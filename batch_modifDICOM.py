@@ -0,0 +1,468 @@
+"""
+Modo batch (sin interfaz) de modifDICOM.
+
+Convierte todos los planes de un directorio o patrón glob según un archivo de
+reglas JSON, repartiendo los archivos en un pool de procesos. Ejemplo de reglas:
+
+    {
+        "machine": "Equipo 2 (EQ2_iX_827)",
+        "gantry_angles": 0,
+        "collimator_angles": {"Beam_1": 90, "Beam_2": 270},
+        "portal_sid_cm": [0, 50],
+        "tolerance_table": "T_QA",
+        "output_suffix": "_mod"
+    }
+
+"machine" es la etiqueta o el TreatmentMachineName de un equipo de
+`maquinas.json` (ver `machine_registry`). Los ángulos y la posición del portal
+aceptan un valor para todos los campos, una lista en el orden de BeamSequence o
+un diccionario por BeamName/BeamNumber.
+
+Con "machines": [...] en lugar de "machine", cada plan se lee una sola vez y se
+genera una salida por equipo, <nombre>_mod_<TreatmentMachineName>.dcm (ver
+`fan_out_plan`).
+
+Las reglas opcionales "gantry_offset" (grados), "mirror_arc" (true/false),
+"clamp_collimator" (true/false) y "mu_scale" (factor) se aplican a todos los
+puntos de control de todos los campos, ver `control_points.ControlPointTable`.
+
+Con "extended_if": true, cada salida lleva el anexo privado ExtendedIF de Varian
+armado a partir del propio plan, con la configuración del equipo (ver
+`extended_if`).
+
+Con "verify": true, cada salida se compara con el plan original (ver
+`dcm_diff`) y se marca como error si cambió algo más que lo que piden las
+reglas. Al cambiar de equipo sólo se verifica lo que viene del plan original
+(UIDs, FractionGroupSequence, BeamSequence y ReferencedStructureSetSequence).
+
+Uso:
+    python batch_modifDICOM.py reglas.json "C:/QA/planes/*.dcm" -j 8 --report reporte.json
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+import dcm_diff
+import dcm_patch
+import extended_if
+import machine_registry
+import modifDICOM
+from control_points import ControlPointTable
+
+# Salidas de modifDICOM / del batch: _mod.dcm y _mod_<equipo>.dcm
+OUTPUT_PATTERN = re.compile(r'_mod(_\w+)?\.dcm$')
+RULE_KEYS = ("machine", "machines", "gantry_angles", "collimator_angles", "portal_sid_cm", "tolerance_table", "output_suffix", "output_dir",
+             "gantry_offset", "mirror_arc", "clamp_collimator", "mu_scale", "extended_if", "verify")
+# Atributos que puede tocar la regla de tolerancias, que corrige la tabla aunque las reglas no la pidan
+TOLERANCE_KEYWORDS = ('ToleranceTableNumber', 'ToleranceTableLabel', 'GantryAngleTolerance', 'BeamLimitingDeviceAngleTolerance',
+                      'PatientSupportAngleTolerance', 'TableTopVerticalPositionTolerance', 'TableTopLongitudinalPositionTolerance',
+                      'TableTopLateralPositionTolerance', 'ReferencedToleranceTableNumber')
+
+# Elementos del anexo ExtendedIF que agrega la regla "extended_if"
+EXTENDED_IF_TAGS = (0x32530010, 0x32531000, 0x32531001, 0x32531002)
+
+
+def load_rules(rules_path):
+    """
+    Reads and validates a JSON rule file.
+
+    Args:
+        rules_path (str): Path to the rule file.
+
+    Returns:
+        dict: The validated rules.
+
+    Raises:
+        ValueError: If the file contains unknown keys, a machine that is not in the registry or an unsupported tolerance table.
+    """
+    with open(rules_path, 'r', encoding='utf-8') as rules_file:
+        rules = json.load(rules_file)
+    return validate_rules(rules, rules_path)
+
+
+def validate_rules(rules, source='las reglas'):
+    """
+    Validates conversion rules already parsed, see `load_rules`.
+
+    Args:
+        rules (dict): The rules.
+        source (str): Where the rules come from, for the error messages.
+
+    Returns:
+        dict: The same rules.
+
+    Raises:
+        ValueError: If the rules contain unknown keys, a machine that is not in the registry or an unsupported tolerance table.
+    """
+    unknown = set(rules) - set(RULE_KEYS)
+    if unknown:
+        raise ValueError(f"Claves desconocidas en {source}: {sorted(unknown)}")
+    if rules.get('machine') is not None:
+        machine_registry.get_registry().get(rules['machine'])
+    for machine in rules.get('machines') or ():
+        machine_registry.get_registry().get(machine)
+    if rules.get('tolerance_table') not in (None, 'T_QA'):
+        raise ValueError(f"Tabla de tolerancia no soportada: {rules['tolerance_table']!r}")
+    return rules
+
+
+def collect_plans(inputs, recursive=False):
+    """
+    Expands directories and glob patterns into a sorted list of plan files.
+
+    Args:
+        inputs (list of str): Directories, files or glob patterns, or '-' to read one path per line from stdin.
+        recursive (bool): Whether directories are searched recursively.
+
+    Returns:
+        list of str: The plan files, without duplicates.
+    """
+    plans = set()
+    for item in inputs:
+        if item == '-':
+            # Una ruta por línea, p. ej. de `plan_catalog.py query --paths`
+            plans.update(line.strip() for line in sys.stdin if line.strip())
+        elif os.path.isdir(item):
+            pattern = os.path.join(item, '**', '*.dcm') if recursive else os.path.join(item, '*.dcm')
+            plans.update(glob.glob(pattern, recursive=recursive))
+        else:
+            plans.update(glob.glob(item, recursive=recursive))
+    # No volver a procesar las salidas de una corrida anterior
+    return sorted(p for p in plans if not OUTPUT_PATTERN.search(p))
+
+
+def output_path_for(full_name, rules):
+    """
+    Builds the output path of a plan following the same naming as `modifDICOM.main`.
+
+    Args:
+        full_name (str): Path of the source plan.
+        rules (dict): The conversion rules.
+
+    Returns:
+        str: The output path.
+    """
+    file_path, file_name = os.path.split(full_name)
+    out_dir = rules.get('output_dir') or file_path
+    return os.path.join(out_dir, os.path.splitext(file_name)[0] + rules.get('output_suffix', '_mod') + '.dcm')
+
+
+def _profile_for(dicom_info, machine):
+    """Returns the profile of the target machine, or of the plan's current machine."""
+    registry = machine_registry.get_registry()
+    profile = registry.find(machine) if machine else None
+    if profile is None and getattr(dicom_info, 'BeamSequence', None):
+        profile = registry.find(dicom_info.BeamSequence[0].get('TreatmentMachineName'))
+    return profile
+
+
+def apply_beam_edits(dicom_info, rules, profile=None):
+    """
+    Applies the angle, portal and control point rules, which don't depend on the machine template.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): The plan.
+        rules (dict): The conversion rules.
+        profile (machine_registry.MachineProfile, optional): Machine whose angle ranges are enforced.
+    """
+    gantry_ranges = profile.gantry_ranges if profile else modifDICOM.GANTRY_RANGES
+    collimator_ranges = profile.collimator_ranges if profile else modifDICOM.COLLIMATOR_RANGES
+
+    modifDICOM.modify_gantry_angles(dicom_info, rules.get('gantry_angles'), gantry_ranges)
+    modifDICOM.modify_collimator_angles(dicom_info, rules.get('collimator_angles'), collimator_ranges)
+    modifDICOM.modify_portal_position(dicom_info, rules.get('portal_sid_cm'))
+
+    if any(rules.get(key) for key in ('gantry_offset', 'mirror_arc', 'clamp_collimator', 'mu_scale')):
+        table = ControlPointTable.from_dataset(dicom_info)
+        if rules.get('gantry_offset'):
+            table.rotate_gantry(rules['gantry_offset'])
+        if rules.get('mirror_arc'):
+            table.mirror_arc()
+        if rules.get('clamp_collimator'):
+            table.clamp_collimator()
+        if rules.get('mu_scale'):
+            table.scale_mu(rules['mu_scale'])
+        table.write_back(dicom_info)
+
+
+def apply_tolerance_rules(dicom_info, rules, profile=None):
+    """
+    Applies the tolerance table rule, as the wizard in `modifDICOM.main` does.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): The plan.
+        rules (dict): The conversion rules.
+        profile (machine_registry.MachineProfile, optional): Target machine, whose default table is used when changing machine.
+    """
+    # Si se cambia de equipo y las reglas no dicen nada, se usa la tabla por defecto del equipo
+    tolerance_table = rules.get('tolerance_table')
+    if 'tolerance_table' not in rules and profile is not None:
+        tolerance_table = profile.tolerance_table
+    if tolerance_table == 'T_QA':
+        modifDICOM.set_tolerances_to_qa(dicom_info)
+    elif hasattr(dicom_info, 'ToleranceTableSequence'):
+        tolerance_table_dicom = dicom_info.ToleranceTableSequence[0].ToleranceTableNumber
+        tolerance_table_beam = dicom_info.BeamSequence[0].ReferencedToleranceTableNumber
+        if tolerance_table_dicom != tolerance_table_beam:
+            modifDICOM.set_tolerances_to_qa(dicom_info)
+
+
+def apply_rules(dicom_info, rules):
+    """
+    Applies the conversion rules to a plan, in the same order as the wizard in `modifDICOM.main`.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): The source plan.
+        rules (dict): The conversion rules.
+
+    Returns:
+        pydicom.dataset.FileDataset: The converted plan.
+    """
+    info_mod = modifDICOM.change_machine(dicom_info, rules.get('machine'))
+    profile = _profile_for(info_mod, rules.get('machine'))
+    apply_beam_edits(info_mod, rules, profile)
+    apply_tolerance_rules(info_mod, rules, profile if rules.get('machine') else None)
+    if rules.get('extended_if'):
+        modifDICOM.set_extended_if(info_mod, extended_if.build_xml_for_machine(info_mod, profile))
+    return info_mod
+
+
+def _clone_top_level(dataset):
+    """
+    Returns a new Dataset with copies of the top-level elements of `dataset`.
+
+    The values are shared: nested sequences (control points, fraction groups...) are not copied, but assigning an
+    attribute of the clone does not affect `dataset`.
+    """
+    clone = Dataset()
+    for tag in dataset.keys():
+        clone.add(copy.copy(dataset[tag]))
+    return clone
+
+
+def machine_variant(dicom_info, profile):
+    """
+    Derives the plan for one machine without touching `dicom_info`.
+
+    Only the beams' top-level elements are copied; control points, FractionGroupSequence and
+    ReferencedStructureSetSequence are shared with `dicom_info` and must not be edited afterwards.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): The source plan, already edited.
+        profile (machine_registry.MachineProfile): The target machine.
+
+    Returns:
+        pydicom.dataset.FileDataset: The plan for `profile`.
+    """
+    source_view = _clone_top_level(dicom_info)
+    if hasattr(dicom_info, 'BeamSequence'):
+        source_view.BeamSequence = Sequence([_clone_top_level(beam) for beam in dicom_info.BeamSequence])
+    return modifDICOM.change_machine(source_view, profile.label)
+
+
+def fan_out_plan(full_name, rules, machines, max_writers=None):
+    """
+    Produces the plan for several machines from a single read of the source.
+
+    The machine-independent rules are applied once. Each variant then gets its own template and beam identity
+    (see `machine_variant`) and all variants are written concurrently.
+
+    Args:
+        full_name (str): Path of the source plan.
+        rules (dict): The conversion rules (its "machine" key is ignored).
+        machines (list of str): UI labels or TreatmentMachineNames of the target machines.
+        max_writers (int, optional): Number of writer threads. Defaults to one per machine.
+
+    Returns:
+        list of str: The output paths, in the order of `machines`.
+
+    Raises:
+        ValueError: If a machine is unknown, an angle is outside the ranges of a target machine or, with the "verify"
+            rule, an output has unexpected changes.
+    """
+    registry = machine_registry.get_registry()
+    profiles = [registry.get(machine) for machine in machines]
+
+    info, pixel_data, file_path, file_name = modifDICOM.get_dicom_file(full_name, modifDICOM.READ_FULL)
+    apply_beam_edits(info, rules)
+    for profile in profiles:
+        for beam in getattr(info, 'BeamSequence', []):
+            control_point = beam.ControlPointSequence[0]
+            if 'GantryAngle' in control_point and not profile.gantry_allowed(control_point.GantryAngle):
+                raise ValueError(f"Ángulo de gantry {control_point.GantryAngle} no permitido en {profile.label}")
+            if 'BeamLimitingDeviceAngle' in control_point and not profile.collimator_allowed(control_point.BeamLimitingDeviceAngle):
+                raise ValueError(f"Ángulo de colimador {control_point.BeamLimitingDeviceAngle} no permitido en {profile.label}")
+
+    def write_variant(profile):
+        variant = machine_variant(info, profile)
+        apply_tolerance_rules(variant, rules, profile)
+        if rules.get('extended_if'):
+            modifDICOM.set_extended_if(variant, extended_if.build_xml_for_machine(variant, profile))
+        base, ext = os.path.splitext(output_path_for(full_name, rules))
+        output_path_file = f"{base}_{profile.machine_name}{ext}"
+        pydicom.dcmwrite(output_path_file, variant, enforce_file_format=False)
+        if rules.get('verify'):
+            verify_output(full_name, output_path_file, rules, profile.label)
+        return output_path_file
+
+    with ThreadPoolExecutor(max_workers=max_writers or len(profiles)) as writers:
+        return list(writers.map(write_variant, profiles))
+
+
+def expected_changes(rules, machine=None):
+    """
+    Lists the attributes that a conversion with `rules` is allowed to change.
+
+    Args:
+        rules (dict): The conversion rules.
+        machine (str, optional): The target machine, if the plan changes machine.
+
+    Returns:
+        tuple: (allowed, scope) as `dcm_diff.unexpected_changes` takes them. When changing machine only the attributes
+        grafted from the source plan are checked, the others come from the template.
+    """
+    allowed = set(TOLERANCE_KEYWORDS)
+    if machine:
+        allowed.update(keyword for _, keyword in machine_registry.BEAM_ATTRIBUTES)
+    if rules.get('gantry_angles') is not None or rules.get('gantry_offset') or rules.get('mirror_arc'):
+        allowed.add('GantryAngle')
+    if rules.get('mirror_arc'):
+        allowed.add('GantryRotationDirection')
+    if rules.get('collimator_angles') is not None or rules.get('clamp_collimator'):
+        allowed.add('BeamLimitingDeviceAngle')
+    if rules.get('portal_sid_cm') is not None:
+        allowed.add('RTImageSID')
+    if rules.get('mu_scale'):
+        allowed.add('BeamMeterset')
+    if rules.get('extended_if'):
+        allowed.update(EXTENDED_IF_TAGS)
+    return allowed, (modifDICOM.GRAFTED_KEYWORDS if machine else None)
+
+
+def verify_output(full_name, output_path_file, rules, machine=None):
+    """
+    Checks that the converted plan differs from the source only where the rules say.
+
+    Args:
+        full_name (str): Path of the source plan.
+        output_path_file (str): Path of the converted plan.
+        rules (dict): The conversion rules.
+        machine (str, optional): The target machine, if the plan changed machine.
+
+    Raises:
+        ValueError: With the unexpected differences.
+    """
+    allowed, scope = expected_changes(rules, machine)
+    unexpected = dcm_diff.unexpected_changes(dcm_diff.diff_files(full_name, output_path_file), allowed, scope)
+    if unexpected:
+        shown = ', '.join(unexpected[:5]) + (f" y {len(unexpected) - 5} más" if len(unexpected) > 5 else '')
+        raise ValueError(f"Cambios no esperados en {output_path_file}: {shown}")
+
+
+def process_plan(full_name, rules):
+    """
+    Converts a single plan. Runs in a worker process and never raises.
+
+    If the rules have a "machines" list, one output per machine is produced (see `fan_out_plan`) and `output` is a list.
+
+    Args:
+        full_name (str): Path of the source plan.
+        rules (dict): The conversion rules.
+
+    Returns:
+        dict: Per-file result with keys `file`, `output`, `status`, `error`, `write` ('patched' or 'full') and `seconds`.
+    """
+    start = time.perf_counter()
+    result = {'file': full_name, 'output': None, 'status': 'ok', 'error': None, 'write': None}
+    try:
+        if rules.get('machines'):
+            result['output'] = fan_out_plan(full_name, rules, rules['machines'])
+            result['write'] = 'full'
+        else:
+            info, pixel_data, file_path, file_name = modifDICOM.get_dicom_file(full_name, modifDICOM.READ_DEFERRED)
+            snapshot = dcm_patch.take_snapshot(info)
+            info_mod = apply_rules(info, rules)
+            output_path_file = output_path_for(full_name, rules)
+            result['write'] = dcm_patch.save_plan(full_name, output_path_file, info_mod, snapshot)
+            result['output'] = output_path_file
+            if rules.get('verify'):
+                verify_output(full_name, output_path_file, rules, rules.get('machine'))
+    except Exception as exc:
+        result['status'] = 'error'
+        result['error'] = f"{type(exc).__name__}: {exc}"
+    result['seconds'] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def run_batch(plans, rules, max_workers=None, progress=None):
+    """
+    Converts a list of plans across a process pool.
+
+    Args:
+        plans (list of str): Paths of the source plans.
+        rules (dict): The conversion rules.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        progress (callable, optional): Called with each result as soon as it is available.
+
+    Returns:
+        list of dict: One result per plan, in the same order as `plans`.
+    """
+    if rules.get('output_dir'):
+        os.makedirs(rules['output_dir'], exist_ok=True)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(process_plan, plan, rules): plan for plan in plans}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if progress is not None:
+                progress(result)
+    return [results[plan] for plan in plans]
+
+
+def _print_result(result):
+    if result['status'] == 'ok':
+        outputs = result['output'] if isinstance(result['output'], list) else [result['output']]
+        print(f"OK     {result['file']} -> {', '.join(outputs)} ({result['seconds']} s)")
+    else:
+        print(f"ERROR  {result['file']}: {result['error']}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversión batch de planes RT sin interfaz gráfica.")
+    parser.add_argument('rules', help="Archivo JSON con las reglas de conversión")
+    parser.add_argument('inputs', nargs='+', help="Directorios, archivos o patrones glob con los planes ('-' para leer rutas de la entrada estándar)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Cantidad de procesos (por defecto, uno por núcleo)")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Buscar planes en subdirectorios")
+    parser.add_argument('--report', help="Guardar el resultado por archivo en este JSON")
+    args = parser.parse_args(argv)
+
+    rules = load_rules(args.rules)
+    plans = collect_plans(args.inputs, args.recursive)
+    if not plans:
+        print("No se encontraron planes.", file=sys.stderr)
+        return 1
+
+    results = run_batch(plans, rules, args.jobs, progress=_print_result)
+    n_errors = sum(result['status'] != 'ok' for result in results)
+    print(f"{len(results) - n_errors} convertidos, {n_errors} con error.")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(results, report_file, indent=2, ensure_ascii=False)
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""
+Benchmarks de las etapas de modifDICOM y pf_con_chasisMOD con datos sintéticos.
+
+Genera planes RT a partir de PlanBase_1_QA.dcm (1 a 50 campos, 2 a 400 puntos de
+control, con y sin el bloque privado ExtendedIF) e imágenes CR de 16 bits de 1k²
+a 4k², y mide cada etapa sin diálogos:
+
+* planes: get_dicom_file, change_machine, set_tolerances_to_qa, dcmwrite,
+  save_plan (leer, editar y parchear) contra full_save (leer, editar y
+  reescribir todo) y write_private_fields (lo que hace add_private_fields);
+* CR: crop_dicom, convert_cr (lo que hace CR2DCM_v2) y save_as;
+* arranque: tiempo de importar cada script en un intérprete nuevo (lo que
+  demora en aparecer el primer diálogo) y de la carga diferida de pydicom/numpy.
+
+Cada etapa se repite --repeat veces (tiempos mínimo, mediana y máximo, y el de la
+primera corrida, que incluye cachés fríos) y se corre una vez más con
+tracemalloc para el pico de memoria. El resultado es un JSON, para comparar
+contra el de la versión anterior antes de entregar.
+
+Uso:
+    python benchmark.py --output benchmark.json
+    python benchmark.py --beams 1,10 --control-points 2,100 --cr-sizes 1024 --repeat 5
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import dcm_patch
+import machine_registry
+import modifDICOM
+import pf_con_chasisMOD
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+SEED_PLAN = os.path.join(SCRIPT_DIR, 'PlanBase_1_QA.dcm')
+MLC_LEAF_PAIRS = 60
+
+
+def make_plan(n_beams, n_control_points, extended_if=True, seed_path=SEED_PLAN):
+    """
+    Builds a synthetic arc plan from a seed plan.
+
+    Args:
+        n_beams (int): Number of beams.
+        n_control_points (int): Control points per beam (at least 2).
+        extended_if (bool): Whether to keep the Varian ExtendedIF private block of the seed.
+        seed_path (str): Plan whose header, tolerance table and first beam are reused.
+
+    Returns:
+        pydicom.dataset.FileDataset: The plan.
+    """
+    plan = pydicom.dcmread(seed_path)
+    if not extended_if:
+        for tag in [tag for tag in plan.keys() if tag.group == modifDICOM.EXTENDED_IF_GROUP]:
+            del plan[tag]
+
+    seed_beam = plan.BeamSequence[0]
+    mlc = Dataset()
+    mlc.RTBeamLimitingDeviceType = 'MLCX'
+    mlc.NumberOfLeafJawPairs = MLC_LEAF_PAIRS
+
+    control_points = []
+    for i in range(n_control_points):
+        control_point = Dataset()
+        control_point.ControlPointIndex = i
+        control_point.GantryAngle = round((180.0 + i * 360.0 / n_control_points) % 360.0, 4)
+        control_point.CumulativeMetersetWeight = round(i / (n_control_points - 1), 6)
+        leaves = Dataset()
+        leaves.RTBeamLimitingDeviceType = 'MLCX'
+        leaves.LeafJawPositions = [round(-10.0 + 0.01 * i, 2)] * MLC_LEAF_PAIRS + [10.0] * MLC_LEAF_PAIRS
+        if i == 0:
+            control_point.GantryRotationDirection = 'CW'
+            control_point.BeamLimitingDeviceAngle = 0
+            control_point.PatientSupportAngle = 0
+            jaws = copy.deepcopy(seed_beam.ControlPointSequence[0].BeamLimitingDevicePositionSequence)
+            control_point.BeamLimitingDevicePositionSequence = Sequence(list(jaws) + [leaves])
+        else:
+            control_point.BeamLimitingDevicePositionSequence = Sequence([leaves])
+        control_points.append(control_point)
+
+    template_beam = copy.deepcopy(seed_beam)
+    template_beam.BeamLimitingDeviceSequence.append(mlc)
+    template_beam.ControlPointSequence = Sequence(control_points)
+    template_beam.NumberOfControlPoints = n_control_points
+
+    beams, referenced_beams = [], []
+    for number in range(1, n_beams + 1):
+        beam = copy.deepcopy(template_beam)
+        beam.BeamNumber = number
+        beam.BeamName = f"Arco_{number}"
+        beams.append(beam)
+        referenced_beam = copy.deepcopy(plan.FractionGroupSequence[0].ReferencedBeamSequence[0])
+        referenced_beam.ReferencedBeamNumber = number
+        referenced_beams.append(referenced_beam)
+    plan.BeamSequence = Sequence(beams)
+    plan.FractionGroupSequence[0].ReferencedBeamSequence = Sequence(referenced_beams)
+    plan.FractionGroupSequence[0].NumberOfBeams = n_beams
+    return plan
+
+
+def _new_image_dataset(rows, columns, pixels=None):
+    image = Dataset()
+    image.file_meta = FileMetaDataset()
+    image.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    image.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'  # CR Image Storage
+    image.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    image.SOPClassUID = image.file_meta.MediaStorageSOPClassUID
+    image.SOPInstanceUID = image.file_meta.MediaStorageSOPInstanceUID
+    image.StudyInstanceUID = generate_uid()
+    image.SeriesInstanceUID = generate_uid()
+    image.Modality = 'CR'
+    image.Rows, image.Columns = rows, columns
+    image.SamplesPerPixel = 1
+    image.PhotometricInterpretation = 'MONOCHROME2'
+    image.BitsAllocated, image.BitsStored, image.HighBit, image.PixelRepresentation = 16, 12, 11, 0
+    image.PixelSpacing = [0.1, 0.1]
+    image.PixelData = (np.zeros((rows, columns), np.uint16) if pixels is None else pixels).tobytes()
+    return image
+
+
+def make_cr_image(size, seed=0):
+    """
+    Builds a synthetic 16-bit (12 bits stored) CR plate: unexposed border, exposed field and picket stripes.
+
+    Args:
+        size (int): Rows and columns of the image.
+        seed (int): Seed of the noise.
+
+    Returns:
+        pydicom.dataset.Dataset: The image, with file meta information.
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(100, 300, (size, size), dtype=np.uint16)
+    margin = size // 10
+    pixels[margin:-margin, margin:-margin] = rng.integers(1800, 2600, (size - 2 * margin, size - 2 * margin), dtype=np.uint16)
+    # Piquetes: franjas más oscuras cada 1/10 de la imagen
+    for column in range(margin, size - margin, max(size // 10, 1)):
+        pixels[margin:-margin, column:column + max(size // 200, 1)] = 1300
+    return _new_image_dataset(size, size, pixels)
+
+
+def make_cr_base(path):
+    """Writes a minimal stand-in for PF-noborrar.dcm, for builds where the real one is not next to the scripts."""
+    base = _new_image_dataset(2, 2)
+    base.Modality = 'RTIMAGE'
+    base.SOPClassUID = base.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.1'  # RT Image Storage
+    base.RTImageSID = 1000
+    base.ImagePlanePixelSpacing = [0.4, 0.4]
+    base.save_as(path, enforce_file_format=True)
+    return path
+
+
+def measure(func, repeat=3):
+    """
+    Times `func` and measures its peak of traced memory.
+
+    Args:
+        func (callable): The stage, without arguments.
+        repeat (int): Timed runs. One more run is done under tracemalloc.
+
+    Returns:
+        tuple: (timing dict, return value of the last run).
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timing = {
+        'first': round(seconds[0], 6),
+        'min': round(min(seconds), 6),
+        'median': round(statistics.median(seconds), 6),
+        'max': round(max(seconds), 6),
+        'peak_bytes': peak,
+    }
+    return timing, result
+
+
+def bench_plan(work_dir, n_beams, n_control_points, extended_if, machine, repeat=3):
+    """
+    Benchmarks the plan stages on one synthetic plan.
+
+    Returns:
+        dict: Plan parameters, file size and one timing per stage.
+    """
+    source = os.path.join(work_dir, f"plan_{n_beams}x{n_control_points}_{'xml' if extended_if else 'noxml'}.dcm")
+    pydicom.dcmwrite(source, make_plan(n_beams, n_control_points, extended_if), enforce_file_format=False)
+    output = os.path.join(work_dir, 'plan_mod.dcm')
+    stages = {}
+
+    stages['get_dicom_file'], (dicom_info, _, _, _) = measure(lambda: modifDICOM.get_dicom_file(source), repeat)
+    # Lectura con valores grandes diferidos, como la usa main()
+    stages['get_dicom_file_deferred'], _ = measure(lambda: modifDICOM.get_dicom_file(source, modifDICOM.READ_DEFERRED), repeat)
+    stages['change_machine'], dicom_info = measure(lambda: modifDICOM.change_machine(dicom_info, machine), repeat)
+    stages['set_tolerances_to_qa'], _ = measure(lambda: modifDICOM.set_tolerances_to_qa(dicom_info), repeat)
+    stages['dcmwrite'], _ = measure(lambda: pydicom.dcmwrite(output, dicom_info, enforce_file_format=False), repeat)
+
+    # Lo mismo que save_plan pero reescribiendo todo el plan: es contra lo que hay que compararlo
+    def full_save():
+        info = modifDICOM.get_dicom_file(source, modifDICOM.READ_DEFERRED)[0]
+        modifDICOM.set_tolerances_to_qa(info)
+        pydicom.dcmwrite(output, info, enforce_file_format=False)
+    stages['full_save'], _ = measure(full_save, repeat)
+
+    def patch_save():
+        info = modifDICOM.get_dicom_file(source, modifDICOM.READ_DEFERRED)[0]
+        snapshot = dcm_patch.take_snapshot(info)
+        modifDICOM.set_tolerances_to_qa(info)
+        return dcm_patch.save_plan(source, output, info, snapshot)
+    stages['save_plan'], mode = measure(patch_save, repeat)
+    stages['save_plan']['mode'] = mode
+
+    stages['write_private_fields'], _ = measure(lambda: modifDICOM.write_private_fields(output, os.path.join(work_dir, 'plan_private.dcm')), repeat)
+    return {
+        'beams': n_beams,
+        'control_points': n_control_points,
+        'extended_if': extended_if,
+        'file_bytes': os.path.getsize(source),
+        'stages': stages,
+    }
+
+
+def bench_cr(work_dir, size, session, sid_mm=1530.0, repeat=3):
+    """
+    Benchmarks the CR stages on one synthetic plate.
+
+    Returns:
+        dict: Image size, file size and one timing per stage.
+    """
+    source = os.path.join(work_dir, f"cr_{size}.dcm")
+    make_cr_image(size).save_as(source, enforce_file_format=True)
+    output = os.path.join(work_dir, pf_con_chasisMOD.qatrack_filename(os.path.basename(source)))
+    stages = {}
+
+    stages['crop_dicom'], cropped = measure(lambda: pf_con_chasisMOD.crop_dicom(source), repeat)
+    stages['convert_cr'], converted = measure(lambda: pf_con_chasisMOD.convert_cr(cropped, sid_mm, session=session), repeat)
+    stages['save_as'], _ = measure(lambda: converted.save_as(output), repeat)
+    return {
+        'size': size,
+        'file_bytes': os.path.getsize(source),
+        'stages': stages,
+    }
+
+
+# Nombre -> código que se mide en un intérprete nuevo
+STARTUP_PROBES = {
+    'python': 'pass',
+    'import_pf_con_chasisMOD': 'import pf_con_chasisMOD',
+    'import_cropPF': 'import cropPF',
+    'import_modifDICOM': 'import modifDICOM',
+    'pf_con_chasisMOD_first_use': 'import pf_con_chasisMOD; pf_con_chasisMOD._preload()',
+}
+
+
+def measure_startup(repeat=5):
+    """
+    Times each of STARTUP_PROBES in a fresh interpreter, as a cold start of the script would.
+
+    Args:
+        repeat (int): Runs per probe.
+
+    Returns:
+        dict: Probe name -> timing (first/min/median/max seconds; no memory peak).
+    """
+    results = {}
+    env = dict(os.environ)
+    env.pop('MODIFDCM_TRACE', None)
+    for name, code in STARTUP_PROBES.items():
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=SCRIPT_DIR, env=env, check=True)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {
+            'first': round(seconds[0], 6),
+            'min': round(min(seconds), 6),
+            'median': round(statistics.median(seconds), 6),
+            'max': round(max(seconds), 6),
+        }
+    return results
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de modifDICOM y pf_con_chasisMOD con datos sintéticos.")
+    parser.add_argument('--beams', type=_int_list, default=[1, 10, 50], help="Cantidades de campos, separadas por comas")
+    parser.add_argument('--control-points', type=_int_list, default=[2, 100, 400], help="Puntos de control por campo, separados por comas")
+    parser.add_argument('--cr-sizes', type=_int_list, default=[1024, 2048, 4096], help="Lados de las imágenes CR, separados por comas")
+    parser.add_argument('--machine', default=None, help="Equipo destino de change_machine (por defecto, el primero de maquinas.json)")
+    parser.add_argument('--repeat', type=int, default=3, help="Corridas medidas por etapa")
+    parser.add_argument('--startup-repeat', type=int, default=5, help="Arranques medidos por script (0 para no medirlos)")
+    parser.add_argument('--output', help="Guardar el resultado en este JSON (por defecto, se imprime)")
+    args = parser.parse_args(argv)
+
+    machine = args.machine or machine_registry.get_registry().labels()[0]
+    results = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'pydicom': pydicom.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': machine,
+        'repeat': args.repeat,
+        'plans': [],
+        'cr': [],
+        'startup': {},
+    }
+
+    if args.startup_repeat:
+        results['startup'] = measure_startup(args.startup_repeat)
+        print("arranque: " + ', '.join(f"{name} {timing['median']:.3f} s" for name, timing in results['startup'].items()), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix='bench_modifdcm_') as work_dir:
+        for n_beams in args.beams:
+            for n_control_points in args.control_points:
+                for extended_if in (True, False):
+                    result = bench_plan(work_dir, n_beams, n_control_points, extended_if, machine, args.repeat)
+                    results['plans'].append(result)
+                    print(f"plan {n_beams}x{n_control_points} {'con' if extended_if else 'sin'} ExtendedIF: "
+                          + ', '.join(f"{name} {timing['median']:.4f} s" for name, timing in result['stages'].items()), file=sys.stderr)
+
+        base_path = os.path.join(pf_con_chasisMOD.get_resource_path(), 'PF-noborrar.dcm')
+        if not os.path.exists(base_path):
+            base_path = make_cr_base(os.path.join(work_dir, 'PF-noborrar.dcm'))
+        session = pf_con_chasisMOD.CRConversionSession(base_path)
+        for size in args.cr_sizes:
+            result = bench_cr(work_dir, size, session, repeat=args.repeat)
+            results['cr'].append(result)
+            print(f"CR {size}x{size}: " + ', '.join(f"{name} {timing['median']:.4f} s" for name, timing in result['stages'].items()), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2, ensure_ascii=False)
+    else:
+        json.dump(results, sys.stdout, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Vista en arreglos de NumPy de los puntos de control de todos los campos de un plan.
+
+`ControlPointTable.from_dataset` recorre una sola vez BeamSequence y arma un
+arreglo estructurado con una fila por punto de control (gantry, colimador,
+camilla, peso acumulado, mordazas y MLC). Los valores que DICOM hereda del punto
+de control anterior se completan hacia adelante, así cada fila es el estado
+completo de la máquina. Las ediciones (rotar, espejar un arco, limitar el
+colimador, escalar UM) son operaciones vectorizadas sobre el arreglo y
+`write_back` vuelve a escribir en el Dataset sólo las celdas que cambiaron.
+
+Uso:
+    table = ControlPointTable.from_dataset(info)
+    table.rotate_gantry(90)
+    table.clamp_collimator()
+    table.write_back(info)
+"""
+import numpy as np
+
+# Dirección de rotación de gantry como entero, para poder espejarla con un cambio de signo
+DIRECTIONS = {'CW': 1, 'CC': -1, 'NONE': 0}
+DIRECTION_NAMES = {value: key for key, value in DIRECTIONS.items()}
+
+JAW_X_TYPES = ('X', 'ASYMX')
+JAW_Y_TYPES = ('Y', 'ASYMY')
+MLC_TYPES = ('MLCX', 'MLCY')
+
+# Campo del arreglo -> atributo del punto de control
+SCALAR_FIELDS = {
+    'gantry': 'GantryAngle',
+    'collimator': 'BeamLimitingDeviceAngle',
+    'couch': 'PatientSupportAngle',
+    'meterset_weight': 'CumulativeMetersetWeight',
+}
+
+
+def _cp_dtype(n_leaf_positions):
+    return np.dtype([
+        ('beam', np.int32),
+        ('index', np.int32),
+        ('gantry', np.float64),
+        ('gantry_direction', np.int8),
+        ('collimator', np.float64),
+        ('couch', np.float64),
+        ('meterset_weight', np.float64),
+        ('jaw_x', np.float64, (2,)),
+        ('jaw_y', np.float64, (2,)),
+        ('mlc', np.float64, (n_leaf_positions,)),
+    ])
+
+
+def _device_positions(control_point):
+    """Returns {device type: (item, positions)} of a control point."""
+    devices = {}
+    for item in getattr(control_point, 'BeamLimitingDevicePositionSequence', []):
+        devices[item.RTBeamLimitingDeviceType] = (item, item.LeafJawPositions)
+    return devices
+
+
+class ControlPointTable:
+    """
+    Structured array of every control point of every beam, with vectorized edits.
+
+    Attributes:
+        data (numpy.ndarray): One row per control point, see `_cp_dtype`. Inherited values are forward-filled and
+            missing ones are NaN.
+        present (numpy.ndarray): Boolean array with the same fields, True where the control point stores the value.
+        beam_meterset (numpy.ndarray): BeamMeterset (MU) of each beam, NaN if the plan has no FractionGroupSequence.
+        beam_numbers (list of int): BeamNumber of each beam, in BeamSequence order.
+    """
+
+    def __init__(self, data, present, beam_meterset, beam_numbers):
+        self.data = data
+        self.present = present
+        self.beam_meterset = beam_meterset
+        self.beam_numbers = beam_numbers
+        self._original = data.copy()
+        self._original_meterset = beam_meterset.copy()
+
+    @classmethod
+    def from_dataset(cls, dicom_info):
+        """
+        Builds the table from the BeamSequence of a plan.
+
+        Args:
+            dicom_info (pydicom.dataset.Dataset): The plan.
+
+        Returns:
+            ControlPointTable: The table.
+        """
+        beams = list(getattr(dicom_info, 'BeamSequence', []))
+        n_rows = sum(len(getattr(beam, 'ControlPointSequence', [])) for beam in beams)
+        n_leaf_positions = 0
+        for beam in beams:
+            for device in getattr(beam, 'BeamLimitingDeviceSequence', []):
+                if device.RTBeamLimitingDeviceType in MLC_TYPES:
+                    n_leaf_positions = max(n_leaf_positions, 2 * int(device.NumberOfLeafJawPairs))
+
+        dtype = _cp_dtype(n_leaf_positions)
+        data = np.zeros(n_rows, dtype=dtype)
+        for name in ('gantry', 'collimator', 'couch', 'meterset_weight', 'jaw_x', 'jaw_y', 'mlc'):
+            data[name] = np.nan
+        present = np.zeros(n_rows, dtype=[(name, bool) for name in dtype.names])
+
+        row = 0
+        for b, beam in enumerate(beams):
+            for i, control_point in enumerate(getattr(beam, 'ControlPointSequence', [])):
+                data['beam'][row] = b
+                data['index'][row] = i
+                for field, keyword in SCALAR_FIELDS.items():
+                    value = control_point.get(keyword)
+                    if value is not None and value != '':
+                        data[field][row] = float(value)
+                        present[field][row] = True
+                direction = control_point.get('GantryRotationDirection')
+                if direction:
+                    data['gantry_direction'][row] = DIRECTIONS.get(direction, 0)
+                    present['gantry_direction'][row] = True
+                for device_type, (item, positions) in _device_positions(control_point).items():
+                    if device_type in JAW_X_TYPES:
+                        data['jaw_x'][row] = positions
+                        present['jaw_x'][row] = True
+                    elif device_type in JAW_Y_TYPES:
+                        data['jaw_y'][row] = positions
+                        present['jaw_y'][row] = True
+                    elif device_type in MLC_TYPES:
+                        data['mlc'][row, :len(positions)] = positions
+                        present['mlc'][row] = True
+                row += 1
+
+        _forward_fill(data, present)
+
+        beam_numbers = [int(beam.BeamNumber) for beam in beams]
+        beam_meterset = np.full(len(beams), np.nan)
+        for fraction_group in getattr(dicom_info, 'FractionGroupSequence', []):
+            for referenced_beam in getattr(fraction_group, 'ReferencedBeamSequence', []):
+                number = int(referenced_beam.ReferencedBeamNumber)
+                if number in beam_numbers and 'BeamMeterset' in referenced_beam:
+                    beam_meterset[beam_numbers.index(number)] = float(referenced_beam.BeamMeterset)
+        return cls(data, present, beam_meterset, beam_numbers)
+
+    def _rows(self, beams):
+        if beams is None:
+            return slice(None)
+        return np.isin(self.data['beam'], np.asarray(beams))
+
+    def rotate_gantry(self, offset, beams=None):
+        """
+        Adds `offset` degrees to every gantry angle, wrapping to [0, 360).
+
+        Args:
+            offset (float): Rotation in degrees.
+            beams (list of int, optional): Beam positions in BeamSequence to edit. All by default.
+        """
+        rows = self._rows(beams)
+        self.data['gantry'][rows] = np.mod(self.data['gantry'][rows] + offset, 360.0)
+
+    def mirror_arc(self, beams=None):
+        """
+        Mirrors the gantry angles about the 0-180 axis and reverses the rotation direction.
+
+        Args:
+            beams (list of int, optional): Beam positions in BeamSequence to edit. All by default.
+        """
+        rows = self._rows(beams)
+        self.data['gantry'][rows] = np.mod(360.0 - self.data['gantry'][rows], 360.0)
+        self.data['gantry_direction'][rows] = -self.data['gantry_direction'][rows]
+
+    def clamp_collimator(self, beams=None):
+        """
+        Moves collimator angles outside the 0-100 / 260-360 ranges to the nearest limit.
+
+        Args:
+            beams (list of int, optional): Beam positions in BeamSequence to edit. All by default.
+        """
+        rows = self._rows(beams)
+        angles = self.data['collimator'][rows]
+        forbidden = (angles > 100.0) & (angles < 260.0)
+        self.data['collimator'][rows] = np.where(forbidden, np.where(angles < 180.0, 100.0, 260.0), angles)
+
+    def scale_mu(self, factor, beams=None):
+        """
+        Multiplies the MU (BeamMeterset) of the beams by `factor`.
+
+        Args:
+            factor (float): Scale factor.
+            beams (list of int, optional): Beam positions in BeamSequence to edit. All by default.
+        """
+        if beams is None:
+            self.beam_meterset *= factor
+        else:
+            self.beam_meterset[np.asarray(beams)] *= factor
+
+    def write_back(self, dicom_info):
+        """
+        Writes the changed values back into the plan.
+
+        Only the cells that differ from the values read in `from_dataset` are touched. A changed value is stored in
+        the control point where it is defined, or in the control point itself if it was inherited.
+
+        Args:
+            dicom_info (pydicom.dataset.Dataset): The plan the table was built from.
+
+        Returns:
+            int: Number of values written.
+        """
+        beams = dicom_info.BeamSequence
+        control_points = [beam.ControlPointSequence for beam in beams]
+        written = 0
+
+        first_of_beam = _first_of_beam(self.data)
+
+        for field, keyword in SCALAR_FIELDS.items():
+            for row in _rows_to_write(self.data[field], self._original[field], self.present[field], first_of_beam):
+                beam, index = self.data['beam'][row], self.data['index'][row]
+                setattr(control_points[beam][index], keyword, _ds(self.data[field][row]))
+                self.present[field][row] = True
+                written += 1
+
+        for row in _rows_to_write(self.data['gantry_direction'], self._original['gantry_direction'], self.present['gantry_direction'], first_of_beam):
+            beam, index = self.data['beam'][row], self.data['index'][row]
+            control_points[beam][index].GantryRotationDirection = DIRECTION_NAMES[int(self.data['gantry_direction'][row])]
+            self.present['gantry_direction'][row] = True
+            written += 1
+
+        for field, device_types in (('jaw_x', JAW_X_TYPES), ('jaw_y', JAW_Y_TYPES), ('mlc', MLC_TYPES)):
+            # Las posiciones sólo se escriben donde el punto de control tiene el item del dispositivo
+            for row in _rows_to_write(self.data[field], self._original[field], self.present[field], first_of_beam):
+                beam, index = self.data['beam'][row], self.data['index'][row]
+                devices = _device_positions(control_points[beam][index])
+                for device_type in device_types:
+                    if device_type in devices:
+                        item, positions = devices[device_type]
+                        item.LeafJawPositions = [_ds(value) for value in self.data[field][row, :len(positions)]]
+                        written += 1
+
+        for b in np.nonzero(~_same(self.beam_meterset, self._original_meterset))[0]:
+            number = self.beam_numbers[b]
+            for fraction_group in getattr(dicom_info, 'FractionGroupSequence', []):
+                for referenced_beam in getattr(fraction_group, 'ReferencedBeamSequence', []):
+                    if int(referenced_beam.ReferencedBeamNumber) == number:
+                        referenced_beam.BeamMeterset = _ds(self.beam_meterset[b])
+                        written += 1
+
+        self._original = self.data.copy()
+        self._original_meterset = self.beam_meterset.copy()
+        return written
+
+
+def _forward_fill(data, present):
+    """Fills inherited values with the last value defined in the same beam."""
+    if len(data) == 0:
+        return
+    first_of_beam = _first_of_beam(data)
+    for field in ('gantry', 'gantry_direction', 'collimator', 'couch', 'jaw_x', 'jaw_y', 'mlc'):
+        # Índice de la última fila (del mismo campo) donde el valor está definido
+        defined = present[field] | first_of_beam
+        last = np.maximum.accumulate(np.where(defined, np.arange(len(data)), 0))
+        data[field] = data[field][last]
+
+
+def _first_of_beam(data):
+    return np.r_[True, data['beam'][1:] != data['beam'][:-1]] if len(data) else np.zeros(0, dtype=bool)
+
+
+def _same(a, b):
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+
+def _reduce_rows(mask):
+    return mask.any(axis=tuple(range(1, mask.ndim))) if mask.ndim > 1 else mask
+
+
+def _rows_to_write(values, original, present, first_of_beam):
+    """
+    Rows whose value changed and can't be inherited: those that store the value, the first of each beam and
+    those that now differ from the previous control point.
+    """
+    changed = _reduce_rows(~_same(values, original))
+    differs_from_previous = np.ones(len(values), dtype=bool)
+    differs_from_previous[1:] = _reduce_rows(~_same(values[1:], values[:-1]))
+    return np.nonzero(changed & (present | first_of_beam | differs_from_previous))[0]
+
+
+def _ds(value):
+    """Rounds to a value whose decimal string fits the 16 characters of a DS."""
+    return round(float(value), 6)
@@ -0,0 +1,253 @@
+"""
+Servicio residente (opcional) de conversión de planes y placas CR.
+
+Cada acceso directo de modifDICOM o del conversor PF arranca un intérprete nuevo
+que vuelve a importar pydicom/numpy y a leer las plantillas del share. El
+servicio se deja corriendo (por ejemplo, al iniciar sesión) con todo eso ya
+cargado: pydicom, numpy, el registro de equipos, los planes base de todos los
+equipos (ver `template_cache`) y la base PF-noborrar.dcm (ver
+`pf_con_chasisMOD.CRConversionSession`). Un cliente liviano, que sólo usa la
+biblioteca estándar, le manda trabajos por un named pipe (Windows) o un socket
+local y espera el resultado, así cada trabajo tarda lo que tarda el trabajo
+DICOM.
+
+Las conexiones se autentican con una clave por usuario guardada en
+~/.modificadorDCM/servicio.key (se crea al arrancar el servicio). La dirección
+se puede cambiar con MODIFDCM_SERVICE ("host:puerto" o la ruta del pipe).
+
+Uso:
+    python conversion_service.py serve
+    python conversion_service.py plan reglas.json "C:/QA/planes/plan.dcm"
+    python conversion_service.py cr "C:/CR/placa.dcm" --sid 153
+    python conversion_service.py ping
+    python conversion_service.py stop
+"""
+import argparse
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+KEY_PATH = os.path.join(os.path.expanduser('~'), '.modificadorDCM', 'servicio.key')
+DEFAULT_PIPE = r'\\.\pipe\modificadorDCM'
+DEFAULT_PORT = 47653
+
+
+def service_address():
+    """
+    Returns the address of the service: MODIFDCM_SERVICE, or a named pipe on Windows and a localhost port elsewhere.
+
+    Returns:
+        str or tuple: A pipe path or a (host, port) pair, as `multiprocessing.connection` expects.
+    """
+    address = os.environ.get('MODIFDCM_SERVICE')
+    if address:
+        if address.startswith('\\\\'):
+            return address
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return DEFAULT_PIPE if sys.platform == 'win32' else ('127.0.0.1', DEFAULT_PORT)
+
+
+def _authkey(create=False):
+    """Reads the per-user key of the service, creating it (readable only by the user) if `create`."""
+    try:
+        with open(KEY_PATH, 'rb') as key_file:
+            return key_file.read()
+    except FileNotFoundError:
+        if not create:
+            raise
+    os.makedirs(os.path.dirname(KEY_PATH), exist_ok=True)
+    key = secrets.token_bytes(32)
+    fd = os.open(KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as key_file:
+        key_file.write(key)
+    return key
+
+
+class ConversionService:
+    """
+    Resident process that keeps libraries, templates and machine profiles loaded and runs conversion jobs.
+
+    Jobs are dicts with an 'op' key:
+
+    * {'op': 'plan', 'file': ..., 'rules': {...}}: like `batch_modifDICOM.process_plan`.
+    * {'op': 'cr', 'file': ..., 'sid_cm': 153, 'output_dir': None, 'bin_factor': 2, 'compression': None}: like `pf_watch.convert_file`.
+    * {'op': 'ping'}: returns the uptime, warm-up time and number of jobs done.
+    * {'op': 'stop'}: stops the service after answering.
+
+    Args:
+        address (str or tuple, optional): Where to listen. Defaults to `service_address()`.
+        max_jobs (int): Jobs run at the same time; the other connections wait.
+    """
+
+    def __init__(self, address=None, max_jobs=2):
+        self.address = address or service_address()
+        self.max_jobs = threading.BoundedSemaphore(max_jobs)
+        self.jobs_done = 0
+        # Los trabajos corren en hilos de cada conexión, varios a la vez
+        self._jobs_done_lock = threading.Lock()
+        self.warm_up_seconds = None
+        self._started = time.monotonic()
+        self._stopping = threading.Event()
+        self._session = None
+
+    def warm_up(self):
+        """Imports the conversion modules and loads the machine registry, every plan template and the CR base."""
+        start = time.perf_counter()
+        import batch_modifDICOM  # noqa: F401  (importa pydicom, numpy, modifDICOM y el registro)
+        import machine_registry
+        import pf_con_chasisMOD
+        import template_cache
+
+        for profile in machine_registry.get_registry().profiles:
+            try:
+                template_cache.get_template(profile.template)
+            except FileNotFoundError as error:
+                print(f"Aviso: {error}", file=sys.stderr)
+        try:
+            self._session = pf_con_chasisMOD.get_session()
+        except FileNotFoundError as error:
+            print(f"Aviso: {error}", file=sys.stderr)
+        self.warm_up_seconds = round(time.perf_counter() - start, 3)
+
+    def handle(self, job):
+        """
+        Runs one job. Never raises: errors are reported in the result.
+
+        Args:
+            job (dict): See the class docstring.
+
+        Returns:
+            dict: The result of the job.
+        """
+        op = job.get('op')
+        if op == 'ping':
+            return {'status': 'ok', 'uptime': round(time.monotonic() - self._started, 1),
+                    'warm_up_seconds': self.warm_up_seconds, 'jobs_done': self.jobs_done}
+        if op == 'stop':
+            self._stopping.set()
+            return {'status': 'ok'}
+
+        with self.max_jobs:
+            try:
+                if op == 'plan':
+                    import batch_modifDICOM
+                    rules = batch_modifDICOM.validate_rules(job['rules'])
+                    result = batch_modifDICOM.process_plan(job['file'], rules)
+                elif op == 'cr':
+                    import pf_watch
+                    output_dir = job.get('output_dir') or os.path.dirname(job['file'])
+                    result = pf_watch.convert_file(job['file'], float(job.get('sid_cm', pf_watch.DEFAULT_SID_CM)) * 10,
+                                                   output_dir, int(job.get('bin_factor', 2)), job.get('compression'))
+                else:
+                    return {'status': 'error', 'error': f"Operación desconocida: {op!r}"}
+            except Exception as error:
+                return {'status': 'error', 'error': f"{type(error).__name__}: {error}"}
+            with self._jobs_done_lock:
+                self.jobs_done += 1
+            return result
+
+    def serve_forever(self):
+        """Accepts connections until a 'stop' job arrives. Each connection is served on its own thread."""
+        with Listener(self.address, authkey=_authkey(create=True)) as listener:
+            print(f"Servicio de conversión escuchando en {self.address} (listo en {self.warm_up_seconds} s)", flush=True)
+            while not self._stopping.is_set():
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, OSError, EOFError) as error:
+                    # Cliente con otra clave o que cortó durante la autenticación
+                    print(f"Conexión rechazada: {error}", file=sys.stderr)
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    job = connection.recv()
+                except (EOFError, OSError):
+                    return
+                connection.send(self.handle(job))
+                if self._stopping.is_set():
+                    # Despertar al accept() del hilo principal para que vea la señal
+                    try:
+                        Client(self.address, authkey=_authkey()).close()
+                    except OSError:
+                        pass
+                    return
+
+
+def submit(job, address=None):
+    """
+    Sends a job to the running service and waits for its result.
+
+    Args:
+        job (dict): See `ConversionService`.
+        address (str or tuple, optional): Defaults to `service_address()`.
+
+    Returns:
+        dict: The result of the job.
+
+    Raises:
+        ConnectionError: If the service is not running.
+    """
+    try:
+        connection = Client(address or service_address(), authkey=_authkey())
+    except (FileNotFoundError, ConnectionRefusedError) as error:
+        raise ConnectionError("El servicio de conversión no está corriendo (python conversion_service.py serve).") from error
+    with connection:
+        connection.send(job)
+        return connection.recv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servicio residente de conversión de planes y placas CR.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help="Cargar todo y quedarse esperando trabajos")
+    serve.add_argument('-j', '--jobs', type=int, default=2, help="Trabajos simultáneos")
+    plan = subparsers.add_parser('plan', help="Convertir planes con un archivo de reglas (como batch_modifDICOM)")
+    plan.add_argument('rules', help="Archivo JSON con las reglas de conversión")
+    plan.add_argument('files', nargs='+', help="Planes a convertir")
+    cr = subparsers.add_parser('cr', help="Convertir placas CR para QATrack (como pf_con_chasisMOD)")
+    cr.add_argument('files', nargs='+', help="Imágenes CR")
+    cr.add_argument('--sid', type=float, default=153, help="Distancia de la placa CR en cm")
+    cr.add_argument('--output-dir', help="Directorio de salida (por defecto, el de cada imagen)")
+    subparsers.add_parser('ping', help="Ver si el servicio está corriendo")
+    subparsers.add_parser('stop', help="Detener el servicio")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        service = ConversionService(max_jobs=args.jobs)
+        service.warm_up()
+        service.serve_forever()
+        return 0
+
+    if args.command == 'plan':
+        with open(args.rules, 'r', encoding='utf-8') as rules_file:
+            rules = json.load(rules_file)
+        jobs = [{'op': 'plan', 'file': os.path.abspath(path), 'rules': rules} for path in args.files]
+    elif args.command == 'cr':
+        output_dir = os.path.abspath(args.output_dir) if args.output_dir else None
+        jobs = [{'op': 'cr', 'file': os.path.abspath(path), 'sid_cm': args.sid, 'output_dir': output_dir} for path in args.files]
+    else:
+        jobs = [{'op': args.command}]
+
+    n_errors = 0
+    for job in jobs:
+        try:
+            result = submit(job)
+        except ConnectionError as error:
+            print(error, file=sys.stderr)
+            return 2
+        n_errors += result.get('status') != 'ok'
+        print(json.dumps(result, ensure_ascii=False))
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,8 @@
 import tkinter as tk
 from tkinter import filedialog, simpledialog
-import pydicom
-import numpy as np
-import matplotlib.pyplot as plt
 
-import tkinter as tk
-from tkinter import filedialog
-import pydicom
-import numpy as np
-import matplotlib.pyplot as plt
+# pydicom, numpy (vía autocrop) y sobre todo matplotlib (vía preview) se importan recién al usarlos,
+# para que el diálogo de selección aparezca enseguida
 
 def crop_dicom():
     # Abrir diálogo para seleccionar archivo DICOM
@@ -19,35 +13,35 @@ def crop_dicom():
         print('User pressed cancel')
         return None
 
+    import pydicom
+    import autocrop
+    import dcm_compress
+
     # Leer archivo DICOM seleccionado
     dicom_info = pydicom.dcmread(file_path,force=True)
 
     # Extraer la matriz de píxeles
     pixel_array = dicom_info.pixel_array
 
-    # Seleccionar la columna central
-    central_column = pixel_array[:, pixel_array.shape[1] // 2]
-
-    # Filtrar las filas cuyos píxeles sean menores a 1000 o iguales a 4095
-    filtered_indices = np.where((central_column >= 1000) & (central_column != 4095))[0]
-
-    # Crear una nueva imagen recortada
-    cropped_image = pixel_array[filtered_indices, :]
+    # Buscar la zona expuesta con los perfiles de filas y columnas de toda la imagen
+    # (sin sub-exposición ni saturación, según la profundidad de bits)
+    bits_stored = getattr(dicom_info, 'BitsStored', 12)
+    rows, columns = autocrop.find_exposed_region(pixel_array, bits_stored=bits_stored)
 
-    # Mostrar la imagen original y la recortada para comparación (opcional)
-    plt.figure(figsize=(10, 5))
-    plt.subplot(1, 2, 1)
-    plt.title('Original Image')
-    plt.imshow(pixel_array, cmap='gray')
+    # Crear una nueva imagen recortada (vista, sin copia)
+    cropped_image = pixel_array[rows, columns]
 
-    plt.subplot(1, 2, 2)
-    plt.title('Cropped Image')
-    plt.imshow(cropped_image, cmap='gray')
+    # Mostrar la imagen original con el recorte marcado y la zona recortada (opcional),
+    # desde una pirámide de resoluciones para que la ventana abra enseguida
+    import matplotlib.pyplot as plt
+    import preview
+    preview.show_crop(pixel_array, rows, columns)
     plt.show()
 
     # Crear un nuevo objeto FileDataset para la imagen recortada
     cropped_dicom_info = dicom_info.copy()
-    cropped_dicom_info.PixelData = cropped_image.tobytes()
+    # Sin comprimir: si la placa venía comprimida, también cambia la sintaxis de transferencia
+    dcm_compress.set_pixel_data(cropped_dicom_info, cropped_image)
     cropped_dicom_info.Rows, cropped_dicom_info.Columns = cropped_image.shape
 
     # Devolver el objeto DICOM recortado
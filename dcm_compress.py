@@ -0,0 +1,270 @@
+"""
+Salida de imágenes con sintaxis de transferencia comprimidas sin pérdida.
+
+Las imágenes para QATrack y las placas CR recortadas se guardaban con los
+píxeles sin comprimir. Este módulo las escribe en RLE Lossless o en Deflated
+Explicit VR Little Endian, con lo que hay en Python/NumPy sin dependencias
+extra:
+
+* RLE: el PackBits de cada plano de bytes (el más significativo primero) está
+  vectorizado con NumPy y codifica cada fila por separado, como pide el
+  estándar (PS3.5 anexo G). Los píxeles quedan encapsulados en un fragmento por
+  cuadro.
+* Deflated: pydicom comprime todo el dataset con zlib al escribirlo.
+
+En los dos casos se actualizan la sintaxis de transferencia del file meta y la
+codificación del dataset (Explicit VR Little Endian). Cualquier visor DICOM, y
+pydicom sin plugins, lee las dos.
+
+Uso:
+    python dcm_compress.py rle "C:/QATrack/entrada/*-a_QATrack.dcm" -j 8
+    python dcm_compress.py deflated placa.dcm -o comprimidas
+"""
+import argparse
+import glob
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from dcm_index import DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN, IMPLICIT_VR_LITTLE_ENDIAN
+
+RLE_LOSSLESS = '1.2.840.10008.1.2.5'
+# Nombre en la configuración -> sintaxis de transferencia
+COMPRESSIONS = {'rle': RLE_LOSSLESS, 'deflated': DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN}
+UNCOMPRESSED_SYNTAXES = (IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN)
+
+# Corridas más cortas van como literales: repetir 2 bytes cuesta lo mismo y corta el literal
+MIN_REPEAT = 3
+MAX_PACKET = 128
+
+
+def _chunks(starts, lengths):
+    """Splits each (start, length) range into pieces of at most MAX_PACKET bytes."""
+    counts = (lengths + MAX_PACKET - 1) // MAX_PACKET
+    owner = np.repeat(np.arange(len(starts)), counts)
+    piece = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    chunk_starts = starts[owner] + MAX_PACKET * piece
+    return chunk_starts, np.minimum(MAX_PACKET, lengths[owner] - MAX_PACKET * piece)
+
+
+def packbits_rows(plane):
+    """
+    PackBits-encodes each row of a byte plane separately and concatenates the rows.
+
+    Args:
+        plane (numpy.ndarray): 2D uint8 array.
+
+    Returns:
+        bytes: The encoded rows.
+    """
+    plane = np.ascontiguousarray(plane, dtype=np.uint8)
+    n_rows, width = plane.shape
+    flat = plane.ravel()
+    if flat.size == 0:
+        return b''
+
+    # Corridas de bytes iguales, cortadas al comienzo de cada fila
+    new_run = np.empty(flat.size, dtype=bool)
+    new_run[0] = True
+    np.not_equal(flat[1:], flat[:-1], out=new_run[1:])
+    new_run[::width] = True
+    starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(starts, flat.size))
+    repeat = lengths >= MIN_REPEAT
+
+    # Literales: corridas cortas consecutivas de una misma fila
+    row_start = starts % width == 0
+    literal = ~repeat
+    begins = literal & (row_start | np.concatenate(([True], repeat[:-1])))
+    ends = literal & (np.append(row_start[1:], True) | np.append(repeat[1:], True))
+    literal_starts = starts[begins]
+    literal_lengths = starts[ends] + lengths[ends] - literal_starts
+
+    repeat_starts, repeat_lengths = _chunks(starts[repeat], lengths[repeat])
+    literal_starts, literal_lengths = _chunks(literal_starts, literal_lengths)
+
+    # Paquetes en el orden de la imagen: encabezado + 1 byte (repetición) o encabezado + n bytes (literal)
+    packet_starts = np.concatenate((repeat_starts, literal_starts))
+    packet_lengths = np.concatenate((repeat_lengths, literal_lengths))
+    is_repeat = np.zeros(len(packet_starts), dtype=bool)
+    is_repeat[:len(repeat_starts)] = True
+    order = np.argsort(packet_starts, kind='stable')
+    packet_starts, packet_lengths, is_repeat = packet_starts[order], packet_lengths[order], is_repeat[order]
+
+    sizes = np.where(is_repeat, 2, packet_lengths + 1)
+    offsets = np.cumsum(sizes) - sizes
+    encoded = np.empty(int(sizes.sum()), dtype=np.uint8)
+    encoded[offsets] = np.where(is_repeat, 257 - packet_lengths, packet_lengths - 1).astype(np.uint8)
+    encoded[offsets[is_repeat] + 1] = flat[packet_starts[is_repeat]]
+
+    # Bytes de los literales: rangos consecutivos de la entrada a rangos consecutivos de la salida
+    literal_lengths = packet_lengths[~is_repeat]
+    n_literal = int(literal_lengths.sum())
+    shift = np.repeat(offsets[~is_repeat] + 1 - packet_starts[~is_repeat], literal_lengths)
+    source = np.arange(n_literal) - np.repeat(np.cumsum(literal_lengths) - literal_lengths, literal_lengths) \
+        + np.repeat(packet_starts[~is_repeat], literal_lengths)
+    encoded[source + shift] = flat[source]
+    return encoded.tobytes()
+
+
+def rle_encode_frame(frame):
+    """
+    Encodes one frame as RLE Lossless: 64-byte header and one segment per byte of the samples.
+
+    Args:
+        frame (numpy.ndarray): (rows, columns) array of unsigned or signed integers of 1, 2 or 4 bytes.
+
+    Returns:
+        bytes: The RLE frame.
+
+    Raises:
+        ValueError: If the frame is not 2D or its samples are not 1, 2 or 4-byte integers.
+    """
+    if frame.ndim != 2 or frame.dtype.kind not in 'ui' or frame.dtype.itemsize not in (1, 2, 4):
+        raise ValueError(f"RLE sólo para imágenes monocromo de enteros de 8, 16 o 32 bits, no {frame.dtype} {frame.shape}")
+    n_bytes = frame.dtype.itemsize
+    as_bytes = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder('<')).view(np.uint8)
+    as_bytes = as_bytes.reshape(frame.shape[0], frame.shape[1], n_bytes)
+
+    segments = []
+    # El primer segmento es el del byte más significativo
+    for byte in range(n_bytes - 1, -1, -1):
+        segment = packbits_rows(as_bytes[:, :, byte])
+        segments.append(segment + b'\x00' * (len(segment) % 2))
+    offsets = np.cumsum([64] + [len(segment) for segment in segments[:-1]])
+    header = struct.pack('<16L', len(segments), *offsets, *([0] * (15 - len(segments))))
+    return header + b''.join(segments)
+
+
+def set_pixel_data(dataset, array, compression=None):
+    """
+    Stores `array` as the PixelData of `dataset`, updating the transfer syntax of its file meta.
+
+    The file meta elements are replaced, not modified, since they may be shared with a template (see
+    `pf_con_chasisMOD.CRConversionSession.new_dataset`).
+
+    Args:
+        dataset (pydicom.dataset.FileDataset): The image.
+        array (numpy.ndarray): The pixels, (rows, columns).
+        compression (str, optional): 'rle', 'deflated' or None for native pixels. With None a compressed source
+            keeps its VR encoding but gets an uncompressed transfer syntax.
+
+    Raises:
+        ValueError: If `compression` is unknown or the image can't be RLE encoded.
+    """
+    from pydicom.encaps import encapsulate
+
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Compresión desconocida: {compression!r} (opciones: {', '.join(COMPRESSIONS)})")
+    file_meta = dataset.file_meta
+    current = file_meta.get('TransferSyntaxUID')
+
+    if compression == 'rle':
+        dataset.add_new('PixelData', 'OB', encapsulate([rle_encode_frame(array)]))
+        dataset['PixelData'].is_undefined_length = True
+        transfer_syntax = RLE_LOSSLESS
+    else:
+        dataset.add_new('PixelData', 'OB' if array.dtype.itemsize == 1 else 'OW', np.ascontiguousarray(array).tobytes())
+        if compression == 'deflated':
+            transfer_syntax = DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN
+        elif current in UNCOMPRESSED_SYNTAXES:
+            transfer_syntax = current
+        else:
+            transfer_syntax = EXPLICIT_VR_LITTLE_ENDIAN
+    # pydicom toma la codificación del dataset (Explicit VR Little Endian salvo en Implicit VR) de esta sintaxis
+    file_meta.add_new('TransferSyntaxUID', 'UI', transfer_syntax)
+
+
+def compress_file(path, output_path=None, compression='rle'):
+    """
+    Rewrites a DICOM image with a compressed transfer syntax. Never raises: errors are reported in the result.
+
+    Args:
+        path (str): The image.
+        output_path (str, optional): Where to write it. Defaults to overwriting `path` (through a temporary file).
+        compression (str): 'rle' or 'deflated', see `COMPRESSIONS`.
+
+    Returns:
+        dict: 'file', 'output', 'status', 'error', 'bytes_in', 'bytes_out' and 'seconds'.
+    """
+    import pydicom
+
+    start = time.perf_counter()
+    output_path = output_path or path
+    result = {'file': path, 'output': output_path, 'status': 'ok', 'error': None, 'bytes_in': os.path.getsize(path)}
+    try:
+        dataset = pydicom.dcmread(path)
+        set_pixel_data(dataset, dataset.pixel_array, compression)
+        temporary = output_path + '.tmp'
+        pydicom.dcmwrite(temporary, dataset, enforce_file_format=False)
+        os.replace(temporary, output_path)
+        result['bytes_out'] = os.path.getsize(output_path)
+    except Exception as error:
+        result['status'] = 'error'
+        result['error'] = f"{type(error).__name__}: {error}"
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def compress_files(paths, compression='rle', output_dir=None, max_workers=None, progress=None):
+    """
+    Compresses several images across a process pool, see `compress_file`.
+
+    Args:
+        paths (list of str): The images.
+        compression (str): 'rle' or 'deflated'.
+        output_dir (str, optional): Where to write the outputs, with the same names. Defaults to overwriting them.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        progress (callable, optional): Called with each result as soon as it is available.
+
+    Returns:
+        list of dict: One result per image, in the same order as `paths`.
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for path in paths:
+            output_path = os.path.join(output_dir, os.path.basename(path)) if output_dir else None
+            futures[pool.submit(compress_file, path, output_path, compression)] = path
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if progress is not None:
+                progress(result)
+    return [results[path] for path in paths]
+
+
+def _print_result(result):
+    if result['status'] == 'ok':
+        ratio = result['bytes_in'] / result['bytes_out'] if result['bytes_out'] else 0
+        print(f"OK     {result['file']} -> {result['output']} ({result['bytes_in']} -> {result['bytes_out']} bytes, "
+              f"{ratio:.1f}x, {result['seconds']} s)")
+    else:
+        print(f"ERROR  {result['file']}: {result['error']}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Comprime imágenes DICOM sin pérdida (RLE Lossless o Deflated).")
+    parser.add_argument('compression', choices=sorted(COMPRESSIONS), help="Sintaxis de transferencia de salida")
+    parser.add_argument('files', nargs='+', help="Imágenes o patrones glob")
+    parser.add_argument('-o', '--output-dir', help="Directorio de salida (por defecto, se reemplazan los archivos)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Cantidad de procesos (por defecto, uno por núcleo)")
+    args = parser.parse_args(argv)
+
+    paths = sorted({path for pattern in args.files for path in glob.glob(pattern)})
+    results = compress_files(paths, args.compression, args.output_dir, args.jobs, progress=_print_result)
+    ok = [result for result in results if result['status'] == 'ok']
+    bytes_in = sum(result['bytes_in'] for result in ok)
+    bytes_out = sum(result['bytes_out'] for result in ok)
+    print(f"{len(ok)} comprimidas, {len(results) - len(ok)} con error: {bytes_in} -> {bytes_out} bytes.")
+    return 1 if len(ok) < len(results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+"""
+Comparación de planes por hashes de contenido de cada elemento.
+
+Cada elemento se resume en un hash de los bytes de su valor (tal como queda en
+el archivo) y cada secuencia o item en un hash de los hashes de sus hijos, así
+que dos subárboles iguales se descartan con una sola comparación. Los
+elementos que pydicom todavía no convirtió se hashean directamente desde sus
+bytes crudos, sin parsearlos: dos planes de 400 puntos de control leídos del
+disco se comparan sin convertir las secuencias que no cambiaron. Los objetos
+compartidos entre los dos datasets (p. ej. las secuencias que `change_machine`
+injerta en la plantilla) se dan por iguales sin mirarlos.
+
+Sirve para verificar una conversión: que entre el plan original y el generado
+sólo hayan cambiado los atributos esperados (ver `unexpected_changes` y la
+regla "verify" de `batch_modifDICOM`).
+
+Uso:
+    python dcm_diff.py plan.dcm plan_mod.dcm
+    python dcm_diff.py plan.dcm plan_mod.dcm --allow GantryAngle RTImageSID
+"""
+import argparse
+import hashlib
+import mmap
+import sys
+from collections import namedtuple
+
+import pydicom
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.dataelem import RawDataElement
+
+import dcm_index
+import dcm_patch
+
+# VRs cuyo relleno al final (espacios o NUL) no cambia el valor
+PADDED_VRS = dcm_patch.TEXT_VRS | {'UI'}
+
+PlanDiff = namedtuple('PlanDiff', 'added removed changed')
+PlanDiff.__doc__ = """
+Differences between two datasets, as lists of tag paths.
+
+A tag path is a tuple alternating tags and item indices, as in `dcm_patch`: (BeamSequence, 0, GantryAngle) is the
+gantry angle of the first beam. A path ending in an index is a whole sequence item.
+
+Attributes:
+    added (list of tuple): Elements or items only in the modified dataset.
+    removed (list of tuple): Elements or items only in the original dataset.
+    changed (list of tuple): Elements whose value changed.
+"""
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _vr(elem):
+    if elem.VR is not None:
+        return elem.VR
+    try:
+        return dictionary_VR(elem.tag)
+    except KeyError:
+        return None
+
+
+def _value_digest(value, vr):
+    if vr in PADDED_VRS:
+        value = value.rstrip(b' \x00')
+    return _digest(value)
+
+
+def _encoding(dataset, inherited):
+    """Returns (implicit_vr, little_endian) of `dataset`, or the one of its parent if it was not read from a file."""
+    encoding = getattr(dataset, 'original_encoding', (None, None))
+    return inherited if None in encoding else encoding
+
+
+class _Hasher:
+    """
+    Content digests of elements and items of a dataset, memoized by object.
+
+    Args:
+        expand_raw (bool): Whether raw sequences are converted and hashed item by item. Otherwise their raw bytes are
+            hashed, which is faster but gives a different digest than the same sequence once converted.
+    """
+
+    def __init__(self, expand_raw=False):
+        self.expand_raw = expand_raw
+        self._memo = {}
+
+    def _cached(self, obj):
+        cached = self._memo.get(id(obj))
+        return cached[1] if cached is not None and cached[0] is obj else None
+
+    def _remember(self, obj, digest):
+        # Se guarda el objeto para que su id no se reutilice mientras dure la comparación
+        self._memo[id(obj)] = (obj, digest)
+        return digest
+
+    def element(self, dataset, tag, encoding):
+        """Returns the digest of the element `tag` of `dataset`."""
+        elem = dataset.get_item(tag)
+        digest = self._cached(elem)
+        if digest is not None:
+            return digest
+        if isinstance(elem, RawDataElement) and elem.value is not None and not (self.expand_raw and dcm_patch._is_sequence(elem)):
+            return self._remember(elem, _value_digest(elem.value, _vr(elem)))
+
+        elem = dataset[tag]
+        if elem.VR == 'SQ':
+            digest = _digest(b''.join(self.item(item, encoding) for item in elem.value))
+        else:
+            digest = _value_digest(dcm_patch.value_bytes(elem, *encoding), elem.VR)
+        return self._remember(elem, digest)
+
+    def item(self, dataset, encoding):
+        """Returns the digest of a whole dataset or sequence item."""
+        digest = self._cached(dataset)
+        if digest is not None:
+            return digest
+        encoding = _encoding(dataset, encoding)
+        parts = [int(tag).to_bytes(4, 'little') + self.element(dataset, tag, encoding) for tag in sorted(dataset.keys())]
+        return self._remember(dataset, _digest(b''.join(parts)))
+
+
+# Los dos recorridos que compara `_diff_items`: un Dataset de pydicom o los bytes del archivo. Un item tiene
+# `identity`, `digest()` y `elements()` (tag -> elemento); un elemento tiene `digest()` e `items()` (None si no es
+# una secuencia). `whole_digest` indica si conviene comparar el item entero antes de mirar sus elementos: en un
+# Dataset el hash del item cuesta lo mismo que recorrerlo y no aprovecha los objetos compartidos.
+
+class _DatasetItem:
+    whole_digest = False
+
+    def __init__(self, dataset, encoding, hasher):
+        self.identity = dataset
+        self.encoding = _encoding(dataset, encoding)
+        self.hasher = hasher
+
+    def digest(self):
+        return self.hasher.item(self.identity, self.encoding)
+
+    def elements(self):
+        return {int(tag): _DatasetElement(self, tag) for tag in self.identity.keys()}
+
+
+class _DatasetElement:
+    def __init__(self, parent, tag):
+        self.parent = parent
+        self.tag = tag
+        self.identity = parent.identity.get_item(tag)
+
+    def digest(self):
+        return self.parent.hasher.element(self.parent.identity, self.tag, self.parent.encoding)
+
+    def items(self):
+        elem = self.parent.identity[self.tag]
+        if elem.VR != 'SQ':
+            return None
+        return [_DatasetItem(item, self.parent.encoding, self.parent.hasher) for item in elem.value]
+
+
+class _BufferItem:
+    identity = None
+    whole_digest = True
+
+    def __init__(self, buf, start, end, layout):
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.layout = layout
+
+    def digest(self):
+        return _digest(self.buf[self.start:self.end])
+
+    def elements(self):
+        elements = {}
+        for element in dcm_index.iter_elements(self.buf, self.start, self.end, self.layout.implicit_vr, self.layout.little_endian):
+            if element.tag in (dcm_index.ITEM_DELIMITER, dcm_index.SEQUENCE_DELIMITER):
+                break
+            elements[element.tag] = _BufferElement(self.buf, element, self.layout)
+        return elements
+
+
+class _BufferElement:
+    identity = None
+
+    def __init__(self, buf, element, layout):
+        self.buf = buf
+        self.element = element
+        self.layout = layout
+
+    def digest(self):
+        return _value_digest(self.buf[self.element.value_offset:self.element.end], self.element.vr)
+
+    def items(self):
+        if self.element.vr != 'SQ':
+            return None
+        return [_BufferItem(self.buf, item.value_offset, item.end, self.layout)
+                for item in dcm_index.iter_elements(self.buf, self.element.value_offset, self.element.end,
+                                                    self.layout.implicit_vr, self.layout.little_endian)
+                if item.tag == dcm_index.ITEM]
+
+
+def build_index(dataset, encoding=(True, True)):
+    """
+    Builds the content-hash index of a dataset.
+
+    The digests don't depend on whether the elements were already converted, so indexes of the same plan taken at
+    different times (or stored) can be compared directly.
+
+    Args:
+        dataset (pydicom.dataset.Dataset): The dataset. Its raw elements are converted.
+        encoding (tuple): (implicit_vr, little_endian) used for elements not read from a file.
+
+    Returns:
+        dict: Tag path -> 16-byte digest of every element and sequence item; () is the whole dataset.
+    """
+    hasher = _Hasher(expand_raw=True)
+    index = {}
+
+    def visit(item, prefix):
+        index[prefix] = item.digest()
+        for tag, element in sorted(item.elements().items()):
+            path = prefix + (tag,)
+            index[path] = element.digest()
+            for i, child in enumerate(element.items() or ()):
+                visit(child, path + (i,))
+
+    visit(_DatasetItem(dataset, encoding, hasher), ())
+    return index
+
+
+def diff(original, modified):
+    """
+    Compares two datasets element by element, skipping identical subtrees.
+
+    Reading a value converts it, so pass datasets that are not going to be saved with `dcm_patch.save_plan`
+    afterwards. Objects shared by both datasets are considered equal: to check edits made in place, `original` must
+    not share sequences with `modified` (e.g. read it again from disk, or compare the files with `diff_files`).
+
+    Args:
+        original (pydicom.dataset.Dataset): The dataset before the conversion.
+        modified (pydicom.dataset.Dataset): The dataset after the conversion.
+
+    Returns:
+        PlanDiff: The added, removed and changed paths, in tag order.
+    """
+    hasher = _Hasher()
+    result = PlanDiff([], [], [])
+    _diff_items(_DatasetItem(original, (True, True), hasher), _DatasetItem(modified, (True, True), hasher), (), result)
+    return result
+
+
+def diff_files(original_path, modified_path):
+    """
+    Compares two DICOM files without parsing them, see `diff`.
+
+    The digests are taken directly over the bytes of each element, item and sequence located with `dcm_index`, so
+    only the subtrees that differ are walked. The file meta (group 0002) is not compared.
+
+    Args:
+        original_path (str): The source plan.
+        modified_path (str): The converted plan.
+
+    Returns:
+        PlanDiff: The differences.
+    """
+    with open(original_path, 'rb') as original_file, open(modified_path, 'rb') as modified_file:
+        with mmap.mmap(original_file.fileno(), 0, access=mmap.ACCESS_READ) as buf_a, \
+                mmap.mmap(modified_file.fileno(), 0, access=mmap.ACCESS_READ) as buf_b:
+            try:
+                layout_a, layout_b = dcm_index.read_file_layout(buf_a), dcm_index.read_file_layout(buf_b)
+            except NotImplementedError:
+                layout_a = layout_b = None
+            if layout_a is None or layout_a[1:3] != layout_b[1:3]:
+                # Deflated o con distinta sintaxis: los bytes no son comparables, se comparan los valores
+                return diff(pydicom.dcmread(original_path), pydicom.dcmread(modified_path))
+            result = PlanDiff([], [], [])
+            _diff_items(_BufferItem(buf_a, layout_a.dataset_offset, len(buf_a), layout_a),
+                        _BufferItem(buf_b, layout_b.dataset_offset, len(buf_b), layout_b), (), result)
+            return result
+
+
+def _diff_items(a, b, prefix, result):
+    if a.identity is not None and a.identity is b.identity:
+        return
+    if a.whole_digest and a.digest() == b.digest():
+        return
+    elements_a, elements_b = a.elements(), b.elements()
+    for tag in sorted(elements_a.keys() | elements_b.keys()):
+        path = prefix + (tag,)
+        if tag not in elements_b:
+            result.removed.append(path)
+            continue
+        if tag not in elements_a:
+            result.added.append(path)
+            continue
+        elem_a, elem_b = elements_a[tag], elements_b[tag]
+        if elem_a.identity is not None and elem_a.identity is elem_b.identity:
+            continue
+        if elem_a.digest() == elem_b.digest():
+            continue
+
+        items_a, items_b = elem_a.items(), elem_b.items()
+        if items_a is None or items_b is None:
+            result.changed.append(path)
+            continue
+        # Distinto hash de la secuencia: bajar a los items, donde los iguales se descartan por su hash
+        for i in range(max(len(items_a), len(items_b))):
+            if i >= len(items_b):
+                result.removed.append(path + (i,))
+            elif i >= len(items_a):
+                result.added.append(path + (i,))
+            else:
+                _diff_items(items_a[i], items_b[i], path + (i,), result)
+
+
+def format_path(path):
+    """
+    Formats a tag path, e.g. 'BeamSequence[0].ControlPointSequence[3].GantryAngle'.
+
+    Args:
+        path (tuple): A tag path.
+
+    Returns:
+        str: The readable path; tags without a keyword are written as '(gggg,eeee)'.
+    """
+    text = ''
+    for position, part in enumerate(path):
+        if position % 2:
+            text += f'[{part}]'
+        else:
+            keyword = keyword_for_tag(part) or f'({part >> 16:04X},{part & 0xFFFF:04X})'
+            text += ('.' if text else '') + keyword
+    return text
+
+
+def _keyword(path):
+    """Returns the keyword of the element a path points to (of the sequence, for an item)."""
+    tag = path[-1] if len(path) % 2 else path[-2]
+    return keyword_for_tag(tag)
+
+
+def unexpected_changes(plan_diff, allowed, scope=None):
+    """
+    Lists the differences that a conversion was not supposed to make.
+
+    Args:
+        plan_diff (PlanDiff): As returned by `diff`.
+        allowed (iterable of str or int): Keywords (or tags, for private elements) of the attributes that may change,
+            be added or removed at any depth.
+        scope (iterable of str, optional): Top-level keywords to check. Differences outside them are ignored, e.g.
+            the attributes that `change_machine` takes from the machine template.
+
+    Returns:
+        list of str: The formatted paths of the unexpected differences.
+    """
+    allowed = set(allowed)
+    scope = set(scope) if scope is not None else None
+    unexpected = []
+    for path in sorted(plan_diff.added + plan_diff.removed + plan_diff.changed):
+        if scope is not None and keyword_for_tag(path[0]) not in scope:
+            continue
+        tag = path[-1] if len(path) % 2 else path[-2]
+        if _keyword(path) not in allowed and tag not in allowed:
+            unexpected.append(format_path(path))
+    return unexpected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Diferencias entre dos planes DICOM, elemento por elemento.")
+    parser.add_argument('original', help="Plan original")
+    parser.add_argument('modified', help="Plan modificado")
+    parser.add_argument('--allow', nargs='+', metavar='KEYWORD',
+                        help="Atributos que pueden cambiar: sólo se informan (y dan error) los demás")
+    args = parser.parse_args(argv)
+
+    plan_diff = diff_files(args.original, args.modified)
+    if args.allow:
+        unexpected = unexpected_changes(plan_diff, args.allow)
+        for path in unexpected:
+            print(f"?  {path}")
+        return 1 if unexpected else 0
+
+    for sign, paths in (('+', plan_diff.added), ('-', plan_diff.removed), ('~', plan_diff.changed)):
+        for path in paths:
+            print(f"{sign}  {format_path(path)}")
+    return 1 if any(plan_diff) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""
+Lectura de la estructura de elementos de un archivo DICOM sin parsear valores.
+
+Recorre los encabezados (tag, VR, largo) de los elementos directamente sobre un
+buffer (bytes, mmap o memoryview), saltando los valores. Sirve para ubicar
+posiciones dentro del archivo (dónde insertar un bloque privado, dónde está el
+valor de un atributo) con un costo proporcional a la cantidad de elementos y
+no al tamaño de los valores.
+"""
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+from pydicom.datadict import dictionary_VR
+
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+
+# VRs que en Explicit VR usan 2 bytes reservados + largo de 4 bytes
+LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+Element = namedtuple('Element', 'tag vr header_offset value_offset length end')
+Element.__doc__ = """
+One data element located in a buffer.
+
+Attributes:
+    tag (int): The tag as a 32 bit integer, e.g. 0x300A00B0.
+    vr (str or None): The VR, or None in Implicit VR when it is not known.
+    header_offset (int): Offset of the first byte of the element.
+    value_offset (int): Offset of the first byte of the value.
+    length (int): Length of the value in bytes (resolved for undefined lengths, including the delimiters).
+    end (int): Offset just after the element.
+"""
+
+FileLayout = namedtuple('FileLayout', 'dataset_offset implicit_vr little_endian transfer_syntax')
+
+
+@lru_cache(maxsize=None)
+def _vr_of(tag):
+    """Returns the dictionary VR of a tag, or None for private/unknown tags."""
+    try:
+        return dictionary_VR(tag)
+    except KeyError:
+        return None
+
+
+def read_file_layout(buf):
+    """
+    Finds where the dataset starts and which encoding it uses.
+
+    Args:
+        buf (bytes, mmap or memoryview): The whole file.
+
+    Returns:
+        FileLayout: Offset of the dataset (after preamble and file meta), VR mode, byte order and transfer syntax UID.
+
+    Raises:
+        NotImplementedError: For deflated transfer syntaxes, which can't be walked in place.
+    """
+    offset = 132 if bytes(buf[128:132]) == b'DICM' else 0
+    transfer_syntax = None
+
+    # El file meta (grupo 0002) siempre es Explicit VR Little Endian
+    while offset + 8 <= len(buf) and struct.unpack_from('<H', buf, offset)[0] == 0x0002:
+        element = _read_header(buf, offset, implicit_vr=False, little_endian=True)
+        if element.tag == 0x00020010:
+            transfer_syntax = bytes(buf[element.value_offset:element.end]).rstrip(b'\x00 ').decode('ascii')
+        offset = element.end
+
+    if transfer_syntax is None:
+        # Sin file meta: mismo criterio que pydicom con force=True
+        vr = bytes(buf[offset + 4:offset + 6])
+        implicit_vr = not (vr.isalpha() and vr.isupper())
+        transfer_syntax = IMPLICIT_VR_LITTLE_ENDIAN if implicit_vr else EXPLICIT_VR_LITTLE_ENDIAN
+    if transfer_syntax == DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN:
+        raise NotImplementedError("No se puede recorrer un archivo con sintaxis de transferencia deflated.")
+
+    implicit_vr = transfer_syntax == IMPLICIT_VR_LITTLE_ENDIAN
+    little_endian = transfer_syntax != EXPLICIT_VR_BIG_ENDIAN
+    return FileLayout(offset, implicit_vr, little_endian, transfer_syntax)
+
+
+def _read_header(buf, offset, implicit_vr, little_endian):
+    """Reads the header of the element at `offset`, resolving undefined lengths."""
+    endian = '<' if little_endian else '>'
+    group, elem = struct.unpack_from(endian + 'HH', buf, offset)
+    tag = (group << 16) | elem
+
+    if group == 0xFFFE:
+        # Items y delimitadores: sin VR y largo de 4 bytes en todas las sintaxis
+        vr = None
+        length = struct.unpack_from(endian + 'L', buf, offset + 4)[0]
+        value_offset = offset + 8
+    elif implicit_vr:
+        vr = _vr_of(tag)
+        length = struct.unpack_from(endian + 'L', buf, offset + 4)[0]
+        value_offset = offset + 8
+    else:
+        raw_vr = bytes(buf[offset + 4:offset + 6])
+        vr = raw_vr.decode('ascii', 'replace')
+        if raw_vr in LONG_VRS:
+            length = struct.unpack_from(endian + 'L', buf, offset + 8)[0]
+            value_offset = offset + 12
+        else:
+            length = struct.unpack_from(endian + 'H', buf, offset + 6)[0]
+            value_offset = offset + 8
+
+    if length == UNDEFINED_LENGTH and group != 0xFFFE:
+        end = _skip_undefined(buf, value_offset, implicit_vr, little_endian)
+        return Element(tag, vr or 'SQ', offset, value_offset, end - value_offset, end)
+    if length == UNDEFINED_LENGTH:
+        # Item de largo indefinido: termina en el delimitador de item
+        end = _skip_item(buf, value_offset, implicit_vr, little_endian)
+        return Element(tag, vr, offset, value_offset, end - value_offset, end)
+    if value_offset + length > len(buf):
+        raise ValueError(f"Elemento ({group:04X},{elem:04X}) en {offset} excede el final del archivo.")
+    return Element(tag, vr, offset, value_offset, length, value_offset + length)
+
+
+def _skip_item(buf, offset, implicit_vr, little_endian):
+    """Returns the offset just after the item delimiter of an undefined length item."""
+    while True:
+        element = _read_header(buf, offset, implicit_vr, little_endian)
+        if element.tag == ITEM_DELIMITER:
+            return element.value_offset
+        offset = element.end
+
+
+def _skip_undefined(buf, offset, implicit_vr, little_endian):
+    """Returns the offset just after the sequence delimiter of an undefined length value."""
+    while True:
+        element = _read_header(buf, offset, implicit_vr, little_endian)
+        if element.tag == SEQUENCE_DELIMITER:
+            return element.value_offset
+        offset = element.end
+
+
+def iter_elements(buf, offset, end, implicit_vr=True, little_endian=True):
+    """
+    Yields the elements stored one after the other between `offset` and `end`.
+
+    Only the headers are read: the values, including nested sequences, are skipped.
+
+    Args:
+        buf (bytes, mmap or memoryview): The buffer.
+        offset (int): Offset of the first element.
+        end (int): Offset where the elements end.
+        implicit_vr (bool): Whether the elements are Implicit VR.
+        little_endian (bool): Whether the elements are Little Endian.
+
+    Yields:
+        Element: Each element at this nesting level.
+    """
+    while offset < end:
+        element = _read_header(buf, offset, implicit_vr, little_endian)
+        yield element
+        offset = element.end
+
+
+def find_group_span(buf, layout, group):
+    """
+    Finds where the elements of a (private) group are, or where they would go, at the top level of the dataset.
+
+    Args:
+        buf (bytes, mmap or memoryview): The whole file.
+        layout (FileLayout): As returned by `read_file_layout`.
+        group (int): The group number, e.g. 0x3253.
+
+    Returns:
+        tuple: (start, stop) offsets. The group occupies buf[start:stop]; start == stop if the group is not present.
+    """
+    start = stop = None
+    for element in iter_elements(buf, layout.dataset_offset, len(buf), layout.implicit_vr, layout.little_endian):
+        element_group = element.tag >> 16
+        if start is None and element_group >= group:
+            start = element.header_offset
+        if element_group > group:
+            stop = element.header_offset
+            break
+    if start is None:
+        start = len(buf)
+    if stop is None:
+        stop = len(buf)
+    return start, stop
+
+
+def encode_element(tag, vr, value, implicit_vr=True, little_endian=True):
+    """
+    Encodes one data element with a defined length.
+
+    Args:
+        tag (int): The tag as a 32 bit integer.
+        vr (str): The VR, used only in Explicit VR.
+        value (bytes): The value; padded with a NUL byte to even length.
+        implicit_vr (bool): Whether to encode as Implicit VR.
+        little_endian (bool): Whether to encode as Little Endian.
+
+    Returns:
+        bytes: The encoded element.
+    """
+    endian = '<' if little_endian else '>'
+    if len(value) % 2:
+        value += b'\x00'
+    header = struct.pack(endian + 'HH', tag >> 16, tag & 0xFFFF)
+    if implicit_vr:
+        header += struct.pack(endian + 'L', len(value))
+    elif vr.encode('ascii') in LONG_VRS:
+        header += vr.encode('ascii') + b'\x00\x00' + struct.pack(endian + 'L', len(value))
+    else:
+        header += vr.encode('ascii') + struct.pack(endian + 'H', len(value))
+    return header + value
+
+
+def build_offset_index(buf, layout=None):
+    """
+    Builds an index of the position of every element of the dataset, including those nested in sequences.
+
+    The keys are tag paths: `(tag,)` for top-level elements and `(sequence_tag, item_index, tag, ...)` for nested
+    ones, the same order in which pydicom iterates a Dataset.
+
+    Args:
+        buf (bytes, mmap or memoryview): The whole file.
+        layout (FileLayout, optional): As returned by `read_file_layout`; read from `buf` if not given.
+
+    Returns:
+        dict: Tag path -> Element.
+    """
+    if layout is None:
+        layout = read_file_layout(buf)
+    index = {}
+    _index_elements(buf, layout.dataset_offset, len(buf), (), index, layout.implicit_vr, layout.little_endian)
+    return index
+
+
+def _index_elements(buf, offset, end, prefix, index, implicit_vr, little_endian):
+    for element in iter_elements(buf, offset, end, implicit_vr, little_endian):
+        if element.tag in (ITEM_DELIMITER, SEQUENCE_DELIMITER):
+            break
+        path = prefix + (element.tag,)
+        index[path] = element
+        if element.vr == 'SQ':
+            item_index = 0
+            for item in iter_elements(buf, element.value_offset, element.end, implicit_vr, little_endian):
+                if item.tag != ITEM:
+                    break
+                _index_elements(buf, item.value_offset, item.end, path + (item_index,), index, implicit_vr, little_endian)
+                item_index += 1
+
+
+def find_elements(buf, paths, layout=None):
+    """
+    Locates the elements at some tag paths, reading only the levels those paths go through.
+
+    Unlike `build_offset_index`, the items of a sequence are only walked if a path goes into them, so locating a few
+    attributes of a large plan reads a few hundred headers instead of every element of the file.
+
+    Args:
+        buf (bytes, mmap or memoryview): The whole file.
+        paths (iterable of tuple): Tag paths, as in `build_offset_index`.
+        layout (FileLayout, optional): As returned by `read_file_layout`; read from `buf` if not given.
+
+    Returns:
+        dict: Tag path -> Element, for the paths that exist in the file.
+    """
+    if layout is None:
+        layout = read_file_layout(buf)
+    implicit_vr, little_endian = layout.implicit_vr, layout.little_endian
+    # Prefijo (ruta de un item, () para el nivel superior) -> {tag: Element} de ese nivel
+    levels = {}
+    # Ruta de una secuencia -> sus items
+    items = {}
+
+    def level(prefix, offset, end):
+        elements = levels.get(prefix)
+        if elements is None:
+            elements = levels[prefix] = {}
+            for element in iter_elements(buf, offset, end, implicit_vr, little_endian):
+                if element.tag in (ITEM_DELIMITER, SEQUENCE_DELIMITER):
+                    break
+                elements[element.tag] = element
+        return elements
+
+    found = {}
+    for path in paths:
+        offset, end = layout.dataset_offset, len(buf)
+        element = None
+        for depth in range(0, len(path), 2):
+            element = level(path[:depth], offset, end).get(path[depth])
+            if element is None or depth + 1 == len(path):
+                break
+            sequence = path[:depth + 1]
+            if sequence not in items:
+                items[sequence] = [item for item in iter_elements(buf, element.value_offset, element.end, implicit_vr,
+                                                                  little_endian) if item.tag == ITEM]
+            if path[depth + 1] >= len(items[sequence]):
+                element = None
+                break
+            item = items[sequence][path[depth + 1]]
+            offset, end = item.value_offset, item.end
+        if element is not None:
+            found[path] = element
+    return found
@@ -0,0 +1,446 @@
+"""
+Guardado de planes por parcheo binario de atributos de largo fijo.
+
+La mayoría de las ediciones de modifDICOM cambian unos pocos escalares (ángulos,
+RTImageSID, tabla de tolerancia, identificación del equipo). En lugar de volver
+a serializar todo el Dataset, se compara cada elemento contra una foto tomada al
+leer, se copia el archivo original y se reescriben sólo los bytes de los valores
+que cambiaron, ubicados recorriendo en el archivo sólo los niveles donde están
+(`dcm_index.find_elements`). Si algún valor nuevo no entra en el largo
+codificado original, si cambió la estructura del plan o si cambiaron más de
+MAX_PATCHES valores (ahí reescribir todo es más rápido), se vuelve a la
+escritura completa con pydicom.
+
+Con un `PreparedOutput`, la copia del original (o la escritura completa de un
+plan que cambió de estructura) se hace en un hilo de fondo mientras el usuario
+contesta los diálogos, y `save_plan` sólo tiene que renombrarla y parchearla.
+
+Uso:
+    snapshot = dcm_patch.take_snapshot(info)
+    ... ediciones sobre info ...
+    dcm_patch.save_plan(full_path_file, output_path_file, info, snapshot)
+"""
+import mmap
+import os
+import shutil
+import threading
+
+import pydicom
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
+from pydicom.multival import MultiValue
+
+import dcm_index
+import perf_trace
+
+# VRs de texto que admiten relleno con espacios al final
+TEXT_VRS = frozenset(('AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'LO', 'LT', 'PN', 'SH', 'ST', 'TM', 'UC', 'UT'))
+
+# Marca de los elementos diferidos, que no se leen y se comparan por identidad
+_DEFERRED = object()
+# Marca de los elementos leídos pero todavía sin convertir, que también se comparan por identidad
+_RAW = object()
+
+# Con más valores cambiados que éstos, ubicar y codificar cada uno cuesta más que reescribir todo el plan (ver
+# benchmark.py: p. ej. un corrimiento de gantry en todos los puntos de control)
+MAX_PATCHES = 256
+
+
+class _TooManyChanges(Exception):
+    pass
+
+
+class PlanSnapshot:
+    """
+    The values of every element of a dataset, taken before editing it.
+
+    Elements whose value was deferred (see `modifDICOM.READ_DEFERRED`) are not read: they are compared by identity,
+    so touching them later forces a full write. Elements not yet converted from their raw bytes are not converted
+    either; if they are converted later they count as changed only if their value no longer encodes to the same bytes.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The dataset as read from the source file.
+    """
+
+    def __init__(self, dicom_info):
+        self.dicom_info = dicom_info
+        self.values = _collect(dicom_info)
+
+
+def take_snapshot(dicom_info):
+    """
+    Records the current value of every element of `dicom_info`.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The dataset as read from the source file.
+
+    Returns:
+        PlanSnapshot: The snapshot.
+    """
+    return PlanSnapshot(dicom_info)
+
+
+def _collect(dataset, prefix=()):
+    """
+    Returns tag path -> (element, value) of every element; for sequences the value is the item count.
+
+    Nothing is converted: raw elements (and raw sequences, with everything in them) are recorded as they are.
+    """
+    values = {}
+    for tag in list(dataset.keys()):
+        path = prefix + (int(tag),)
+        elem = dataset.get_item(tag)
+        if isinstance(elem, RawDataElement):
+            # Sin convertir: convertir todo el plan (p. ej. miles de puntos de control) cuesta más que escribirlo
+            values[path] = (elem, _DEFERRED if elem.value is None and elem.length else _RAW)
+        elif elem.VR == 'SQ':
+            values[path] = (elem, len(elem.value))
+            for i, item in enumerate(elem.value):
+                values.update(_collect(item, path + (i,)))
+        else:
+            value = elem.value
+            values[path] = (elem, list(value) if isinstance(value, MultiValue) else value)
+    return values
+
+
+def find_changes(snapshot, dicom_info, limit=None):
+    """
+    Lists the elements that changed since the snapshot.
+
+    Only what was converted from its raw bytes is compared: a sequence converted after the snapshot is compared item
+    by item with its raw bytes, and the elements still raw are unchanged by definition.
+
+    Args:
+        snapshot (PlanSnapshot): Taken before editing.
+        dicom_info (pydicom.dataset.Dataset): The edited dataset.
+        limit (int, optional): Stop comparing, and return None, after finding more changes than this.
+
+    Returns:
+        dict or None: Tag path -> DataElement of the changed elements, or None if the structure changed
+        (another dataset, added/removed elements, different sequence lengths or a deferred element was touched) or
+        there are more than `limit` changes.
+    """
+    if dicom_info is not snapshot.dicom_info:
+        return None
+    changes = _Changes(limit)
+    try:
+        seen = _walk_changes(dicom_info, (), snapshot.values, changes)
+    except _TooManyChanges:
+        return None
+    if seen is None or seen != len(snapshot.values):
+        return None
+    return dict(changes)
+
+
+class _Changes(dict):
+    """Tag path -> changed element, that gives up when it holds more than `limit`."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def __setitem__(self, path, elem):
+        super().__setitem__(path, elem)
+        if self.limit is not None and len(self) > self.limit:
+            raise _TooManyChanges()
+
+
+def _walk_changes(dataset, prefix, old_values, changes):
+    """Adds the changes of `dataset` to `changes`; returns the number of snapshot entries visited, or None."""
+    seen = 0
+    for tag in dataset.keys():
+        path = prefix + (int(tag),)
+        old = old_values.get(path)
+        if old is None:
+            return None
+        seen += 1
+        old_elem, old_value = old
+        elem = dataset.get_item(tag)
+        if old_value is _DEFERRED:
+            if elem is not old_elem:
+                return None
+        elif old_value is _RAW:
+            if elem is old_elem:
+                continue
+            if isinstance(elem, RawDataElement):
+                return None
+            # Se convirtió después de la foto (p. ej. un diálogo sólo lo leyó): se compara con sus bytes crudos
+            buf = old_elem.value
+            if elem.VR == 'SQ':
+                if not _compare_items(elem.value, buf, 0, len(buf), old_elem.is_implicit_VR,
+                                      old_elem.is_little_endian, path, changes):
+                    return None
+            elif not _same_value(elem, buf, old_elem.is_implicit_VR, old_elem.is_little_endian):
+                changes[path] = elem
+        elif isinstance(elem, RawDataElement):
+            return None
+        elif elem.VR == 'SQ':
+            if old_elem.VR != 'SQ' or old_value != len(elem.value):
+                return None
+            for i, item in enumerate(elem.value):
+                item_seen = _walk_changes(item, path + (i,), old_values, changes)
+                if item_seen is None:
+                    return None
+                seen += item_seen
+        else:
+            value = elem.value
+            if elem is not old_elem or (list(value) if isinstance(value, MultiValue) else value) != old_value:
+                changes[path] = elem
+    return seen
+
+
+def _compare_items(sequence, buf, offset, end, implicit_vr, little_endian, path, changes):
+    """Compares the items of a converted sequence with its raw bytes buf[offset:end]; False if the structure changed."""
+    items = [item for item in dcm_index.iter_elements(buf, offset, end, implicit_vr, little_endian)
+             if item.tag == dcm_index.ITEM]
+    if len(items) != len(sequence):
+        return False
+    for i, (item, dataset) in enumerate(zip(items, sequence)):
+        old = {}
+        for element in dcm_index.iter_elements(buf, item.value_offset, item.end, implicit_vr, little_endian):
+            if element.tag == dcm_index.ITEM_DELIMITER:
+                break
+            old[element.tag] = element
+        if len(dataset) != len(old):
+            return False
+        for tag in dataset.keys():
+            element = old.get(int(tag))
+            if element is None:
+                return False
+            elem = dataset.get_item(tag)
+            if isinstance(elem, RawDataElement):
+                # Nunca se convirtió: son los mismos bytes
+                continue
+            if elem.VR == 'SQ':
+                if not _compare_items(elem.value, buf, element.value_offset, element.end, implicit_vr, little_endian,
+                                      path + (i, int(tag)), changes):
+                    return False
+            elif not _same_value(elem, buf[element.value_offset:element.end], implicit_vr, little_endian):
+                changes[path + (i, int(tag))] = elem
+    return True
+
+
+def _same_value(elem, old, implicit_vr, little_endian):
+    """Whether `elem` encodes to the value bytes `old` (from the source file), ignoring the padding."""
+    value = value_bytes(elem, implicit_vr, little_endian)
+    old = bytes(old or b'')
+    if elem.VR in TEXT_VRS or elem.VR == 'UI':
+        return value.rstrip(b' \x00') == old.rstrip(b' \x00')
+    return value == old
+
+
+def _compact_ds(value):
+    """Returns the shortest decimal string that represents `value` exactly."""
+    original = getattr(value, 'original_string', None)
+    number = float(value)
+    text = repr(int(number)) if number.is_integer() else repr(number)
+    if original is not None and len(original.strip()) <= len(text):
+        return original.strip()
+    return text if len(text) <= 16 else format(number, '.10g')
+
+
+def value_bytes(elem, implicit_vr=True, little_endian=True):
+    """
+    Encodes the value of `elem` exactly as a full write would, without the element header.
+
+    Args:
+        elem (pydicom.dataelem.DataElement): The element.
+        implicit_vr (bool): Whether to encode as Implicit VR.
+        little_endian (bool): Whether to encode as Little Endian.
+
+    Returns:
+        bytes: The value bytes, including the padding to even length.
+    """
+    fp = DicomBytesIO()
+    fp.is_little_endian = little_endian
+    fp.is_implicit_VR = implicit_vr
+    write_data_element(fp, elem)
+    encoded = fp.getvalue()
+    header = dcm_index._read_header(encoded, 0, implicit_vr, little_endian)
+    return encoded[header.value_offset:header.end]
+
+
+def encode_value(elem, slot_length, implicit_vr=True, little_endian=True):
+    """
+    Encodes the value of `elem` exactly as a full write would, padded to fill an existing slot.
+
+    Args:
+        elem (pydicom.dataelem.DataElement): The element with its new value.
+        slot_length (int): The length of the value in the source file.
+        implicit_vr (bool): Whether the source file is Implicit VR.
+        little_endian (bool): Whether the source file is Little Endian.
+
+    Returns:
+        bytes or None: The value bytes of length `slot_length`, or None if they don't fit.
+    """
+    if elem.VR == 'DS' and not elem.VM > 1 and elem.value is not None and elem.value != '':
+        # La forma más corta del número (p. ej. '90' en vez de '90.0') entra en más lugares
+        elem = DataElement(elem.tag, 'DS', _compact_ds(elem.value))
+
+    value = value_bytes(elem, implicit_vr, little_endian)
+    if len(value) == slot_length:
+        return value
+    if len(value) > slot_length:
+        return None
+    if elem.VR in TEXT_VRS:
+        return value.rstrip(b' \x00') + b' ' * (slot_length - len(value.rstrip(b' \x00')))
+    if elem.VR == 'UI' and slot_length - len(value.rstrip(b'\x00')) == 1:
+        return value.rstrip(b'\x00') + b'\x00'
+    return None
+
+
+def plan_patches(source_path, changes):
+    """
+    Locates and encodes the changed attributes in the source file.
+
+    Args:
+        source_path (str): The file the snapshot was read from.
+        changes (dict): As returned by `find_changes`.
+
+    Returns:
+        list or None: (offset, bytes) pairs, or None if some value does not fit its slot.
+    """
+    if not changes:
+        return []
+    with open(source_path, 'rb') as source:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            layout = dcm_index.read_file_layout(buf)
+            index = dcm_index.find_elements(buf, changes, layout)
+
+    patches = []
+    for path, elem in changes.items():
+        located = index.get(path)
+        if located is None:
+            return None
+        value = encode_value(elem, located.length, layout.implicit_vr, layout.little_endian)
+        if value is None:
+            return None
+        patches.append((located.value_offset, value))
+    return patches
+
+
+class PreparedOutput:
+    """
+    A file next to the output, written on a background thread, that `save_plan` renames and patches.
+
+    Use `copy_of` when the plan keeps the structure of its source file (the usual case) and `written_from` after a
+    structural change (e.g. `change_machine`): the plan is serialized once in the background and the later edits are
+    patched over that file.
+
+    Args:
+        output_path (str): Final path of the plan.
+        snapshot (PlanSnapshot): Snapshot that matches the contents of the prepared file.
+        write (callable): Called with the temporary path, on the background thread.
+
+    Attributes:
+        path (str): The temporary file.
+        snapshot (PlanSnapshot): See Args.
+    """
+
+    def __init__(self, output_path, snapshot, write):
+        self.path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.snapshot = snapshot
+        self._write = write
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='preparar_salida', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def copy_of(cls, source_path, output_path, snapshot):
+        """
+        Starts copying the source file of a plan.
+
+        Args:
+            source_path (str): The file the plan was read from.
+            output_path (str): Final path of the plan.
+            snapshot (PlanSnapshot): Taken right after reading `source_path`.
+
+        Returns:
+            PreparedOutput: The copy in progress.
+        """
+        return cls(output_path, snapshot, lambda path: shutil.copyfile(source_path, path))
+
+    @classmethod
+    def written_from(cls, dicom_info, output_path):
+        """
+        Takes a snapshot of `dicom_info` and starts writing it in full.
+
+        `dicom_info` must not be edited until `wait` returns.
+
+        Args:
+            dicom_info (pydicom.dataset.FileDataset): The plan, as it is now.
+            output_path (str): Final path of the plan.
+
+        Returns:
+            PreparedOutput: The write in progress.
+        """
+        snapshot = take_snapshot(dicom_info)
+        return cls(output_path, snapshot, lambda path: pydicom.dcmwrite(path, dicom_info, enforce_file_format=False))
+
+    def _run(self):
+        with perf_trace.span('preparar_salida', path=self.path):
+            try:
+                self._write(self.path)
+            except Exception as error:
+                self._error = error
+
+    def wait(self):
+        """
+        Waits for the background write.
+
+        Returns:
+            bool: Whether the prepared file is ready. If the write failed the file is removed.
+        """
+        self._thread.join()
+        if self._error is not None:
+            self.discard()
+        return self._error is None
+
+    def discard(self):
+        """Removes the prepared file, if any."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+@perf_trace.traced()
+def save_plan(source_path, output_path, dicom_info, snapshot=None, prepared=None):
+    """
+    Saves an edited plan, patching a copy of the source file in place when possible.
+
+    Args:
+        source_path (str): The file `dicom_info` was read from.
+        output_path (str): Where to save the plan.
+        dicom_info (pydicom.dataset.FileDataset): The edited plan.
+        snapshot (PlanSnapshot, optional): Taken right after reading `source_path`. Without it the plan is written in full.
+        prepared (PreparedOutput, optional): File prepared in the background. If it is ready, it replaces the copy of
+            `source_path` and its snapshot replaces `snapshot`.
+
+    Returns:
+        str: 'patched' if only the changed bytes were rewritten, 'full' if the dataset was serialized again.
+    """
+    if prepared is not None and prepared.wait():
+        source_path, snapshot = prepared.path, prepared.snapshot
+    else:
+        prepared = None
+    changes = find_changes(snapshot, dicom_info, MAX_PATCHES) if snapshot is not None else None
+    patches = plan_patches(source_path, changes) if changes is not None else None
+    if patches is None:
+        pydicom.dcmwrite(output_path, dicom_info, enforce_file_format=False)
+        perf_trace.annotate(mode='full', bytes_written=os.path.getsize(output_path))
+        if prepared is not None:
+            prepared.discard()
+        return 'full'
+
+    if prepared is not None:
+        os.replace(prepared.path, output_path)
+    else:
+        shutil.copyfile(source_path, output_path)
+    with open(output_path, 'r+b') as output:
+        for offset, value in patches:
+            output.seek(offset)
+            output.write(value)
+    perf_trace.annotate(mode='patched', bytes_written=sum(len(value) for _, value in patches))
+    return 'patched'
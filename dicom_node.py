@@ -0,0 +1,452 @@
+"""
+Nodo DICOM (C-STORE) para recibir planes y placas CR y reenviar los resultados.
+
+`StoreSCP` recibe planes RT e imágenes CR por red, los guarda tal como llegan
+(sin decodificarlos) y los pasa a un pool de procesos: los planes con las
+reglas de `batch_modifDICOM` y las placas CR con `pf_watch.convert_file`. Si se
+indica un nodo de destino, cada salida se reenvía con `StoreSCU`, que mantiene
+abierta una misma asociación para todo el lote en lugar de abrir una por
+archivo; la asociación se libera si pasa un rato sin nada que enviar y se
+vuelve a abrir sola con el próximo archivo. Los archivos se envían desde el
+disco sin decodificarlos ni volver a codificarlos, así el tiempo de un lote
+depende de los bytes y no del armado de asociaciones ni de pydicom.
+
+Necesita pynetdicom (pip install pynetdicom), que no hace falta para el resto
+del programa. Los nodos se escriben AE@host:puerto.
+
+Uso:
+    python dicom_node.py listen --port 11112 --rules reglas.json --sid 153 --forward QATRACK@10.0.0.5:104
+    python dicom_node.py listen --port 11113 --store-only --dir recibidos   (nodo de prueba)
+    python dicom_node.py send ARIA@10.0.0.5:104 salida/*_mod.dcm
+    python dicom_node.py echo ARIA@10.0.0.5:104
+"""
+import argparse
+import glob
+import os
+import queue
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pf_watch
+
+DEFAULT_AE_TITLE = 'MODIFDCM'
+DEFAULT_PORT = 11112
+# Segundos sin nada que reenviar antes de liberar la asociación
+IDLE_RELEASE = 30
+
+VERIFICATION = '1.2.840.10008.1.1'
+RT_PLAN_STORAGE = '1.2.840.10008.5.1.4.1.1.481.5'
+RT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.481.1'
+CR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.1'
+DX_IMAGE_STORAGE_PRESENTATION = '1.2.840.10008.5.1.4.1.1.1.1'
+DX_IMAGE_STORAGE_PROCESSING = '1.2.840.10008.5.1.4.1.1.1.1.1'
+SOP_CLASSES = (RT_PLAN_STORAGE, RT_IMAGE_STORAGE, CR_IMAGE_STORAGE, DX_IMAGE_STORAGE_PRESENTATION, DX_IMAGE_STORAGE_PROCESSING)
+# Placas del lector CR, que van a pf_con_chasisMOD
+CR_SOP_CLASSES = (CR_IMAGE_STORAGE, DX_IMAGE_STORAGE_PRESENTATION, DX_IMAGE_STORAGE_PROCESSING)
+TRANSFER_SYNTAXES = (
+    '1.2.840.10008.1.2',       # Implicit VR Little Endian
+    '1.2.840.10008.1.2.1',     # Explicit VR Little Endian
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+    '1.2.840.10008.1.2.5',     # RLE Lossless
+)
+
+Node = namedtuple('Node', 'ae_title host port')
+Node.__doc__ = """
+A remote DICOM node.
+
+Attributes:
+    ae_title (str): Its AE title.
+    host (str): Host name or IP address.
+    port (int): TCP port.
+"""
+
+
+def parse_node(text):
+    """
+    Parses a node written as AE@host:port.
+
+    Args:
+        text (str): E.g. 'ARIA@10.0.0.5:104'.
+
+    Returns:
+        Node: The node.
+
+    Raises:
+        ValueError: If `text` is not AE@host:port.
+    """
+    try:
+        ae_title, address = text.split('@', 1)
+        host, port = address.rsplit(':', 1)
+        return Node(ae_title, host, int(port))
+    except ValueError:
+        raise ValueError(f"Nodo inválido {text!r}: se espera AE@host:puerto") from None
+
+
+def _pynetdicom():
+    """Imports pynetdicom, which is only needed for networking."""
+    try:
+        import pynetdicom
+    except ImportError as error:
+        raise ImportError("El nodo DICOM necesita pynetdicom: pip install pynetdicom") from error
+    return pynetdicom
+
+
+def _new_ae(ae_title):
+    pynetdicom = _pynetdicom()
+    # Enviar los archivos desde el disco tal como están: si no, pynetdicom los lee con dcmread y los vuelve a
+    # codificar, que en un plan de muchos puntos de control tarda mucho más que mandar los bytes
+    pynetdicom._config.STORE_SEND_CHUNKED_DATASET = True
+    return pynetdicom.AE(ae_title=ae_title)
+
+
+class StoreSCU:
+    """
+    Sends files to a remote node over one association, reused for every file.
+
+    The association is opened with the first file and again after `release` or if the remote node closed it.
+    One context is proposed per SOP class and transfer syntax, so files are sent as they are on disk.
+
+    Args:
+        node (Node): The destination.
+        ae_title (str): Our AE title.
+    """
+
+    def __init__(self, node, ae_title=DEFAULT_AE_TITLE):
+        self.node = node
+        self.ae = _new_ae(ae_title)
+        for sop_class in SOP_CLASSES:
+            for transfer_syntax in TRANSFER_SYNTAXES:
+                self.ae.add_requested_context(sop_class, transfer_syntax)
+        self._association = None
+        self.associations_opened = 0
+
+    def _associate(self):
+        if self._association is None or not self._association.is_established:
+            association = self.ae.associate(self.node.host, self.node.port, ae_title=self.node.ae_title)
+            if not association.is_established:
+                raise ConnectionError(f"No se pudo asociar con {self.node.ae_title}@{self.node.host}:{self.node.port}")
+            self._association = association
+            self.associations_opened += 1
+        return self._association
+
+    def send(self, path):
+        """
+        Sends one file. Never raises: errors are reported in the result.
+
+        Args:
+            path (str): The DICOM file. It is sent without decoding it.
+
+        Returns:
+            dict: 'file', 'status' ('ok' or 'error'), 'error' and 'seconds'.
+        """
+        start = time.perf_counter()
+        result = {'file': path, 'status': 'ok', 'error': None}
+        try:
+            status = None
+            for attempt in range(2):
+                association = self._associate()
+                status = association.send_c_store(path)
+                if status or association.is_established:
+                    break
+                # El otro nodo cerró una asociación que teníamos abierta: se abre otra y se reintenta una vez
+                self._association = None
+            code = getattr(status, 'Status', None)
+            if code is None:
+                raise ConnectionError("Sin respuesta al C-STORE")
+            if code != 0x0000:
+                raise RuntimeError(f"C-STORE rechazado con estado 0x{code:04X}")
+        except Exception as error:
+            result['status'] = 'error'
+            result['error'] = f"{type(error).__name__}: {error}"
+        result['seconds'] = round(time.perf_counter() - start, 4)
+        return result
+
+    def send_files(self, paths, progress=None):
+        """
+        Sends several files over the same association.
+
+        Args:
+            paths (list of str): The DICOM files.
+            progress (callable, optional): Called with each result.
+
+        Returns:
+            list of dict: One result per file, see `send`.
+        """
+        results = []
+        for path in paths:
+            result = self.send(path)
+            results.append(result)
+            if progress is not None:
+                progress(result)
+        return results
+
+    def release(self):
+        """Releases the association, if open. The next `send` opens another one."""
+        if self._association is not None and self._association.is_established:
+            self._association.release()
+        self._association = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def echo(node, ae_title=DEFAULT_AE_TITLE):
+    """
+    Checks that a node answers a C-ECHO.
+
+    Args:
+        node (Node): The remote node.
+        ae_title (str): Our AE title.
+
+    Returns:
+        bool: Whether the node answered with success.
+    """
+    ae = _new_ae(ae_title)
+    ae.add_requested_context(VERIFICATION)
+    association = ae.associate(node.host, node.port, ae_title=node.ae_title)
+    if not association.is_established:
+        return False
+    status = association.send_c_echo()
+    association.release()
+    return bool(status) and status.Status == 0x0000
+
+
+def _process_received(path, sop_class, rules, sid_mm, output_dir, bin_factor, compression=None):
+    """Runs the pipeline of one received file in a worker process. Never raises."""
+    if sop_class == RT_PLAN_STORAGE:
+        import batch_modifDICOM
+        return batch_modifDICOM.process_plan(path, rules)
+    return pf_watch.convert_file(path, sid_mm, output_dir, bin_factor, compression)
+
+
+class StoreSCP:
+    """
+    Receives plans and CR images, converts them and optionally forwards the outputs.
+
+    Received files are written as they arrive, without decoding them, to `storage_dir` (named by SOP Instance UID)
+    and the C-STORE is answered right away; the conversions run on a process pool. An instance received again while
+    the previous copy is still being converted is written as <UID>-2.dcm (-3...), so the conversion in progress
+    keeps its source and both outputs have their own names. RT Images, and every file in store-only mode, are just
+    stored.
+
+    Args:
+        storage_dir (str): Where received files are written.
+        ae_title (str): Our AE title.
+        port (int): TCP port to listen on.
+        rules (dict, optional): `batch_modifDICOM` rules for the plans. Without rules plans are only stored.
+        sid_cm (float, optional): CR plate distance for the CR images. Without it CR images are only stored.
+        output_dir (str, optional): Directory of the CR outputs. Defaults to `storage_dir`.
+        bin_factor (int): Binning factor of the CR outputs.
+        compression (str, optional): 'rle' or 'deflated' to write the CR outputs losslessly compressed.
+        forward (Node, optional): Node that receives the outputs.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        progress (callable, optional): Called with each result (received, converted or forwarded).
+    """
+
+    def __init__(self, storage_dir, ae_title=DEFAULT_AE_TITLE, port=DEFAULT_PORT, rules=None, sid_cm=None, output_dir=None,
+                 bin_factor=2, compression=None, forward=None, max_workers=None, progress=None):
+        self.storage_dir = os.path.abspath(storage_dir)
+        self.port = port
+        self.rules = rules
+        self.sid_mm = float(sid_cm) * 10 if sid_cm is not None else None
+        self.output_dir = os.path.abspath(output_dir) if output_dir else self.storage_dir
+        self.bin_factor = bin_factor
+        self.compression = compression
+        self.forward = forward
+        self.max_workers = max_workers
+        self.progress = progress
+        self.ae = _new_ae(ae_title)
+        for sop_class in SOP_CLASSES:
+            self.ae.add_supported_context(sop_class, TRANSFER_SYNTAXES)
+        self.ae.add_supported_context(VERIFICATION)
+        self._pool = None
+        self._server = None
+        # Archivos recibidos que todavía se están convirtiendo: no se pisan con otra copia de la misma instancia
+        self._processing = set()
+        self._processing_lock = threading.Lock()
+        self._outbox = queue.Queue()
+        self._forwarder = None
+
+    def _report(self, result):
+        if self.progress is not None:
+            self.progress(result)
+
+    def _on_store(self, event):
+        start = time.perf_counter()
+        sop_class = event.request.AffectedSOPClassUID
+        process = sop_class == RT_PLAN_STORAGE and self.rules is not None or sop_class in CR_SOP_CLASSES and self.sid_mm is not None
+        path = self._received_path(event.request.AffectedSOPInstanceUID, process)
+        try:
+            temporary = path + '.tmp'
+            with open(temporary, 'wb') as received_file:
+                received_file.write(event.encoded_dataset())
+            os.replace(temporary, path)
+        except OSError as error:
+            self._done_processing(path)
+            self._report({'file': path, 'status': 'error', 'error': f"{type(error).__name__}: {error}", 'stage': 'recepcion'})
+            return 0xA700  # Sin recursos
+        self._report({'file': path, 'status': 'ok', 'error': None, 'stage': 'recepcion',
+                      'seconds': round(time.perf_counter() - start, 4)})
+
+        if process:
+            future = self._pool.submit(_process_received, path, sop_class, self.rules, self.sid_mm, self.output_dir, self.bin_factor,
+                                       self.compression)
+            future.add_done_callback(lambda future: self._on_processed(future, path))
+        return 0x0000
+
+    def _received_path(self, sop_instance_uid, process):
+        """Returns where to write a received instance, avoiding the files still being converted."""
+        with self._processing_lock:
+            path = os.path.join(self.storage_dir, f"{sop_instance_uid}.dcm")
+            copy = 1
+            while path in self._processing:
+                copy += 1
+                path = os.path.join(self.storage_dir, f"{sop_instance_uid}-{copy}.dcm")
+            if process:
+                self._processing.add(path)
+        return path
+
+    def _done_processing(self, path):
+        with self._processing_lock:
+            self._processing.discard(path)
+
+    def _on_processed(self, future, path):
+        self._done_processing(path)
+        try:
+            result = future.result()
+        except Exception as error:
+            # Proceso del pool caído (p. ej. sin memoria)
+            result = {'file': path, 'output': None, 'status': 'error', 'error': f"{type(error).__name__}: {error}"}
+        result['stage'] = 'conversion'
+        self._report(result)
+        if result['status'] == 'ok' and self.forward is not None:
+            outputs = result['output'] if isinstance(result['output'], list) else [result['output']]
+            for output in outputs:
+                self._outbox.put(output)
+
+    def _forward_loop(self):
+        with StoreSCU(self.forward, self.ae.ae_title) as scu:
+            while True:
+                try:
+                    path = self._outbox.get(timeout=IDLE_RELEASE)
+                except queue.Empty:
+                    scu.release()
+                    continue
+                if path is None:
+                    return
+                result = scu.send(path)
+                result['stage'] = 'reenvio'
+                self._report(result)
+
+    def start(self):
+        """Starts listening in the background."""
+        pynetdicom = _pynetdicom()
+        os.makedirs(self.storage_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.rules and self.rules.get('output_dir'):
+            os.makedirs(self.rules['output_dir'], exist_ok=True)
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        if self.forward is not None:
+            self._forwarder = threading.Thread(target=self._forward_loop, daemon=True)
+            self._forwarder.start()
+        self._server = self.ae.start_server(('', self.port), block=False,
+                                            evt_handlers=[(pynetdicom.evt.EVT_C_STORE, self._on_store)])
+
+    def stop(self):
+        """Stops listening, waits for the pending conversions and forwards, and releases the forward association."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._forwarder is not None:
+            self._outbox.put(None)
+            self._forwarder.join()
+            self._forwarder = None
+
+    def serve_forever(self):
+        """Listens until Ctrl+C."""
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def _print_result(result):
+    stage = result.get('stage', 'envio')
+    if result['status'] == 'ok':
+        output = result.get('output')
+        outputs = output if isinstance(output, list) else [output] if output else []
+        arrow = f" -> {', '.join(outputs)}" if outputs else ''
+        print(f"OK     {stage:<10} {result['file']}{arrow} ({result.get('seconds')} s)", flush=True)
+    else:
+        print(f"ERROR  {stage:<10} {result['file']}: {result['error']}", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nodo DICOM para recibir, convertir y reenviar planes y placas CR.")
+    parser.add_argument('--ae', default=DEFAULT_AE_TITLE, help="AE title propio")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    listen = subparsers.add_parser('listen', help="Recibir por C-STORE y convertir")
+    listen.add_argument('--port', type=int, default=DEFAULT_PORT, help="Puerto TCP")
+    listen.add_argument('--dir', default='recibidos', help="Directorio donde se guardan los archivos recibidos")
+    listen.add_argument('--rules', help="Reglas de batch_modifDICOM para los planes (sin reglas, los planes sólo se guardan)")
+    listen.add_argument('--sid', type=float, default=pf_watch.DEFAULT_SID_CM, help="Distancia de la placa CR en cm")
+    listen.add_argument('--output-dir', help="Directorio de salida de las placas CR (por defecto, --dir)")
+    listen.add_argument('--compression', choices=('rle', 'deflated'), help="Comprimir sin pérdida las placas CR convertidas")
+    listen.add_argument('--forward', type=parse_node, help="Nodo AE@host:puerto al que se reenvían las salidas")
+    listen.add_argument('--store-only', action='store_true', help="Sólo guardar lo recibido (nodo de prueba)")
+    listen.add_argument('-j', '--jobs', type=int, default=None, help="Cantidad de procesos (por defecto, uno por núcleo)")
+    send = subparsers.add_parser('send', help="Enviar archivos por C-STORE en una sola asociación")
+    send.add_argument('node', type=parse_node, help="Nodo AE@host:puerto")
+    send.add_argument('files', nargs='+', help="Archivos o patrones glob")
+    ping = subparsers.add_parser('echo', help="Verificar un nodo con C-ECHO")
+    ping.add_argument('node', type=parse_node, help="Nodo AE@host:puerto")
+    args = parser.parse_args(argv)
+
+    try:
+        _pynetdicom()
+    except ImportError as error:
+        print(error, file=sys.stderr)
+        return 2
+
+    if args.command == 'echo':
+        ok = echo(args.node, args.ae)
+        print("OK" if ok else f"Sin respuesta de {args.node.ae_title}@{args.node.host}:{args.node.port}")
+        return 0 if ok else 1
+
+    if args.command == 'send':
+        paths = sorted({path for pattern in args.files for path in glob.glob(pattern)})
+        start = time.perf_counter()
+        with StoreSCU(args.node, args.ae) as scu:
+            results = scu.send_files(paths, progress=_print_result)
+        n_errors = sum(result['status'] != 'ok' for result in results)
+        print(f"{len(results) - n_errors} enviados, {n_errors} con error, {scu.associations_opened} asociación(es), "
+              f"{time.perf_counter() - start:.2f} s.")
+        return 1 if n_errors else 0
+
+    rules = None
+    if args.rules and not args.store_only:
+        import batch_modifDICOM
+        rules = batch_modifDICOM.load_rules(args.rules)
+    scp = StoreSCP(args.dir, args.ae, args.port, rules=rules, sid_cm=None if args.store_only else args.sid,
+                   output_dir=args.output_dir, compression=args.compression, forward=None if args.store_only else args.forward,
+                   max_workers=args.jobs, progress=_print_result)
+    print(f"Escuchando como {args.ae} en el puerto {args.port} (Ctrl+C para terminar)", flush=True)
+    scp.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Generación del anexo ExtendedIF (XML ExtendedVAPlanInterface de Varian) a partir del plan.
+
+`add_private_fields` pegaba siempre el mismo anexo (`anexo_XML.txt`), con la
+tabla de tolerancia 3, sin campos y con límites de dosis fijos, leyéndolo del
+disco en cada llamada. Acá el XML se arma con lo que tiene el plan:
+
+* una <ToleranceTable> por cada ítem de ToleranceTableSequence, con la
+  configuración de setup (Remote/Manual) de cada eje;
+* una <DoseReference> por cada ítem de DoseReferenceSequence con dosis
+  prescripta (como hace Eclipse: un punto de referencia sin dosis no lleva
+  límites), con los límites de dosis diario y por sesión;
+* un <Beam> por campo de BeamSequence (FieldOrder = orden en la secuencia), sólo
+  si se configura una extensión por campo. Si no, <Beams> queda vacío, como en
+  el anexo fijo.
+
+Los fragmentos se arman con plantillas de formato que se componen una sola vez
+y se cachean (`functools.lru_cache`), lo mismo que el documento entero por
+combinación de números de tabla, dosis y campos: en un batch de planes
+parecidos el XML sale del caché sin E/S ni armado de cadenas.
+
+La configuración puede venir de la entrada "extended_if" de un equipo en
+`maquinas.json`:
+
+    "extended_if": {
+        "dose_limit": 2.0,
+        "setup": {"PatientSupportAngleSetup": "Remote"},
+        "beam_extension": {"GantryRtnExtendedStart": false, "GantryRtnExtendedStop": false}
+    }
+"""
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+# Límite de dosis (Gy) diario y por sesión del anexo fijo
+DEFAULT_DOSE_LIMIT = 2.0
+# Atributos de un DoseReference con dosis prescripta
+PRESCRIPTION_KEYWORDS = ('DeliveryMaximumDose', 'TargetPrescriptionDose')
+# Setup de cada eje en las tablas de tolerancia, en el orden del anexo fijo
+DEFAULT_SETUP = (
+    ('GantryRtnSetup', 'Remote'),
+    ('CollRtnSetup', 'Remote'),
+    ('CollXSetup', 'Remote'),
+    ('CollYSetup', 'Remote'),
+    ('PatientSupportAngleSetup', 'Manual'),
+    ('CouchLngSetup', 'Manual'),
+    ('CouchVrtSetup', 'Manual'),
+    ('CouchLatSetup', 'Manual'),
+)
+# Como en los planes que exporta Eclipse (ver PlanBase_*_QA.dcm)
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\r\n'
+
+_DOCUMENT = ('<ExtendedVAPlanInterface Version="1"><Beams>{beams}</Beams><ToleranceTables>{tolerance_tables}'
+             '</ToleranceTables><DoseReferences>{dose_references}</DoseReferences></ExtendedVAPlanInterface>')
+_TOLERANCE_TABLE = ('<ToleranceTable><ReferencedToleranceTableNumber>{number}</ReferencedToleranceTableNumber>'
+                    '<ToleranceTableExtension>{extension}</ToleranceTableExtension></ToleranceTable>')
+_DOSE_REFERENCE = ('<DoseReference><ReferencedDoseReferenceNumber>{number}</ReferencedDoseReferenceNumber>'
+                   '<DoseReferenceExtension><DailyDoseLimit>{limit:.6f}</DailyDoseLimit>'
+                   '<SessionDoseLimit>{limit:.6f}</SessionDoseLimit></DoseReferenceExtension></DoseReference>')
+_BEAM = ('<Beam><ReferencedBeamNumber>{number}</ReferencedBeamNumber><BeamExtension><FieldOrder>{order}</FieldOrder>'
+         '{extension}</BeamExtension></Beam>')
+
+
+def _text(value):
+    # Los booleanos del JSON van como en el XML de Eclipse: true/false
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return escape(str(value))
+
+
+@lru_cache(maxsize=None)
+def _elements(items):
+    """Compiles (name, value) pairs into the XML elements <name>value</name>."""
+    return ''.join(f'<{name}>{_text(value)}</{name}>' for name, value in items)
+
+
+@lru_cache(maxsize=None)
+def _tolerance_table(number, setup):
+    return _TOLERANCE_TABLE.format(number=number, extension=_elements(setup))
+
+
+@lru_cache(maxsize=None)
+def _dose_reference(number, limit):
+    return _DOSE_REFERENCE.format(number=number, limit=limit)
+
+
+@lru_cache(maxsize=None)
+def _beam(number, order, extension):
+    return _BEAM.format(number=number, order=order, extension=_elements(extension))
+
+
+@lru_cache(maxsize=256)
+def _document(tolerance_numbers, dose_numbers, beam_numbers, setup, dose_limit, beam_extension):
+    beams = ''
+    if beam_extension is not None:
+        beams = ''.join(_beam(number, order, beam_extension) for order, number in enumerate(beam_numbers, 1))
+    xml = _DOCUMENT.format(
+        beams=beams,
+        tolerance_tables=''.join(_tolerance_table(number, setup) for number in tolerance_numbers),
+        dose_references=''.join(_dose_reference(number, dose_limit) for number in dose_numbers),
+    )
+    return (XML_DECLARATION + xml).encode('utf-8')
+
+
+def _numbers(dicom_info, sequence, keyword, required=()):
+    """Returns the `keyword` numbers of the items of a sequence that have it and any of the `required` attributes."""
+    return tuple(int(item.get(keyword)) for item in dicom_info.get(sequence) or ()
+                 if item.get(keyword) is not None and (not required or any(name in item for name in required)))
+
+
+def _merge(defaults, overrides):
+    """Returns `defaults` (name, value) pairs with the values of `overrides` replaced or appended, as a tuple."""
+    merged = dict(defaults)
+    merged.update(overrides or {})
+    return tuple(merged.items())
+
+
+def build_xml(dicom_info, setup=None, dose_limit=None, beam_extension=None):
+    """
+    Builds the ExtendedVAPlanInterface XML of a plan.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The plan. Only ToleranceTableSequence, DoseReferenceSequence and
+            BeamSequence are read.
+        setup (dict, optional): Setup of each axis of the tolerance tables, over DEFAULT_SETUP.
+        dose_limit (float, optional): Daily and session dose limit in Gy. Defaults to DEFAULT_DOSE_LIMIT.
+        beam_extension (dict, optional): Elements of the extension of every beam, after FieldOrder. Without it the
+            <Beams> section is left empty.
+
+    Returns:
+        bytes: The XML, UTF-8 encoded.
+    """
+    return _document(
+        _numbers(dicom_info, 'ToleranceTableSequence', 'ToleranceTableNumber'),
+        _numbers(dicom_info, 'DoseReferenceSequence', 'DoseReferenceNumber', PRESCRIPTION_KEYWORDS),
+        _numbers(dicom_info, 'BeamSequence', 'BeamNumber'),
+        _merge(DEFAULT_SETUP, setup),
+        float(DEFAULT_DOSE_LIMIT if dose_limit is None else dose_limit),
+        None if beam_extension is None else tuple(beam_extension.items()),
+    )
+
+
+def build_xml_for_machine(dicom_info, profile=None):
+    """
+    Builds the XML of a plan with the "extended_if" configuration of its machine.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The plan.
+        profile (machine_registry.MachineProfile, optional): The machine. Defaults to the one of the first beam's
+            TreatmentMachineName, if it is in the registry.
+
+    Returns:
+        bytes: The XML, see `build_xml`.
+    """
+    if profile is None:
+        import machine_registry
+        beams = dicom_info.get('BeamSequence') or ()
+        if beams and beams[0].get('TreatmentMachineName'):
+            profile = machine_registry.get_registry().find(str(beams[0].TreatmentMachineName))
+    config = profile.extended_if if profile is not None else {}
+    return build_xml(dicom_info, **config)
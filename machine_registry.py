@@ -0,0 +1,180 @@
+"""
+Registro de equipos (aceleradores) leído de un archivo de configuración.
+
+Cada equipo de `maquinas.json` define su identificación (fabricante, modelo,
+número de serie, nombre de máquina), el plan base que usa `change_machine`, el
+paciente de QA, la tabla de tolerancia por defecto y los rangos de ángulos
+permitidos y, opcionalmente, la configuración del anexo ExtendedIF
+("extended_if", ver `extended_if`). Agregar un equipo es agregar una entrada al
+archivo.
+
+Al cargarse, cada perfil se compila una sola vez en la lista de elementos que
+hay que escribir en cada campo; aplicarlo es una única pasada por BeamSequence.
+El registro se cachea por ruta + mtime, así un batch lo lee una sola vez.
+"""
+import json
+import os
+import threading
+
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+
+REGISTRY_PATH = os.environ.get('MODIFDCM_MACHINES') or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'maquinas.json')
+
+# Campo del perfil -> atributo de cada Beam
+BEAM_ATTRIBUTES = (
+    ('manufacturer', 'Manufacturer'),
+    ('institution', 'InstitutionName'),
+    ('model', 'ManufacturerModelName'),
+    ('serial', 'DeviceSerialNumber'),
+    ('machine_name', 'TreatmentMachineName'),
+)
+# Claves de "extended_if" (argumentos de extended_if.build_xml)
+EXTENDED_IF_KEYS = ('setup', 'dose_limit', 'beam_extension')
+
+
+class MachineProfile:
+    """
+    One treatment machine, with its beam attributes compiled into a reusable patch.
+
+    Args:
+        config (dict): The machine entry of the registry file.
+
+    Attributes:
+        label (str): Name shown in the UI, e.g. "Equipo 1 (QBA_600CD_523)".
+        machine_name (str): TreatmentMachineName, e.g. "QBA_600CD_523".
+        template (str): Path of the template plan.
+        patient_name (str): PatientName of the converted plans.
+        patient_id (str): PatientID of the converted plans.
+        tolerance_table (str or None): Default tolerance table label.
+        gantry_ranges (tuple): Allowed gantry angle ranges, as (min, max) pairs.
+        collimator_ranges (tuple): Allowed collimator angle ranges, as (min, max) pairs.
+        extended_if (dict): Arguments of `extended_if.build_xml` for the plans of this machine.
+
+    Raises:
+        ValueError: If "extended_if" has unknown keys.
+    """
+
+    def __init__(self, config):
+        self.label = config['label']
+        self.manufacturer = config['manufacturer']
+        self.institution = config['institution']
+        self.model = config['model']
+        self.serial = config['serial']
+        self.machine_name = config['machine_name']
+        self.template = config['template']
+        self.patient_name = config.get('patient_name', self.machine_name)
+        self.patient_id = config.get('patient_id', '')
+        self.tolerance_table = config.get('tolerance_table')
+        self.gantry_ranges = tuple(tuple(r) for r in config.get('gantry_ranges', [[0, 360]]))
+        self.collimator_ranges = tuple(tuple(r) for r in config.get('collimator_ranges', [[0, 100], [260, 360]]))
+        self.extended_if = dict(config.get('extended_if') or {})
+        unknown = set(self.extended_if) - set(EXTENDED_IF_KEYS)
+        if unknown:
+            raise ValueError(f"Claves desconocidas en extended_if de {self.label}: {sorted(unknown)}")
+
+        # (tag, VR, valor) de cada atributo, resueltos una sola vez
+        self._beam_patch = tuple(
+            (tag_for_keyword(keyword), dictionary_VR(keyword), getattr(self, field))
+            for field, keyword in BEAM_ATTRIBUTES
+        )
+
+    def apply_to_beams(self, dicom_info):
+        """
+        Writes the machine identity into every beam of the BeamSequence.
+
+        Args:
+            dicom_info (pydicom.dataset.Dataset): The plan.
+        """
+        # Se reemplaza el elemento en lugar de cambiar su valor: los campos pueden compartir
+        # elementos con el plan original (ver batch_modifDICOM.fan_out_plan)
+        for beam in getattr(dicom_info, 'BeamSequence', []):
+            for tag, vr, value in self._beam_patch:
+                beam.add_new(tag, vr, value)
+
+    def gantry_allowed(self, angle):
+        return any(low <= angle <= high for low, high in self.gantry_ranges)
+
+    def collimator_allowed(self, angle):
+        return any(low <= angle <= high for low, high in self.collimator_ranges)
+
+
+class MachineRegistry:
+    """
+    The machines of a registry file, looked up by UI label or by TreatmentMachineName.
+
+    Args:
+        profiles (list of MachineProfile): The machines, in the order they are shown in the UI.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = list(profiles)
+        self._by_key = {}
+        for profile in self.profiles:
+            self._by_key[profile.label] = profile
+            self._by_key[profile.machine_name] = profile
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Reads a registry file.
+
+        Args:
+            path (str): Path of the JSON file, with a "machines" list.
+
+        Returns:
+            MachineRegistry: The registry.
+        """
+        with open(path, 'r', encoding='utf-8') as registry_file:
+            config = json.load(registry_file)
+        return cls(MachineProfile(machine) for machine in config['machines'])
+
+    def labels(self):
+        return [profile.label for profile in self.profiles]
+
+    def find(self, key):
+        """
+        Returns the machine with this UI label or TreatmentMachineName, or None.
+
+        Args:
+            key (str): UI label or TreatmentMachineName.
+
+        Returns:
+            MachineProfile or None
+        """
+        return self._by_key.get(key)
+
+    def get(self, key):
+        """
+        Like `find`, but raises if the machine is unknown.
+
+        Raises:
+            ValueError: If there is no machine with this label or name.
+        """
+        profile = self.find(key)
+        if profile is None:
+            raise ValueError(f"Equipo desconocido: {key!r}. Equipos definidos: {self.labels()}")
+        return profile
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_registry(path=None):
+    """
+    Returns the registry of `path` (by default `maquinas.json`), parsed once per process and file version.
+
+    Args:
+        path (str, optional): Path of the registry file.
+
+    Returns:
+        MachineRegistry: The registry.
+    """
+    path = path or REGISTRY_PATH
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        cached = _cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, MachineRegistry.from_file(path))
+            _cache[path] = cached
+    return cached[1]
@@ -1,42 +1,145 @@
+import atexit
+import mmap
 import os
+import threading
 import tkinter as tk
 from tkinter import filedialog, simpledialog, messagebox
 import pydicom
 import numpy as np
 import sys
 
-def ui_get_dicom_file():
+import dcm_index
+import dcm_patch
+import extended_if
+import machine_registry
+import perf_trace
+import template_cache
+
+# Modos de lectura de get_dicom_file / ui_get_dicom_file
+READ_FULL = 'full'          # Todo el archivo en memoria; los píxeles se decodifican recién al usarlos
+READ_DEFERRED = 'deferred'  # Los valores grandes (píxeles, blobs privados) se leen del disco recién al usarlos
+READ_METADATA = 'metadata'  # Sólo el encabezado: se detiene antes de los píxeles
+DEFER_SIZE = '1 MB'
+
+class LazyPixelArray:
+    """
+    Proxy of `Dataset.pixel_array` that decodes the pixel data only on first access.
+
+    `shape` and `dtype` are answered from the header without decoding. Indexing, `numpy.asarray` or any other
+    ndarray attribute decode the pixels once and keep the result.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): A dataset that contains PixelData.
+    """
+    def __init__(self, dicom_info):
+        self._dicom_info = dicom_info
+        self._array = None
+
+    @property
+    def is_decoded(self):
+        return self._array is not None
+
+    @property
+    def shape(self):
+        if self._array is not None:
+            return self._array.shape
+        shape = (self._dicom_info.Rows, self._dicom_info.Columns)
+        if int(getattr(self._dicom_info, 'NumberOfFrames', 1) or 1) > 1:
+            shape = (int(self._dicom_info.NumberOfFrames),) + shape
+        if int(getattr(self._dicom_info, 'SamplesPerPixel', 1)) > 1:
+            shape = shape + (int(self._dicom_info.SamplesPerPixel),)
+        return shape
+
+    @property
+    def dtype(self):
+        if self._array is not None:
+            return self._array.dtype
+        signed = int(getattr(self._dicom_info, 'PixelRepresentation', 0)) == 1
+        return np.dtype(f"{'i' if signed else 'u'}{int(self._dicom_info.BitsAllocated) // 8}")
+
+    def decode(self):
+        """Decodes the pixel data (only the first time) and returns it as a numpy.ndarray."""
+        if self._array is None:
+            self._array = self._dicom_info.pixel_array
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.decode()
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.decode(), name)
+
+def _read_dicom(full_name, read_mode):
+    """
+    Reads a DICOM file according to `read_mode` and wraps its pixel data in a `LazyPixelArray`.
+
+    Args:
+        full_name (str): Path of the DICOM file.
+        read_mode (str): READ_FULL, READ_DEFERRED or READ_METADATA.
+
+    Returns:
+        tuple: [Dataset, LazyPixelArray or None]
+    """
+    with perf_trace.span('lectura', path=full_name, mode=read_mode) as trace_span:
+        if read_mode == READ_FULL:
+            dicom_info = pydicom.dcmread(full_name, force=True)
+        elif read_mode == READ_DEFERRED:
+            dicom_info = pydicom.dcmread(full_name, force=True, defer_size=DEFER_SIZE)
+        elif read_mode == READ_METADATA:
+            dicom_info = pydicom.dcmread(full_name, force=True, stop_before_pixels=True, defer_size=DEFER_SIZE)
+        else:
+            raise ValueError(f"Modo de lectura desconocido: {read_mode!r}")
+        trace_span.set(file_bytes=os.path.getsize(full_name))
+    pixel_data = LazyPixelArray(dicom_info) if 'PixelData' in dicom_info else None
+    return dicom_info, pixel_data
+
+def ui_get_dicom_file(read_mode=READ_FULL):
     """
     Opens a file dialog to select a DICOM file and returns the DICOM information, pixel data, file path, file name, and full name.
 
     This function opens a file dialog. The file dialog filters the files to only show DICOM files with the extension `.dcm`. If a file is selected, the file path is split to extract the file name and directory. The DICOM file is then read using `pydicom` to obtain the DICOM information and pixel data.
 
+    Args:
+        read_mode (str): READ_FULL, READ_DEFERRED (large values stay on disk until used) or READ_METADATA (stops before the pixel data).
+
     Returns:
-        tuple: [Dataset, numpy.ndarray or None, str, str, str]: A tuple containing the DICOM information (Dataset), pixel data (numpy.ndarray or None), file path (str), file name (str), and full name (str).
+        tuple: [Dataset, LazyPixelArray or None, str, str, str]: A tuple containing the DICOM information (Dataset), pixel data (decoded on first access, or None), file path (str), file name (str), and full name (str).
     """
     root = tk.Tk()
     root.withdraw()
-    full_name = filedialog.askopenfilename(filetypes=[('DICOM Files', '*.dcm;*.img')])
+    with perf_trace.wait('dialogo_archivo'):
+        full_name = filedialog.askopenfilename(filetypes=[('DICOM Files', '*.dcm;*.img')])
     if full_name:
         file_path, file_name = os.path.split(full_name)  # Extract the directory and filename from the full path
-        dicom_info = pydicom.dcmread(full_name,force=True)
-        pixel_data = dicom_info.pixel_array if hasattr(dicom_info, 'pixel_array') else None
+        dicom_info, pixel_data = _read_dicom(full_name, read_mode)
         return dicom_info, pixel_data, file_path, file_name, full_name
     else:
         return None, None, None, None, None
     
-def get_dicom_file(full_name):
+def get_dicom_file(full_name, read_mode=READ_FULL):
     """
     Opens a DICOM file and returns the DICOM information, pixel data, file path, file name, and full name.
 
     The DICOM file is then read using `pydicom` to obtain the DICOM information and pixel data.
 
+    Args:
+        full_name (str): Path of the DICOM file.
+        read_mode (str): READ_FULL, READ_DEFERRED (large values stay on disk until used) or READ_METADATA (stops before the pixel data).
+
     Returns:
-        tuple: [Dataset, numpy.ndarray or None, str, str]: A tuple containing the DICOM information (Dataset), pixel data (numpy.ndarray or None), file path (str), and file name (str).
+        tuple: [Dataset, LazyPixelArray or None, str, str]: A tuple containing the DICOM information (Dataset), pixel data (decoded on first access, or None), file path (str), and file name (str).
     """
     file_path, file_name = os.path.split(full_name)  # Extract the directory and filename from the full path
-    dicom_info = pydicom.dcmread(full_name,force=True)
-    pixel_data = dicom_info.pixel_array if hasattr(dicom_info, 'pixel_array') else None
+    dicom_info, pixel_data = _read_dicom(full_name, read_mode)
     return dicom_info, pixel_data, file_path, file_name
 
 def get_dose_reference_sequence(dicom_info):
@@ -123,6 +226,7 @@ def get_number_of_beams(dicom_info):
     """
     return len(dicom_info.BeamSequence)
 
+@perf_trace.traced(kind=perf_trace.WAIT)
 def ui_modify_gantry_angles(dicom_info):
     """
     Modifies the gantry angles of the given DICOM info.
@@ -162,6 +266,7 @@ def ui_modify_gantry_angles(dicom_info):
             
             root.destroy()
 
+@perf_trace.traced(kind=perf_trace.WAIT)
 def ui_modify_collimator_angles(dicom_info):
     """
     Modifies the collimator angles of the given DICOM info.
@@ -201,6 +306,7 @@ def ui_modify_collimator_angles(dicom_info):
             
             root.destroy()
 
+@perf_trace.traced(kind=perf_trace.WAIT)
 def modificar_portal_possition(dicom_info):
     """
     Recorre todos los beams en BeamSequence, muestra el valor actual de RTImageSID y permite cambiarlo.
@@ -238,6 +344,96 @@ def modificar_portal_possition(dicom_info):
                         root.destroy()
 
 
+GANTRY_RANGES = ((0, 360),)
+COLLIMATOR_RANGES = ((0, 100), (260, 360))
+
+def _value_for_beam(values, index, beam):
+    """
+    Resolves the value that applies to a beam from a scalar, a list or a dict.
+
+    Args:
+        values (int, float, list or dict): A single value for every beam, a list indexed by beam order, or a dict keyed by BeamName or BeamNumber.
+        index (int): Position of the beam in the BeamSequence.
+        beam (pydicom.dataset.Dataset): The beam.
+
+    Returns:
+        The value for the beam, or None if it should be left unchanged.
+    """
+    if values is None:
+        return None
+    if isinstance(values, dict):
+        for key in (getattr(beam, 'BeamName', None), str(getattr(beam, 'BeamNumber', ''))):
+            if key in values:
+                return values[key]
+        return None
+    if isinstance(values, (list, tuple)):
+        return values[index] if index < len(values) else None
+    return values
+
+@perf_trace.traced()
+def modify_gantry_angles(dicom_info, angles, allowed_ranges=GANTRY_RANGES):
+    """
+    Sets the gantry angle of the first control point of each beam without any dialog.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The DICOM info containing the BeamSequence.
+        angles (int, list or dict): New gantry angles (0-360), see `_value_for_beam`.
+        allowed_ranges (tuple): Allowed (min, max) ranges, e.g. `MachineProfile.gantry_ranges`.
+
+    Raises:
+        ValueError: If an angle is outside the allowed ranges.
+    """
+    if hasattr(dicom_info, 'BeamSequence'):
+        for i, beam in enumerate(dicom_info.BeamSequence):
+            new_angle = _value_for_beam(angles, i, beam)
+            if new_angle is None:
+                continue
+            if not any(low <= new_angle <= high for low, high in allowed_ranges):
+                raise ValueError(f"Ángulo de gantry fuera de rango {allowed_ranges}: {new_angle}")
+            beam.ControlPointSequence[0].GantryAngle = new_angle
+
+@perf_trace.traced()
+def modify_collimator_angles(dicom_info, angles, allowed_ranges=COLLIMATOR_RANGES):
+    """
+    Sets the collimator angle of the first control point of each beam without any dialog.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The DICOM info containing the BeamSequence.
+        angles (int, list or dict): New collimator angles (100-0 o 360-260), see `_value_for_beam`.
+        allowed_ranges (tuple): Allowed (min, max) ranges, e.g. `MachineProfile.collimator_ranges`.
+
+    Raises:
+        ValueError: If an angle is outside the allowed ranges.
+    """
+    if hasattr(dicom_info, 'BeamSequence'):
+        for i, beam in enumerate(dicom_info.BeamSequence):
+            new_angle = _value_for_beam(angles, i, beam)
+            if new_angle is None:
+                continue
+            if not any(low <= new_angle <= high for low, high in allowed_ranges):
+                raise ValueError(f"Ángulo de colimador fuera de rango {allowed_ranges}: {new_angle}")
+            beam.ControlPointSequence[0].BeamLimitingDeviceAngle = new_angle
+
+@perf_trace.traced()
+def modify_portal_position(dicom_info, positions_cm):
+    """
+    Sets the portal position (RTImageSID) of every planned verification image without any dialog.
+
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The DICOM info containing the BeamSequence.
+        positions_cm (int, list or dict): Portal position in cm below the ISO, see `_value_for_beam`.
+    """
+    if hasattr(dicom_info, 'BeamSequence'):
+        for i, beam in enumerate(dicom_info.BeamSequence):
+            new_sid = _value_for_beam(positions_cm, i, beam)
+            if new_sid is None or not hasattr(beam, 'PlannedVerificationImageSequence'):
+                continue
+            for verification_image in beam.PlannedVerificationImageSequence:
+                if hasattr(verification_image, 'RTImageSID'):
+                    verification_image.RTImageSID = (new_sid*10 + 1000)
+
+
+@perf_trace.traced()
 def set_tolerances_to_qa(dicom_info):
     """
     Modifica la tabla de tolerancia de un archivo DICOM.
@@ -260,6 +456,31 @@ def set_tolerances_to_qa(dicom_info):
         beam.ReferencedToleranceTableNumber = 3
 
 
+def prefetch_templates():
+    """
+    Loads the template plans of every machine of the registry in the background, see `template_cache.prefetch`.
+
+    Called before the first dialog, so that by the time the user picks a machine `change_machine` finds its template
+    already parsed instead of reading it from the network share.
+
+    Returns:
+        threading.Thread: The (daemon) thread that starts the loads.
+    """
+    thread = threading.Thread(target=_prefetch_templates, name='prefetch', daemon=True)
+    thread.start()
+    return thread
+
+def _prefetch_templates():
+    with perf_trace.span('prefetch_plantillas'):
+        try:
+            paths = [profile.template for profile in machine_registry.get_registry().profiles]
+        except (OSError, ValueError):
+            # Sin registro no hay equipos que elegir; el error se informa si se intenta cambiar el equipo
+            return
+        for thread in template_cache.prefetch(paths):
+            thread.join()
+
+@perf_trace.traced(kind=perf_trace.WAIT)
 def ui_select_machine():
     def get_selected_option():
         selected_option.set(option_var.get())
@@ -275,7 +496,7 @@ def ui_select_machine():
     option_var = tk.StringVar(root)
     option_var.set('-')  # Opción predeterminada
 
-    option_menu = tk.OptionMenu(root, option_var, "Equipo 1 (QBA_600CD_523)", "Equipo 2 (EQ2_iX_827)")
+    option_menu = tk.OptionMenu(root, option_var, *machine_registry.get_registry().labels())
     option_menu.pack(pady=10)
 
     selected_option = tk.StringVar()
@@ -293,128 +514,194 @@ def update_beam_params(dicom_info, equipo_destino):
     """
     Update the manufacturer, institution, model name, serial number, and treatment machine name of all beams in the BeamSequence of the given DICOM info based on the equipment destination.
 
+    The values come from the machine registry (`maquinas.json`, see `machine_registry`).
+
     Args:
         dicom_info (pydicom.dataset.FileDataset): The DICOM info containing the BeamSequence.
-        equipo_destino (str): The equipment destination.
+        equipo_destino (str): The equipment destination (UI label or TreatmentMachineName).
 
     Returns:
         None
-    """
-    if equipo_destino == "Equipo 1 (QBA_600CD_523)":
-        new_manufacturer = "Varian Medical Systems"
-        new_institution = "Mevaterapia Quilmes"
-        new_modelname = "600CD"
-        new_serialnumber = "523"
-        new_treatment_machine_name = "QBA_600CD_523"
 
-    elif equipo_destino == "Equipo 2 (EQ2_iX_827)":
-        new_manufacturer = "Varian Medical Systems"
-        new_institution = "Mevaterapia Quilmes"
-        new_modelname = "iX-S"
-        new_serialnumber = "827"
-        new_treatment_machine_name = "EQ2_iX_827"
+    Raises:
+        ValueError: If the equipment is not in the registry.
+    """
+    machine_registry.get_registry().get(equipo_destino).apply_to_beams(dicom_info)
 
-    if hasattr(dicom_info, 'BeamSequence'):
-        for beam in dicom_info.BeamSequence:
-            beam.Manufacturer = new_manufacturer
-            beam.InstitutionName = new_institution
-            beam.ManufacturerModelName = new_modelname
-            beam.DeviceSerialNumber = new_serialnumber
-            beam.TreatmentMachineName = new_treatment_machine_name
 
+# Atributos que change_machine copia del plan original a la plantilla del equipo
+GRAFTED_KEYWORDS = ('SOPClassUID', 'SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID', 'FrameOfReferenceUID',
+                    'FractionGroupSequence', 'BeamSequence', 'ReferencedStructureSetSequence')
 
+@perf_trace.traced()
 def change_machine(dicom_info, goal_machine):
-    if goal_machine == "Equipo 1 (QBA_600CD_523)":
-        # Cargo dicom base de 600CD
-        path_eq1 = rf'\\10.130.1.253\FisicaQuilmes\_Datos\2_ Desarrollos\0_ En Curso\Modificador DCM\PlanBase_1_QA.dcm'
-        info_eq1, sin_uso, sin_uso1, sin_uso2 = get_dicom_file(path_eq1)
-
-        if hasattr(dicom_info, 'SOPClassUID'): info_eq1.SOPClassUID = dicom_info.SOPClassUID
-        if hasattr(dicom_info, 'SOPInstanceUID'): info_eq1.SOPInstanceUID = dicom_info.SOPInstanceUID
-        info_eq1.PatientName = 'Equipo1_QA'
-        info_eq1.PatientID = '1-000000-1'
-        if hasattr(dicom_info, 'StudyInstanceUID'): info_eq1.StudyInstanceUID = dicom_info.StudyInstanceUID
-        if hasattr(dicom_info, 'SeriesInstanceUID'): info_eq1.SeriesInstanceUID = dicom_info.SeriesInstanceUID
-        if hasattr(dicom_info, 'FrameOfReferenceUID'): info_eq1.FrameOfReferenceUID = dicom_info.FrameOfReferenceUID
-        if hasattr(dicom_info, 'FractionGroupSequence'): info_eq1.FractionGroupSequence = dicom_info.FractionGroupSequence
-        if hasattr(dicom_info, 'BeamSequence'): info_eq1.BeamSequence = dicom_info.BeamSequence
-        if hasattr(dicom_info, 'ReferencedStructureSetSequence'): info_eq1.ReferencedStructureSetSequence = dicom_info.ReferencedStructureSetSequence
-
-        update_beam_params(info_eq1,goal_machine)
-        
-        return info_eq1
-    
-    elif goal_machine == "Equipo 2 (EQ2_iX_827)":
-        # Cargo dicom base de iX
-        path_eq2 = rf'\\10.130.1.253\FisicaQuilmes\_Datos\2_ Desarrollos\0_ En Curso\Modificador DCM\PlanBase_2_QA.dcm'
-        info_eq2, sin_uso, sin_uso1, sin_uso2 = get_dicom_file(path_eq2)
-
-        if hasattr(dicom_info, 'SOPClassUID'): info_eq2.SOPClassUID = dicom_info.SOPClassUID
-        if hasattr(dicom_info, 'SOPInstanceUID'): info_eq2.SOPInstanceUID = dicom_info.SOPInstanceUID
-        info_eq2.PatientName = 'Equipo2_QA'
-        info_eq2.PatientID = '1-000000-2'
-        if hasattr(dicom_info, 'StudyInstanceUID'): info_eq2.StudyInstanceUID = dicom_info.StudyInstanceUID
-        if hasattr(dicom_info, 'SeriesInstanceUID'): info_eq2.SeriesInstanceUID = dicom_info.SeriesInstanceUID
-        if hasattr(dicom_info, 'FrameOfReferenceUID'): info_eq2.FrameOfReferenceUID = dicom_info.FrameOfReferenceUID
-        if hasattr(dicom_info, 'FractionGroupSequence'): info_eq2.FractionGroupSequence = dicom_info.FractionGroupSequence
-        if hasattr(dicom_info, 'BeamSequence'): info_eq2.BeamSequence = dicom_info.BeamSequence
-        if hasattr(dicom_info, 'ReferencedStructureSetSequence'): info_eq2.ReferencedStructureSetSequence = dicom_info.ReferencedStructureSetSequence
-
-        update_beam_params(info_eq2,goal_machine)
-        
-        return info_eq2
-    
-    else:
+    """
+    Moves the plan onto the template plan of another machine.
+
+    The UIDs, FractionGroupSequence, BeamSequence and ReferencedStructureSetSequence of `dicom_info` are grafted onto
+    a copy of the machine's template plan and the beams get the machine identity. If `goal_machine` is not in the
+    registry the plan is returned unchanged.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): The plan.
+        goal_machine (str): UI label or TreatmentMachineName of the target machine.
+
+    Returns:
+        pydicom.dataset.FileDataset: The plan for the target machine, or `dicom_info`.
+    """
+    profile = machine_registry.get_registry().find(goal_machine) if goal_machine else None
+    if profile is None:
         return dicom_info
 
+    # Cargo dicom base del equipo
+    with perf_trace.span('carga_plantilla', template=profile.template):
+        info_eq = template_cache.get_template(profile.template)
 
+    if hasattr(dicom_info, 'SOPClassUID'): info_eq.SOPClassUID = dicom_info.SOPClassUID
+    if hasattr(dicom_info, 'SOPInstanceUID'): info_eq.SOPInstanceUID = dicom_info.SOPInstanceUID
+    info_eq.PatientName = profile.patient_name
+    info_eq.PatientID = profile.patient_id
+    if hasattr(dicom_info, 'StudyInstanceUID'): info_eq.StudyInstanceUID = dicom_info.StudyInstanceUID
+    if hasattr(dicom_info, 'SeriesInstanceUID'): info_eq.SeriesInstanceUID = dicom_info.SeriesInstanceUID
+    if hasattr(dicom_info, 'FrameOfReferenceUID'): info_eq.FrameOfReferenceUID = dicom_info.FrameOfReferenceUID
+    if hasattr(dicom_info, 'FractionGroupSequence'): info_eq.FractionGroupSequence = dicom_info.FractionGroupSequence
+    if hasattr(dicom_info, 'BeamSequence'): info_eq.BeamSequence = dicom_info.BeamSequence
+    if hasattr(dicom_info, 'ReferencedStructureSetSequence'): info_eq.ReferencedStructureSetSequence = dicom_info.ReferencedStructureSetSequence
+    # El file meta sigue siendo el de la plantilla: sin esto el archivo se identifica con el UID de la plantilla (p. ej.
+    # al reenviarlo tal cual por C-STORE, todos los planes de un equipo llegarían como la misma instancia)
+    file_meta = getattr(info_eq, 'file_meta', None)
+    if file_meta is not None:
+        if 'SOPClassUID' in info_eq: file_meta.add_new('MediaStorageSOPClassUID', 'UI', info_eq.SOPClassUID)
+        if 'SOPInstanceUID' in info_eq: file_meta.add_new('MediaStorageSOPInstanceUID', 'UI', info_eq.SOPInstanceUID)
 
-def add_private_fields(path_file_name):
+    profile.apply_to_beams(info_eq)
+
+    return info_eq
+
+
+
+EXTENDED_IF_GROUP = 0x3253
+EXTENDED_IF_CREATOR = b'Varian Medical Systems VISION 3253'
+
+# Lo que hace falta del plan para armar el anexo (ver `extended_if.build_xml`)
+EXTENDED_IF_SOURCE_TAGS = ('ToleranceTableSequence', 'DoseReferenceSequence', 'BeamSequence')
+
+def read_annex_xml(xml_path=None):
     """
-    Adds private fields to a DICOM file.
+    Reads the ExtendedVAPlanInterface XML stored in an annex file, like the former fixed `anexo_XML.txt`.
 
     Args:
-        path_file_name (str): The path to the DICOM file.
+        xml_path (str, optional): Path to the annex. Defaults to `anexo_XML.txt` next to the script.
 
     Returns:
-        None
+        bytes: The XML text, without padding.
+    """
+    if xml_path is None:
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        xml_path = os.path.join(script_dir, 'anexo_XML.txt')
+    with open(xml_path, 'rb') as xml_file:
+        data_xml = xml_file.read()
 
-    This function reads an XML file located in the same directory as the script and adds its contents to the end of the DICOM file specified by `path_file_name`. The modified DICOM file is saved with the suffix "_mod.dcm" appended to the original file name. The function prints the path to the modified DICOM file after it is saved.
+    # El anexo son los elementos del grupo 3253 en Implicit VR Little Endian; el XML es el (3253,1000)
+    for element in dcm_index.iter_elements(data_xml, 0, len(data_xml)):
+        if element.tag == 0x32531000:
+            return data_xml[element.value_offset:element.end].rstrip(b'\x00\n')
+    raise ValueError(f"El anexo {xml_path} no contiene el elemento (3253,1000).")
 
-    The function first obtains the directory and file name of the DICOM file using `os.path.dirname` and `os.path.basename`. It then constructs the path to the XML file using `os.path.join` and `os.path.realpath` to ensure that the path is correct regardless of the current working directory.
+def encode_extended_if(data_xml, implicit_vr=True, little_endian=True):
+    """
+    Encodes the Varian ExtendedIF private block: creator, XML, XML length and the 'ExtendedIF' marker.
+
+    The block is written as Eclipse writes it: the XML as given, with no trailing newline, padded with a NUL to an
+    even length, and its unpadded length in (3253,1001).
 
-    The function reads the contents of the XML file using a binary mode file object. It then reads the contents of the DICOM file using a binary mode file object.
+    Args:
+        data_xml (bytes): The ExtendedVAPlanInterface XML.
+        implicit_vr (bool): Whether the target file is Implicit VR.
+        little_endian (bool): Whether the target file is Little Endian.
 
-    The function searches for the position of the string 'APPROVED' at the end of the DICOM file. It does this by iteratively checking the last 8 bytes of the file until it finds the string 'APPROVED'.
+    Returns:
+        bytes: The encoded (3253,0010), (3253,1000), (3253,1001) and (3253,1002) elements.
     """
-    # Obtener el directorio y nombre del archivo DICOM
-    dir_path = os.path.dirname(path_file_name)
-    file_name = os.path.basename(path_file_name)
-    
-    # Ruta al archivo XML en el mismo directorio que el script
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    xml_path = os.path.join(script_dir, 'anexo_XML.txt')
+    return b''.join((
+        dcm_index.encode_element(0x32530010, 'LO', EXTENDED_IF_CREATOR, implicit_vr, little_endian),
+        dcm_index.encode_element(0x32531000, 'UN', data_xml, implicit_vr, little_endian),
+        dcm_index.encode_element(0x32531001, 'UN', str(len(data_xml)).encode('ascii'), implicit_vr, little_endian),
+        dcm_index.encode_element(0x32531002, 'UN', b'ExtendedIF', implicit_vr, little_endian),
+    ))
+
+def set_extended_if(dicom_info, data_xml):
+    """
+    Replaces the Varian ExtendedIF private block of a dataset, with the same values as `encode_extended_if`.
 
-    # Leer el archivo XML
-    with open(xml_path, 'rb') as xml_file:
-        data_xml = xml_file.read()
+    Args:
+        dicom_info (pydicom.dataset.Dataset): The plan.
+        data_xml (bytes): The ExtendedVAPlanInterface XML, see `extended_if.build_xml`.
+    """
+    for tag in [tag for tag in dicom_info.keys() if tag.group == EXTENDED_IF_GROUP]:
+        del dicom_info[tag]
+    # Valores UN de longitud par, rellenos con NUL como los escribe encode_element
+    for tag, vr, value in ((0x32530010, 'LO', EXTENDED_IF_CREATOR.decode('ascii')),
+                           (0x32531000, 'UN', data_xml),
+                           (0x32531001, 'UN', str(len(data_xml)).encode('ascii')),
+                           (0x32531002, 'UN', b'ExtendedIF')):
+        if vr == 'UN' and len(value) % 2:
+            value += b'\x00'
+        dicom_info.add_new(tag, vr, value)
+
+@perf_trace.traced()
+def write_private_fields(path_file_name, output_path=None, data_xml=None):
+    """
+    Writes a copy of a DICOM file with the ExtendedIF private block, without any dialog.
 
-    # Leer el archivo DICOM
-    with open(path_file_name, 'rb') as dicom_file:
-        data_dcm = dicom_file.read()
+    The insertion point is found by walking the top-level element headers over a memory map of the file. Any
+    existing group 3253 is replaced and the elements before and after it are streamed to the output unchanged.
 
-    # Buscar la posición de 'APPROVED' al final del archivo DICOM
-    APPROVED = b'APPROVED'
-    aux = len(data_dcm)
-    i = 0
-    while data_dcm[aux-8-i:aux-i] != APPROVED:
-        i += 1
+    Args:
+        path_file_name (str): The path to the DICOM file.
+        output_path (str, optional): Where to write. Defaults to the input name with the suffix "_private.dcm".
+        data_xml (bytes, optional): The XML to embed. By default it is built from the plan, with the configuration
+            of its machine (see `extended_if.build_xml_for_machine`).
+
+    Returns:
+        str: The path of the written file.
+    """
+    if output_path is None:
+        output_path = os.path.splitext(path_file_name)[0] + '_private.dcm'
+    if data_xml is None:
+        with perf_trace.span('anexo_xml'):
+            source = pydicom.dcmread(path_file_name, stop_before_pixels=True, specific_tags=list(EXTENDED_IF_SOURCE_TAGS))
+            data_xml = extended_if.build_xml_for_machine(source)
+
+    with open(path_file_name, 'rb') as dicom_file, mmap.mmap(dicom_file.fileno(), 0, access=mmap.ACCESS_READ) as data_dcm:
+        layout = dcm_index.read_file_layout(data_dcm)
+        start, stop = dcm_index.find_group_span(data_dcm, layout, EXTENDED_IF_GROUP)
+        block = encode_extended_if(data_xml, layout.implicit_vr, layout.little_endian)
+
+        # memoryview: las porciones se escriben directo desde el mmap, sin copiarlas
+        with memoryview(data_dcm) as view, open(output_path, 'wb') as fid3:
+            fid3.write(view[:start])
+            fid3.write(block)
+            fid3.write(view[stop:])
+    perf_trace.annotate(bytes_written=os.path.getsize(output_path))
+    return output_path
+
+def add_private_fields(path_file_name):
+    """
+    Adds private fields to a DICOM file.
+
+    Args:
+        path_file_name (str): The path to the DICOM file.
+
+    Returns:
+        None
 
-    # Reescribir el archivo DICOM agregando el anexo en XML
-    data_dcm_mod = data_dcm[:aux-i]  # data2 cortado al final de 'APPROVED'
-    output_path = os.path.join(dir_path, file_name[:-4] + '_private.dcm')
-    with open(output_path, 'wb') as fid3:
-        fid3.write(data_dcm_mod + data_xml)
+    This function embeds the Varian ExtendedIF private block, with the XML built from the plan itself (tolerance
+    tables, dose references and, if the machine configures it, beams; see `extended_if`), into the DICOM file
+    specified by `path_file_name`, see `write_private_fields`. The modified DICOM file is saved with the suffix
+    "_private.dcm" and its path is shown in a message box.
+    """
+    output_path = write_private_fields(path_file_name)
 
     # Imprimir la ruta al archivo modificado
     root = tk.Tk()
@@ -422,14 +709,25 @@ def add_private_fields(path_file_name):
     messagebox.showinfo("Listo!", f"Archivo modificado guardado en: {output_path}")
 
 def main():
+    # Las plantillas de los equipos se cargan del share mientras el usuario elige el archivo y contesta los diálogos
+    prefetch_templates()
+
     # Cargo el DICOM
-    info, pixel_data, file_path, file_name, full_path_file = ui_get_dicom_file()
+    info, pixel_data, file_path, file_name, full_path_file = ui_get_dicom_file(READ_DEFERRED)
     if info is None:
         root = tk.Tk()
         root.withdraw()
         messagebox.showinfo("Bueno, adiós!", "No se selecciono ningun archivo.")
         sys.exit()
 
+    # Valores originales, para guardar parcheando sólo los bytes que cambian
+    snapshot = dcm_patch.take_snapshot(info)
+
+    # Definir el nombre del archivo de salida
+    out_path_name = file_path
+    output_file_name = os.path.splitext(file_name)[0] + '_mod.dcm'
+    output_path_file = os.path.join(out_path_name, output_file_name)
+
     # Creo una copia para modificar
     info_mod = info
 
@@ -438,23 +736,37 @@ def main():
     selected_machine = 'Null'
     root = tk.Tk()
     root.withdraw()
-    change_machine_question = messagebox.askyesno("Equipo", "El equipo es '" + current_machine + "'. ¿Desea cambiarlo?")
+    with perf_trace.wait('dialogo_equipo'):
+        change_machine_question = messagebox.askyesno("Equipo", "El equipo es '" + current_machine + "'. ¿Desea cambiarlo?")
     if change_machine_question: 
         selected_machine = ui_select_machine()
     root.destroy()
     info_mod = change_machine(info_mod, selected_machine)
 
+    # La salida se prepara en segundo plano mientras el usuario contesta los diálogos que siguen: la copia del
+    # original o, si cambió el equipo, el plan nuevo completo. Al final sólo se parchean las ediciones.
+    if info_mod is info:
+        prepared = dcm_patch.PreparedOutput.copy_of(full_path_file, output_path_file, snapshot)
+    else:
+        prepared = dcm_patch.PreparedOutput.written_from(info_mod, output_path_file)
+    # Si el asistente se corta antes de guardar, no queda el temporal
+    atexit.register(prepared.discard)
+
     # Modificar Gantry Angle
     root = tk.Tk()
     root.withdraw()
-    change_angle = messagebox.askyesno("Gantry", "¿Desea cambiar el ángulo de Gantry?")
+    with perf_trace.wait('dialogo_gantry'):
+        change_angle = messagebox.askyesno("Gantry", "¿Desea cambiar el ángulo de Gantry?")
+    # La escritura anticipada lee el plan: tiene que terminar antes de editarlo
+    prepared.wait()
     if change_angle: ui_modify_gantry_angles(info_mod)
     root.destroy()
 
     # Modificar Col Angle
     root = tk.Tk()
     root.withdraw()
-    change_angle = messagebox.askyesno("Colimador", "¿Desea cambiar el ángulo de Colimador?")
+    with perf_trace.wait('dialogo_colimador'):
+        change_angle = messagebox.askyesno("Colimador", "¿Desea cambiar el ángulo de Colimador?")
     if change_angle: ui_modify_collimator_angles(info_mod)
     root.destroy()
 
@@ -469,7 +781,8 @@ def main():
         root = tk.Tk()
         root.withdraw()
         message = f"La tabla de tolerancia es '{tolerance_table_original}'. ¿Desea cambiarla a 'T_QA'?"
-        change_tol_table = messagebox.askyesno("Tabla de tolerancia", message)
+        with perf_trace.wait('dialogo_tolerancia'):
+            change_tol_table = messagebox.askyesno("Tabla de tolerancia", message)
 
         if change_tol_table: set_tolerances_to_qa(info_mod)
         root.destroy()
@@ -477,16 +790,12 @@ def main():
     if tolerance_table_dicom != tolerance_table_beam:
         set_tolerances_to_qa(info_mod)
 
-    # Definir el nombre del archivo de salida
-    out_path_name = file_path
-    output_file_name = os.path.splitext(file_name)[0] + '_mod.dcm'
-    output_path_file = os.path.join(out_path_name, output_file_name)
-
-    # Guardar el archivo DICOM modificado
-    pydicom.write_file(output_path_file, info_mod, write_like_original=True)
+    # Guardar el archivo DICOM modificado (renombrando y parcheando la salida preparada)
+    dcm_patch.save_plan(full_path_file, output_path_file, info_mod, snapshot, prepared=prepared)
     root = tk.Tk()
     root.withdraw()
-    messagebox.showinfo("Listo!", f"Archivo modificado guardado en: {out_path_name}")
+    with perf_trace.wait('dialogo_listo'):
+        messagebox.showinfo("Listo!", f"Archivo modificado guardado en: {out_path_name}")
 
     # Llamar a la función para modificar y guardar el archivo DICOM
     #add_private_fields(output_path_file)
@@ -0,0 +1,227 @@
+"""
+Instrumentación opcional (spans) de las conversiones.
+
+Desactivada por defecto: `span` devuelve un objeto vacío y no mide nada. Se
+activa con la variable de entorno MODIFDCM_TRACE apuntando al archivo de salida,
+o llamando a `enable`:
+
+    set MODIFDCM_TRACE=C:/QA/traza.jsonl      (un evento JSON por línea)
+    set MODIFDCM_TRACE=C:/QA/traza.json       (formato Chrome trace, se abre en
+                                               chrome://tracing o ui.perfetto.dev)
+    set MODIFDCM_TRACE_MEMORY=1               (además, pico de memoria con tracemalloc)
+
+Cada span registra nombre, tipo ('compute' para el trabajo, 'wait' para el
+tiempo que el usuario pasa frente a un diálogo), inicio y duración, proceso,
+hilo y atributos como bytes leídos/escritos. Los spans se anidan por hilo.
+
+Uso:
+    with perf_trace.span('lectura', path=full_name):
+        ...
+        perf_trace.annotate(bytes_read=size)
+
+    @perf_trace.traced(kind='wait')
+    def ui_select_machine(): ...
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+COMPUTE = 'compute'
+WAIT = 'wait'
+
+_state = {'path': None, 'chrome': False, 'memory': False, 'events': [], 'owner_pid': None}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    """Span of the disabled tracer: does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    One timed region. Use through `span` or `wait`.
+
+    Args:
+        name (str): Name of the stage.
+        kind (str): COMPUTE or WAIT.
+        attributes (dict): Extra values recorded with the span.
+    """
+
+    def __init__(self, name, kind, attributes):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self._child_peak = 0
+
+    def set(self, **attributes):
+        """Adds attributes (bytes read/written, counts...) to the span."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _stack()
+        self._parent = stack[-1] if stack else None
+        stack.append(self)
+        if _state['memory'] and tracemalloc.is_tracing():
+            self._memory_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        # Inicio en tiempo de reloj (comparable entre procesos), duración con perf_counter
+        self._wall_start_ns = time.time_ns()
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration_ns = time.perf_counter_ns() - self._start_ns
+        stack = _stack()
+        stack.pop()
+        if _state['memory'] and tracemalloc.is_tracing():
+            # El pico de un span incluye el de sus hijos, que reiniciaron el contador
+            peak = max(tracemalloc.get_traced_memory()[1], self._child_peak)
+            self.attributes['peak_bytes'] = peak - self._memory_start
+            if self._parent is not None:
+                self._parent._child_peak = max(self._parent._child_peak, peak)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        _record({
+            'name': self.name,
+            'kind': self.kind,
+            'start_us': self._wall_start_ns / 1000,
+            'duration_us': duration_ns / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'parent': self._parent.name if self._parent is not None else None,
+            'attributes': self.attributes,
+        })
+        if not stack and _state['chrome'] and os.getpid() != _state['owner_pid']:
+            # Los procesos de un pool terminan sin correr atexit
+            flush()
+        return False
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enable(path, chrome=None, memory=False):
+    """
+    Starts recording spans to `path`.
+
+    Args:
+        path (str): Output file. JSON lines, or Chrome trace format if `chrome`.
+        chrome (bool, optional): Defaults to True when `path` ends in '.json'.
+        memory (bool): Also record the peak of traced memory of each span (slower).
+    """
+    _state['path'] = path
+    _state['chrome'] = path.lower().endswith('.json') if chrome is None else chrome
+    _state['memory'] = memory
+    _state['events'] = []
+    # Los procesos hijos (pools) heredan la variable de entorno: en formato Chrome cada uno escribe su archivo
+    _state['owner_pid'] = int(os.environ.setdefault('MODIFDCM_TRACE_PID', str(os.getpid())))
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enabled():
+    return _state['path'] is not None
+
+
+def span(name, kind=COMPUTE, **attributes):
+    """
+    Returns a context manager that times the region as a span, or a no-op one if tracing is disabled.
+
+    Args:
+        name (str): Name of the stage.
+        kind (str): COMPUTE or WAIT.
+        **attributes: Extra values recorded with the span.
+    """
+    if _state['path'] is None:
+        return _NULL_SPAN
+    return Span(name, kind, attributes)
+
+
+def wait(name, **attributes):
+    """Like `span`, for time spent waiting on the user (dialogs)."""
+    return span(name, WAIT, **attributes)
+
+
+def annotate(**attributes):
+    """Adds attributes to the innermost open span of the current thread, if any."""
+    if _state['path'] is not None and _stack():
+        _stack()[-1].set(**attributes)
+
+
+def traced(name=None, kind=COMPUTE):
+    """
+    Decorator that records each call of the function as a span.
+
+    Args:
+        name (str, optional): Name of the span. Defaults to the function name.
+        kind (str): COMPUTE or WAIT.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _state['path'] is None:
+                return func(*args, **kwargs)
+            with Span(span_name, kind, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _record(event):
+    with _lock:
+        if _state['chrome']:
+            _state['events'].append(event)
+        else:
+            with open(_state['path'], 'a', encoding='utf-8') as trace_file:
+                trace_file.write(json.dumps(event, ensure_ascii=False, default=str) + '\n')
+
+
+def flush():
+    """Writes the Chrome trace file with the spans recorded so far. JSON lines are written as they happen."""
+    if _state['path'] is None or not _state['chrome']:
+        return
+    path = _state['path']
+    if os.getpid() != _state['owner_pid']:
+        path = f"{os.path.splitext(path)[0]}.{os.getpid()}.json"
+    with _lock:
+        trace_events = [{
+            'name': event['name'],
+            'cat': event['kind'],
+            'ph': 'X',
+            'ts': event['start_us'],
+            'dur': event['duration_us'],
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': event['attributes'],
+        } for event in _state['events'] if event['pid'] == os.getpid()]
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file, ensure_ascii=False, default=str)
+
+
+atexit.register(flush)
+
+if os.environ.get('MODIFDCM_TRACE'):
+    enable(os.environ['MODIFDCM_TRACE'], memory=os.environ.get('MODIFDCM_TRACE_MEMORY') == '1')
@@ -0,0 +1,351 @@
+"""
+Análisis de picket fence sobre las placas CR recortadas.
+
+Trabaja sobre la salida de `crop_dicom` (o sobre una imagen ya convertida para
+QATrack), todo vectorizado con NumPy:
+
+* La orientación de los piquetes y su posición aproximada salen del perfil
+  medio de la imagen (con una de cada 4 filas alcanza).
+* El perfil de cada par de láminas es el promedio de las filas de la mitad
+  central de la lámina (lejos del machihembrado): sólo se leen esas filas.
+* En cada piquete y lámina se toma el máximo del perfil y se le ajusta una
+  parábola por cuadrados mínimos a los píxeles vecinos: el vértice da la
+  posición con precisión sub-píxel. Es una sola multiplicación de matrices para
+  todas las láminas y piquetes.
+
+Las posiciones se pasan a mm en el isocentro con el tamaño de píxel de la placa
+y la magnificación RTImageSID / SAD. El eje central se toma en el centro de la
+imagen, como en `convert_cr`, y las láminas son las de un Millennium 120 salvo
+que se indique otra geometría. El error de cada lámina es la diferencia con la
+recta ajustada a su piquete (lo que mide la desviación de una lámina respecto de
+sus vecinas) o, si se dan, con las posiciones nominales de los piquetes.
+
+Uso:
+    python pf_analysis.py placa.dcm --sid 153 --tolerance 0.5
+    python pf_analysis.py "C:/CR/export/*.dcm" --nominal -60 -45 -30 -15 0 15 30 45 60 --csv errores.csv
+"""
+import argparse
+import csv
+import glob
+import math
+import sys
+import time
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+# Distancia fuente-isocentro en mm, si la imagen no trae RadiationMachineSAD
+SAD_MM = 1000.0
+# Anchos de lámina en el isocentro (mm) de un Millennium 120: 10 de 10 mm, 40 de 5 mm y 10 de 10 mm
+MILLENNIUM_120 = (10.0,) * 10 + (5.0,) * 40 + (10.0,) * 10
+# Fracción central del ancho de cada lámina que se promedia en su perfil
+LEAF_FRACTION = 0.5
+# Una de cada tantas filas alcanza para el perfil medio
+PROFILE_STEP = 4
+
+PicketFence = namedtuple('PicketFence', 'leaves leaf_centers_mm pickets_mm positions_mm errors_mm magnification orientation')
+PicketFence.__doc__ = """
+Result of a picket fence analysis. Distances are in mm at the isocenter, from the central axis.
+
+Attributes:
+    leaves (numpy.ndarray): Numbers (from 1) of the analyzed leaf pairs, counted from the first row (column) of the
+        image.
+    leaf_centers_mm (numpy.ndarray): Center of each leaf pair, across the leaf travel direction.
+    pickets_mm (numpy.ndarray): Reference position of each picket: the nominal one, or the fitted line at the axis.
+    positions_mm (numpy.ndarray): Measured position of each picket on each leaf pair, (leaves, pickets). NaN where
+        no peak was found.
+    errors_mm (numpy.ndarray): Measured minus reference position, (leaves, pickets).
+    magnification (float): RTImageSID / SAD.
+    orientation (str): 'vertical' if the pickets run along the columns of the image, else 'horizontal'.
+"""
+
+
+def detect_orientation(pixel_array):
+    """
+    Returns 'vertical' if the pickets run along the columns of the image, else 'horizontal'.
+
+    The pickets are sharp edges across the leaf travel direction, so the mean profile along that direction has the
+    larger pixel to pixel differences.
+    """
+    sample = pixel_array[::PROFILE_STEP, ::PROFILE_STEP]
+    along_rows = np.diff(sample.mean(axis=0, dtype=np.float64))
+    along_columns = np.diff(sample.mean(axis=1, dtype=np.float64))
+    return 'vertical' if along_rows.std() >= along_columns.std() else 'horizontal'
+
+
+def find_pickets(profile):
+    """
+    Finds the pickets of a mean profile across them.
+
+    Args:
+        profile (numpy.ndarray): 1D profile, pickets as peaks.
+
+    Returns:
+        tuple: (centers, width). The approximate center of each picket in pixels and the median width at half
+        height, in pixels.
+
+    Raises:
+        ValueError: If there are no pickets.
+    """
+    background = np.median(profile)
+    above = profile > background + 0.5 * (profile.max() - background)
+    changes = np.diff(above.astype(np.int8), prepend=0, append=0)
+    starts, stops = np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+    keep = stops - starts >= 2
+    starts, stops = starts[keep], stops[keep]
+    if len(starts) == 0:
+        raise ValueError("No se encontraron piquetes en la imagen")
+    return (starts + stops - 1) / 2, float(np.median(stops - starts))
+
+
+def leaf_bands(n_rows, row_mm, center_row, leaf_widths=MILLENNIUM_120, fraction=LEAF_FRACTION):
+    """
+    Returns the rows averaged into the profile of each leaf pair that lies inside the image.
+
+    Args:
+        n_rows (int): Rows of the image (across the leaf travel direction).
+        row_mm (float): Row spacing at the isocenter, in mm.
+        center_row (float): Row of the central axis.
+        leaf_widths (sequence of float): Leaf widths at the isocenter, in mm, from the first row on.
+        fraction (float): Central fraction of each leaf that is averaged.
+
+    Returns:
+        tuple: (leaves, centers_mm, starts, stops). Leaf numbers (from 1), leaf centers in mm and the [start, stop)
+        rows of each leaf inside the image.
+    """
+    widths = np.asarray(leaf_widths, dtype=np.float64)
+    boundaries = np.concatenate(([0.0], np.cumsum(widths))) - widths.sum() / 2
+    centers_mm = (boundaries[:-1] + boundaries[1:]) / 2
+    centers = center_row + centers_mm / row_mm
+    half = fraction * widths / row_mm / 2
+    starts = np.ceil(centers - half).astype(np.intp)
+    stops = np.floor(centers + half).astype(np.intp) + 1
+    inside = (starts >= 0) & (stops <= n_rows) & (stops > starts)
+    return np.flatnonzero(inside) + 1, centers_mm[inside], starts[inside], stops[inside]
+
+
+def leaf_profiles(image, starts, stops):
+    """
+    Returns the mean profile of the rows [start, stop) of each leaf, (leaves, columns).
+
+    Only the rows of the leaves are read; each band is a contiguous block, summed row by row.
+    """
+    sums = np.stack([image[start:stop].sum(axis=0, dtype=np.float64) for start, stop in zip(starts, stops)])
+    return sums / (stops - starts)[:, None]
+
+
+def peak_positions(profiles, centers, width):
+    """
+    Locates each picket on each leaf profile with sub-pixel precision.
+
+    The maximum is searched within the picket width around the approximate center, and a parabola is fitted by least
+    squares to the pixels around it (a third of the width on each side); its vertex is the position.
+
+    Args:
+        profiles (numpy.ndarray): Leaf profiles (leaves, columns), pickets as peaks.
+        centers (numpy.ndarray): Approximate picket centers, in pixels (see `find_pickets`).
+        width (float): Picket width at half height, in pixels.
+
+    Returns:
+        numpy.ndarray: Positions in pixels (leaves, pickets), NaN where there is no peak.
+    """
+    n_leaves, n_columns = profiles.shape
+    spacing = np.diff(centers).min() if len(centers) > 1 else n_columns
+    half = max(int(min(1.5 * width, spacing / 2 - 1)), 2)
+    k = max(int(round(width / 3)), 1)
+
+    window_columns = np.clip(np.rint(centers).astype(np.intp)[:, None] + np.arange(-half, half + 1), 0, n_columns - 1)
+    peaks = profiles[:, window_columns].argmax(axis=2)
+    peak_columns = window_columns[np.arange(len(centers)), peaks]
+
+    x = np.arange(-k, k + 1)
+    values = profiles[np.arange(n_leaves)[:, None, None], np.clip(peak_columns[..., None] + x, 0, n_columns - 1)]
+    # Cuadrados mínimos de a*x² + b*x + c con la misma matriz para todos los piquetes
+    a, b, _ = np.moveaxis(values @ np.linalg.pinv(np.column_stack((x * x, x, np.ones_like(x)))).T, -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = -b / (2 * a)
+    vertex[(a >= 0) | ~(np.abs(vertex) <= k)] = np.nan
+    return peak_columns + vertex
+
+
+def analyze(pixel_array, spacing, sid_mm, sad_mm=SAD_MM, leaf_widths=MILLENNIUM_120, nominal_mm=None, center=None,
+            orientation=None):
+    """
+    Analyzes a picket fence image.
+
+    Args:
+        pixel_array (numpy.ndarray): The image (rows, columns), usually the output of `crop_dicom`.
+        spacing (sequence of float): (row, column) pixel spacing at the plate, in mm.
+        sid_mm (float): Source to plate distance, in mm.
+        sad_mm (float): Source to isocenter distance, in mm.
+        leaf_widths (sequence of float): Leaf widths at the isocenter, in mm.
+        nominal_mm (sequence of float, optional): Nominal picket positions at the isocenter. Each picket is compared
+            with the closest one. Without them, each picket is compared with the line fitted to it.
+        center (tuple, optional): (row, column) of the central axis. Defaults to the center of the image.
+        orientation (str, optional): 'vertical' or 'horizontal'. Detected by default (see `detect_orientation`).
+
+    Returns:
+        PicketFence: The analysis.
+
+    Raises:
+        ValueError: If there are no pickets, no whole leaf inside the image or no picket with a peak on any leaf.
+    """
+    magnification = float(sid_mm) / float(sad_mm)
+    orientation = orientation or detect_orientation(pixel_array)
+    image = pixel_array
+    spacing = [float(value) for value in spacing]
+    center = center or ((pixel_array.shape[0] - 1) / 2, (pixel_array.shape[1] - 1) / 2)
+    if orientation == 'horizontal':
+        # Los piquetes quedan como columnas y las láminas como filas
+        image, spacing, center = image.T, spacing[::-1], center[::-1]
+    row_mm, column_mm = spacing[0] / magnification, spacing[1] / magnification
+
+    profile = image[::PROFILE_STEP].mean(axis=0, dtype=np.float64)
+    # Los piquetes son picos si están más lejos del fondo que el mínimo (MONOCHROME1 los da como valles)
+    sign = 1.0 if profile.max() - np.median(profile) >= np.median(profile) - profile.min() else -1.0
+    centers, width = find_pickets(sign * profile)
+
+    leaves, leaf_centers_mm, starts, stops = leaf_bands(image.shape[0], row_mm, center[0], leaf_widths)
+    if len(leaves) == 0:
+        raise ValueError("Ninguna lámina entra completa en la imagen")
+    positions_mm = (peak_positions(sign * leaf_profiles(image, starts, stops), centers, width) - center[1]) * column_mm
+    # Un piquete sin pico en ninguna lámina no tiene posición medida ni recta: se descarta
+    measured_pickets = ~np.isnan(positions_mm).all(axis=0)
+    if not measured_pickets.any():
+        raise ValueError("Ningún piquete tiene pico en las láminas")
+    positions_mm = positions_mm[:, measured_pickets]
+
+    if nominal_mm is not None:
+        nominal = np.asarray(nominal_mm, dtype=np.float64)
+        measured = np.nanmedian(positions_mm, axis=0)
+        pickets_mm = nominal[np.abs(measured[:, None] - nominal[None, :]).argmin(axis=1)]
+        errors_mm = positions_mm - pickets_mm
+    else:
+        # Recta por piquete (cubre una placa o un colimador algo girados); las láminas sin pico no la mueven
+        filled = np.where(np.isnan(positions_mm), np.nanmedian(positions_mm, axis=0), positions_mm)
+        slope, pickets_mm = np.polyfit(leaf_centers_mm, filled, 1)
+        errors_mm = positions_mm - (np.outer(leaf_centers_mm, slope) + pickets_mm)
+    return PicketFence(leaves, leaf_centers_mm, pickets_mm, positions_mm, errors_mm, magnification, orientation)
+
+
+def analyze_dataset(dataset, sid_mm=None, **kwargs):
+    """
+    Analyzes a picket fence DICOM image, e.g. the output of `crop_dicom` or `convert_cr`.
+
+    The pixel spacing is ImagePlanePixelSpacing (or PixelSpacing), the SID RTImageSID (or `sid_mm`) and the SAD
+    RadiationMachineSAD (or SAD_MM).
+
+    Args:
+        dataset (pydicom.dataset.Dataset): The image.
+        sid_mm (float, optional): Source to plate distance in mm, if the image has no RTImageSID.
+        **kwargs: More arguments for `analyze`.
+
+    Returns:
+        PicketFence: The analysis.
+
+    Raises:
+        ValueError: If the SID or the pixel spacing are unknown, or see `analyze`.
+    """
+    spacing = dataset.get('ImagePlanePixelSpacing') or dataset.get('PixelSpacing')
+    if not spacing:
+        raise ValueError("La imagen no tiene tamaño de píxel (ImagePlanePixelSpacing/PixelSpacing)")
+    sid_mm = dataset.get('RTImageSID') or sid_mm
+    if not sid_mm:
+        raise ValueError("La imagen no tiene RTImageSID: indicar la distancia de la placa")
+    kwargs.setdefault('sad_mm', float(dataset.get('RadiationMachineSAD') or SAD_MM))
+    return analyze(dataset.pixel_array, spacing, float(sid_mm), **kwargs)
+
+
+def leaf_table(result, tolerance_mm=None):
+    """
+    Summarizes the errors of each leaf pair.
+
+    Args:
+        result (PicketFence): The analysis.
+        tolerance_mm (float, optional): Maximum absolute error allowed.
+
+    Returns:
+        list of dict: One row per leaf pair: 'leaf', 'center_mm', 'max_error_mm' (largest absolute error over the
+        pickets with a peak, NaN if none has one), 'mean_error_mm', 'no_peak' (True if some picket has no peak on the
+        leaf) and, with a tolerance, 'ok' (no measured error over the tolerance; leaves without a peak are reported
+        by 'no_peak', not here).
+    """
+    with warnings.catch_warnings():
+        # Una lámina sin ningún pico queda en NaN, sin aviso
+        warnings.simplefilter('ignore', RuntimeWarning)
+        max_errors = np.nanmax(np.abs(result.errors_mm), axis=1)
+        mean_errors = np.nanmean(result.errors_mm, axis=1)
+    rows = []
+    for leaf, center_mm, errors, max_error, mean_error in zip(result.leaves, result.leaf_centers_mm, result.errors_mm,
+                                                              max_errors, mean_errors):
+        row = {'leaf': int(leaf), 'center_mm': round(float(center_mm), 2), 'max_error_mm': round(float(max_error), 3),
+               'mean_error_mm': round(float(mean_error), 3), 'no_peak': bool(np.isnan(errors).any())}
+        if tolerance_mm is not None:
+            row['ok'] = not max_error > tolerance_mm
+        rows.append(row)
+    return rows
+
+
+def write_csv(path, results):
+    """
+    Writes the per-leaf errors of several images to a CSV file.
+
+    Args:
+        path (str): The CSV file.
+        results (list of tuple): (file, PicketFence) pairs.
+    """
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        n_pickets = max((len(result.pickets_mm) for _, result in results), default=0)
+        writer.writerow(['archivo', 'lamina', 'centro_mm'] + [f'piquete_{index + 1}_mm' for index in range(n_pickets)])
+        for file, result in results:
+            for leaf, center_mm, errors in zip(result.leaves, result.leaf_centers_mm, result.errors_mm):
+                writer.writerow([file, int(leaf), f'{center_mm:.2f}'] +
+                                ['' if math.isnan(error) else f'{error:.3f}' for error in errors])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Análisis de picket fence de placas CR.")
+    parser.add_argument('files', nargs='+', help="Placas CR o patrones glob")
+    parser.add_argument('--sid', type=float, default=None, help="Distancia de la placa CR en cm, si la imagen no trae RTImageSID")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Error máximo por lámina en mm")
+    parser.add_argument('--nominal', type=float, nargs='+', help="Posiciones nominales de los piquetes en mm (por defecto, recta ajustada)")
+    parser.add_argument('--csv', help="Guardar los errores por lámina y piquete en este CSV")
+    args = parser.parse_args(argv)
+
+    from pf_con_chasisMOD import crop_dicom
+
+    paths = sorted({path for pattern in args.files for path in glob.glob(pattern)})
+    analyzed = []
+    n_failed = 0
+    for path in paths:
+        try:
+            cropped = crop_dicom(path)
+            start = time.perf_counter()
+            result = analyze_dataset(cropped, args.sid * 10 if args.sid else None, nominal_mm=args.nominal)
+            seconds = time.perf_counter() - start
+        except Exception as error:
+            print(f"ERROR  {path}: {type(error).__name__}: {error}", file=sys.stderr, flush=True)
+            n_failed += 1
+            continue
+        analyzed.append((path, result))
+        rows = leaf_table(result, args.tolerance)
+        out = [row['leaf'] for row in rows if not row['ok']]
+        no_peak = [row['leaf'] for row in rows if row['no_peak']]
+        worst = max((row['max_error_mm'] for row in rows if not math.isnan(row['max_error_mm'])), default=float('nan'))
+        print(f"{'OK' if not out and not no_peak else 'FALLA':<6} {path}: {len(rows)} láminas, "
+              f"{len(result.pickets_mm)} piquetes, error máx. {worst:.3f} mm ({seconds * 1000:.1f} ms)", flush=True)
+        if out:
+            print(f"       Láminas fuera de tolerancia: {', '.join(map(str, out))}", flush=True)
+        if no_peak:
+            print(f"       Láminas sin pico en algún piquete: {', '.join(map(str, no_peak))}", flush=True)
+        if out or no_peak:
+            n_failed += 1
+    if args.csv:
+        write_csv(args.csv, analyzed)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
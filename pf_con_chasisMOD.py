@@ -1,35 +1,189 @@
+import importlib
 import os
 import sys
+import threading
 import tkinter as tk
 from tkinter import simpledialog, filedialog, messagebox
-import pydicom
-import numpy as np
 
+import perf_trace
+
+# pydicom y numpy (y los módulos que los usan) se importan recién al usarlos: tardan más que el resto
+# del arranque y el primer diálogo no los necesita. `preload_in_background` los importa mientras el
+# usuario elige el archivo.
+HEAVY_MODULES = ('numpy', 'pydicom', 'pydicom.dataset', 'pydicom.uid', 'autocrop', 'resample', 'dcm_compress')
+# Compresión sin pérdida de las imágenes para QATrack: 'rle', 'deflated' o sin comprimir (ver `dcm_compress`)
+CR_COMPRESSION = os.environ.get('MODIFDCM_CR_COMPRESSION') or None
+
+def preload_in_background():
+    """Importa HEAVY_MODULES en un hilo aparte y devuelve el hilo."""
+    thread = threading.Thread(target=_preload, name='preload', daemon=True)
+    thread.start()
+    return thread
+
+def _preload():
+    with perf_trace.span('importacion', modules=list(HEAVY_MODULES)):
+        for name in HEAVY_MODULES:
+            importlib.import_module(name)
+
+@perf_trace.traced()
 def crop_dicom(file_path):
+    import pydicom
+    import autocrop
+    import dcm_compress
+
     # Leer archivo DICOM seleccionado
-    dicom_info = pydicom.dcmread(file_path)
+    with perf_trace.span('lectura', path=file_path, file_bytes=os.path.getsize(file_path)):
+        dicom_info = pydicom.dcmread(file_path)
 
     # Extraer la matriz de píxeles
     pixel_array = dicom_info.pixel_array
 
-    # Seleccionar la columna central
-    central_column = pixel_array[:, pixel_array.shape[1] // 2]
-
-    # Filtrar las filas cuyos píxeles sean menores a 1000 o iguales a 4095
-    filtered_indices = np.where((central_column >= 1000) & (central_column != 4095))[0]
+    # Buscar la zona expuesta con los perfiles de filas y columnas de toda la imagen
+    # (sin sub-exposición ni saturación, según la profundidad de bits)
+    bits_stored = getattr(dicom_info, 'BitsStored', 12)
+    rows, columns = autocrop.find_exposed_region(pixel_array, bits_stored=bits_stored)
 
-    # Crear una nueva imagen recortada
-    cropped_image = pixel_array[filtered_indices, :]
+    # Crear una nueva imagen recortada (vista, sin copia)
+    cropped_image = pixel_array[rows, columns]
 
     # Crear un nuevo objeto FileDataset para la imagen recortada
     cropped_dicom_info = dicom_info.copy()
-    cropped_dicom_info.PixelData = cropped_image.tobytes()
+    # Sin comprimir: si la placa venía comprimida, también cambia la sintaxis de transferencia
+    dcm_compress.set_pixel_data(cropped_dicom_info, cropped_image)
     cropped_dicom_info.Rows, cropped_dicom_info.Columns = cropped_image.shape
 
     # Devolver el objeto DICOM recortado
     return cropped_dicom_info
 
-def CR2DCM_v2(dicom_info, output_dir, original_filename):
+def _centered_window(size, size_keep):
+    """Returns the slice of the centered `size_keep` pixels of an axis of `size` pixels, clamped to the axis."""
+    start = max((size - size_keep) // 2, 0)
+    return slice(start, min(start + size_keep, size))
+
+def qatrack_filename(original_filename):
+    """Devuelve el nombre del archivo convertido para QATrack: <nombre>-a_QATrack.dcm."""
+    return os.path.splitext(original_filename)[0] + '-a_QATrack.dcm'
+
+class CRConversionSession:
+    """
+    Convierte imágenes CR sobre la base PF-noborrar.dcm, leyendo la base una sola vez.
+
+    La base leída queda como copia maestra que nunca se modifica. Cada imagen recibe una copia liviana del
+    encabezado: comparte los elementos de la base y sólo reemplaza Rows/Columns, ImagePlanePixelSpacing,
+    RTImageSID, PixelData y los UIDs de la instancia, así se puede usar desde varios hilos a la vez.
+
+    Args:
+        base_path (str, optional): Ruta de la base. Por defecto, PF-noborrar.dcm del directorio de recursos.
+
+    Attributes:
+        series_uid (str): SeriesInstanceUID de todas las imágenes convertidas en la sesión.
+    """
+
+    def __init__(self, base_path=None):
+        import pydicom
+        from pydicom.uid import generate_uid
+
+        base_path = base_path or os.path.join(get_resource_path(), 'PF-noborrar.dcm')
+        with perf_trace.span('carga_plantilla', template=base_path):
+            master = pydicom.dcmread(base_path)
+        master.pop('PixelData', None)
+        # Convertir de una vez todos los elementos crudos, para que las copias no lo repitan
+        for _ in master:
+            pass
+        self._master = master
+        self._preamble = master.preamble
+        self._file_meta = master.file_meta
+        self._transfer_syntax = master.file_meta.TransferSyntaxUID
+        self.series_uid = generate_uid()
+
+    def new_dataset(self, filename=''):
+        """
+        Devuelve una copia del encabezado de la base con UIDs nuevos, sin PixelData.
+
+        Args:
+            filename (str): Nombre asociado a la copia.
+
+        Returns:
+            pydicom.dataset.FileDataset: La copia. Sus elementos son los de la base: se reemplazan, no se modifican.
+        """
+        from pydicom.dataset import FileDataset, FileMetaDataset
+        from pydicom.uid import generate_uid
+
+        sop_instance_uid = generate_uid()
+        file_meta = FileMetaDataset()
+        for elem in self._file_meta:
+            file_meta.add(elem)
+        file_meta.add_new('MediaStorageSOPInstanceUID', 'UI', sop_instance_uid)
+
+        image = FileDataset(filename, dict(self._master.items()), preamble=self._preamble, file_meta=file_meta,
+                            is_implicit_VR=self._transfer_syntax.is_implicit_VR,
+                            is_little_endian=self._transfer_syntax.is_little_endian)
+        image.add_new('SOPInstanceUID', 'UI', sop_instance_uid)
+        image.add_new('SeriesInstanceUID', 'UI', self.series_uid)
+        return image
+
+    @perf_trace.traced('convert_cr')
+    def convert(self, dicom_info, SID, bin_factor=2, compression=None):
+        """
+        Arma la imagen para QATrack a partir de una imagen CR recortada, sin interfaz.
+
+        Args:
+            dicom_info (pydicom.dataset.FileDataset): La imagen CR recortada (ver `crop_dicom`).
+            SID (float): Distancia fuente-placa CR en mm.
+            bin_factor (int): Factor de binning (promedio de bloques bin_factor x bin_factor) de la imagen.
+            compression (str, optional): 'rle' o 'deflated' para guardar los píxeles comprimidos sin pérdida.
+
+        Returns:
+            pydicom.dataset.FileDataset: La imagen convertida.
+        """
+        import dcm_compress
+        import resample
+
+        H, W = dicom_info.Rows, dicom_info.Columns
+        spacing = [float(value) for value in dicom_info.PixelSpacing]
+        Hn = int(220 * (SID / 100) / spacing[0])
+        Wn = int(220 * (SID / 100) / spacing[1])
+
+        # Ventana centrada de Hn x Wn recortada a los límites de la imagen, y binning por promedio de bloques
+        # (el diezmado [::2, ::2] descartaba 3 de cada 4 píxeles)
+        rows, columns = _centered_window(H, Hn), _centered_window(W, Wn)
+        CRn = resample.bin_image(dicom_info.pixel_array[rows, columns], bin_factor)
+
+        # add_new reemplaza el elemento: asignar el atributo cambiaría el de la base compartida
+        Basen = self.new_dataset()
+        Basen.add_new('RTImageSID', 'DS', SID)
+        Basen.add_new('Rows', 'US', CRn.shape[0])
+        Basen.add_new('Columns', 'US', CRn.shape[1])
+        Basen.add_new('ImagePlanePixelSpacing', 'DS', [spacing[0] * bin_factor, spacing[1] * bin_factor])
+        dcm_compress.set_pixel_data(Basen, CRn, compression)
+        return Basen
+
+_session = None
+
+def get_session():
+    """Devuelve la sesión de conversión del proceso, creándola la primera vez."""
+    global _session
+    if _session is None:
+        _session = CRConversionSession()
+    return _session
+
+def convert_cr(dicom_info, SID, bin_factor=2, session=None, compression=None):
+    """
+    Arma la imagen para QATrack a partir de una imagen CR recortada, sin interfaz.
+
+    Args:
+        dicom_info (pydicom.dataset.FileDataset): La imagen CR recortada (ver `crop_dicom`).
+        SID (float): Distancia fuente-placa CR en mm.
+        bin_factor (int): Factor de binning (promedio de bloques bin_factor x bin_factor) de la imagen.
+        session (CRConversionSession, optional): Sesión a usar. Por defecto, la del proceso (ver `get_session`).
+        compression (str, optional): 'rle' o 'deflated' para guardar los píxeles comprimidos sin pérdida.
+
+    Returns:
+        pydicom.dataset.FileDataset: La imagen convertida, sobre la base PF-noborrar.dcm.
+    """
+    return (session or get_session()).convert(dicom_info, SID, bin_factor, compression)
+
+def CR2DCM_v2(dicom_info, output_dir, original_filename, bin_factor=2, SID=None, compression=CR_COMPRESSION):
     """
     Modifica el archivo DICOM según las especificaciones dadas y lo guarda.
 
@@ -37,42 +191,28 @@ def CR2DCM_v2(dicom_info, output_dir, original_filename):
         dicom_info (pydicom.dataset.FileDataset): El objeto DICOM que contiene la información.
         output_dir (str): El directorio donde se guardará el archivo modificado.
         original_filename (str): El nombre del archivo original.
+        bin_factor (int): Factor de binning (promedio de bloques bin_factor x bin_factor) de la imagen.
+        SID (float, optional): Distancia de la placa CR en mm. Si no se da, se le pide al usuario.
+        compression (str, optional): 'rle' o 'deflated'. Por defecto, MODIFDCM_CR_COMPRESSION (sin comprimir si no está).
     """
-    # Localizar PF-noborrar.dcm en el directorio correcto
-    base_path = os.path.join(get_resource_path(), 'PF-noborrar.dcm')
-    Base = pydicom.dcmread(base_path)
-
-    # Pedir al usuario la distancia de la placa CR
-    root = tk.Tk()
-    root.withdraw()
-    SID = simpledialog.askstring("Distancia CR", "Ingrese la distancia de la placa CR (cm):", initialvalue="153")
-    if not SID:
-        print('User pressed cancel')
-        return
-    SID = float(SID) * 10
-
-    # Actualizar los atributos en el objeto Base
-    Base.ImagePlanePixelSpacing = dicom_info.PixelSpacing
-    Base.RTImageSID = SID
-    H, W = dicom_info.Rows, dicom_info.Columns
-    spacing = dicom_info.PixelSpacing
-    Basen = Base
-    Hn = int(220 * (SID / 100) / spacing[0])
-    Wn = int(220 * (SID / 100) / spacing[1])
-
-    try:
-        CRn = dicom_info.pixel_array[int(0.5 * (H - Hn)) + 1 : int(0.5 * (H + Hn)) : 2, int(0.5 * (W - Wn)) + 1 : int(0.5 * (W + Wn)) : 2]
-    except:
-        CRn = dicom_info.pixel_array[0:H:2, 0:W:2]
-
-    Basen.Rows, Basen.Columns = CRn.shape
-    Basen.ImagePlanePixelSpacing = [spacing[0] * 2, spacing[1] * 2]  # Asignar una lista de dos floats
+    if SID is None:
+        # Pedir al usuario la distancia de la placa CR
+        root = tk.Tk()
+        root.withdraw()
+        with perf_trace.wait('dialogo_sid'):
+            SID = simpledialog.askstring("Distancia CR", "Ingrese la distancia de la placa CR (cm):", initialvalue="153")
+        if not SID:
+            print('User pressed cancel')
+            return
+        SID = float(SID) * 10
+
+    Basen = convert_cr(dicom_info, SID, bin_factor, compression=compression)
 
     # Guardar el archivo DICOM modificado en el directorio especificado
-    modified_filename = os.path.splitext(original_filename)[0] + '-a_QATrack.dcm'
-    output_file = os.path.join(output_dir, modified_filename)
-    Basen.PixelData = CRn.tobytes()
-    Basen.save_as(output_file)
+    output_file = os.path.join(output_dir, qatrack_filename(original_filename))
+    with perf_trace.span('escritura', path=output_file):
+        Basen.save_as(output_file)
+        perf_trace.annotate(bytes_written=os.path.getsize(output_file))
     print(f"Archivo DICOM modificado guardado en {output_file}")
 
 def get_resource_path():
@@ -83,9 +223,11 @@ def get_resource_path():
 
 def main():
     # Primero recortar la imagen
+    preload_in_background()
     root = tk.Tk()
     root.withdraw()
-    file_path = filedialog.askopenfilename(filetypes=[('DICOM Files', '*.dcm')])
+    with perf_trace.wait('dialogo_archivo'):
+        file_path = filedialog.askopenfilename(filetypes=[('DICOM Files', '*.dcm')])
     if file_path:
         directory, original_filename = os.path.split(file_path)
         cropped_dicom = crop_dicom(file_path)
@@ -94,7 +236,8 @@ def main():
             output_dir = directory
             # Luego modificar el archivo recortado y guardarlo en el directorio especificado
             CR2DCM_v2(cropped_dicom, output_dir, original_filename)
-            messagebox.showinfo("Éxito", f"Archivo DICOM modificado guardado en {directory}")
+            with perf_trace.wait('dialogo_listo'):
+                messagebox.showinfo("Éxito", f"Archivo DICOM modificado guardado en {directory}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+# -*- mode: python ; coding: utf-8 -*-
+# Variante de pf_con_chasisMOD.spec para arranque rápido: carpeta (onedir) en lugar de un único EXE,
+# sin UPX. El EXE de un archivo descomprime todo en un temporal en cada arranque y UPX suma la
+# descompresión de cada DLL (y más escaneos del antivirus). Se excluyen paquetes que pydicom/numpy
+# pueden arrastrar pero que la conversión no usa.
+#
+#   pyinstaller pf_con_chasisMOD_onedir.spec   ->   dist/pf_con_chasisMOD/pf_con_chasisMOD.exe
+
+
+a = Analysis(
+    ['pf_con_chasisMOD.py'],
+    pathex=[],
+    binaries=[],
+    datas=[('PF-noborrar.dcm', '.')],
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=[
+        'matplotlib',
+        'pandas',
+        'scipy',
+        'IPython',
+        'pytest',
+        'setuptools',
+        'numpy.f2py',
+        'numpy.distutils',
+        'tkinter.test',
+    ],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='pf_con_chasisMOD',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+    icon=['pf.ico'],
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='pf_con_chasisMOD',
+)
@@ -0,0 +1,404 @@
+"""
+Conversión automática de las placas CR que llegan a una o más carpetas.
+
+Revisa periódicamente las carpetas, espera a que cada archivo .dcm nuevo deje de
+crecer (el lector CR lo puede estar escribiendo todavía) y lo convierte con
+`crop_dicom` + `convert_cr` en un pool de procesos. La salida
+<nombre>-a_QATrack.dcm se escribe en un temporal y se renombra con os.replace,
+así QATrack nunca ve un archivo a medio escribir.
+
+Cada carpeta lleva un diario (.pf_watch_procesados.jsonl) con los archivos ya
+convertidos (nombre, tamaño y fecha de modificación), así al reiniciar no se
+vuelven a convertir; si un archivo se reemplaza por otro, se convierte de nuevo.
+Los que fallan (bloqueados, a medio escribir, disco lleno) no se anotan: se
+reintentan hasta MAX_ATTEMPTS veces con esperas crecientes, y otra vez al
+reiniciar. Si se cae un proceso del pool, se informa y se arma un pool nuevo.
+
+La distancia de la placa (SID) es la de --sid, o la de un pf_watch.json en la
+carpeta:
+
+    {"sid_cm": 150, "output_dir": "C:/QATrack/entrada", "bin_factor": 2, "compression": "rle"}
+
+"compression" ("rle" o "deflated", ver `dcm_compress`) es la de --compression si
+la carpeta no la indica. Con --tolerance (o "tolerance_mm" en pf_watch.json) cada
+placa recortada pasa además por el análisis de picket fence (ver `pf_analysis`)
+y el resultado informa el error máximo, las láminas fuera de tolerancia y las
+láminas en las que algún piquete no tiene pico.
+
+Con --upload, cada imagen convertida se sube además a QATrack+ (ver
+`qatrack_upload`).
+
+Uso:
+    python pf_watch.py "C:/CR/export" --sid 153 -j 4
+"""
+import argparse
+import functools
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import perf_trace
+from pf_con_chasisMOD import convert_cr, crop_dicom, qatrack_filename
+
+CONFIG_NAME = 'pf_watch.json'
+JOURNAL_NAME = '.pf_watch_procesados.jsonl'
+OUTPUT_SUFFIX = '-a_QATrack.dcm'
+DEFAULT_SID_CM = 153
+# Intentos por archivo en una corrida; la espera antes de cada reintento se duplica desde RETRY_DELAY segundos
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30.0
+
+
+def load_folder_config(folder, default_sid_cm=DEFAULT_SID_CM, default_compression=None, default_tolerance_mm=None):
+    """
+    Reads the pf_watch.json of a folder, if any.
+
+    Args:
+        folder (str): The watched folder.
+        default_sid_cm (float): SID used when the folder has no configuration.
+        default_compression (str, optional): Compression used when the folder does not set one.
+        default_tolerance_mm (float, optional): Picket fence tolerance used when the folder does not set one.
+
+    Returns:
+        dict: 'sid_mm', 'output_dir', 'bin_factor', 'compression' and 'tolerance_mm' for the files of the folder.
+    """
+    config = {}
+    config_path = os.path.join(folder, CONFIG_NAME)
+    if os.path.isfile(config_path):
+        with open(config_path, 'r', encoding='utf-8') as config_file:
+            config = json.load(config_file)
+        if not isinstance(config, dict):
+            raise ValueError("se esperaba un objeto JSON")
+    return {
+        'sid_mm': float(config.get('sid_cm', default_sid_cm)) * 10,
+        'output_dir': config.get('output_dir') or folder,
+        'bin_factor': int(config.get('bin_factor', 2)),
+        'compression': config.get('compression', default_compression),
+        'tolerance_mm': config.get('tolerance_mm', default_tolerance_mm),
+    }
+
+
+class Journal:
+    """
+    Append-only record of the files of a folder that were already converted.
+
+    Args:
+        path (str): Path of the journal file (JSON lines).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Última línea cortada por un corte de luz
+                        continue
+                    # Los diarios viejos también anotaban los errores: ésos se vuelven a intentar
+                    if entry.get('status', 'ok') == 'ok':
+                        self._done.add((entry['name'], entry['size'], entry['mtime_ns']))
+
+    def __contains__(self, key):
+        return key in self._done
+
+    def record(self, key, result):
+        """
+        Marks a file as converted.
+
+        Args:
+            key (tuple): (name, size, mtime_ns) of the source file.
+            result (dict): As returned by `convert_file`, with status 'ok'.
+        """
+        name, size, mtime_ns = key
+        entry = dict(result, name=name, size=size, mtime_ns=mtime_ns)
+        with open(self.path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._done.add(key)
+
+
+def convert_file(path, sid_mm, output_dir, bin_factor=2, compression=None, tolerance_mm=None):
+    """
+    Converts one CR file and writes its output atomically. Never raises: errors are reported in the result.
+
+    Args:
+        path (str): The CR file.
+        sid_mm (float): Source to CR plate distance in mm.
+        output_dir (str): Directory of the output.
+        bin_factor (int): Binning factor, see `convert_cr`.
+        compression (str, optional): 'rle' or 'deflated' to write the pixels losslessly compressed.
+        tolerance_mm (float, optional): With a tolerance, the cropped image is also analyzed as a picket fence.
+
+    Returns:
+        dict: 'file', 'output', 'status' ('ok' or 'error'), 'error' and 'seconds'. With a tolerance, also
+        'max_error_mm', 'leaves_out' (leaf pairs over the tolerance) and 'leaves_no_peak' (leaf pairs where some
+        picket has no peak), or 'analysis_error' if the analysis failed (the conversion is still done).
+    """
+    start = time.perf_counter()
+    output = os.path.join(output_dir, qatrack_filename(os.path.basename(path)))
+    result = {'file': path, 'output': output, 'status': 'ok', 'error': None}
+    try:
+        cropped = crop_dicom(path)
+        if tolerance_mm is not None:
+            result.update(_analyze(cropped, sid_mm, tolerance_mm))
+        converted = convert_cr(cropped, sid_mm, bin_factor, compression=compression)
+        temporary = output + '.tmp'
+        with perf_trace.span('escritura', path=output):
+            converted.save_as(temporary)
+            os.replace(temporary, output)
+            perf_trace.annotate(bytes_written=os.path.getsize(output))
+    except Exception as error:
+        result['status'] = 'error'
+        result['error'] = f"{type(error).__name__}: {error}"
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def _analyze(cropped, sid_mm, tolerance_mm):
+    """Picket fence summary of a cropped image, for the result of `convert_file`."""
+    import pf_analysis
+
+    with perf_trace.span('analisis_pf'):
+        try:
+            rows = pf_analysis.leaf_table(pf_analysis.analyze_dataset(cropped, sid_mm), tolerance_mm)
+        except ValueError as error:
+            return {'analysis_error': str(error)}
+    errors = [row['max_error_mm'] for row in rows if not math.isnan(row['max_error_mm'])]
+    return {'max_error_mm': max(errors, default=None), 'leaves_out': [row['leaf'] for row in rows if not row['ok']],
+            'leaves_no_peak': [row['leaf'] for row in rows if row['no_peak']]}
+
+
+class FolderWatcher:
+    """
+    Polls folders for new CR files and converts them on a process pool.
+
+    Args:
+        folders (list of str): The folders to watch.
+        default_sid_cm (float): SID for the folders without pf_watch.json.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        interval (float): Seconds between scans.
+        settle (float): Seconds a file must keep the same size and modification time before it is converted.
+        progress (callable, optional): Called with each result.
+        default_compression (str, optional): Compression for the folders whose pf_watch.json does not set one.
+        default_tolerance_mm (float, optional): Picket fence tolerance for the folders whose pf_watch.json does not
+            set one. Without a tolerance the images are not analyzed.
+    """
+
+    def __init__(self, folders, default_sid_cm=DEFAULT_SID_CM, max_workers=None, interval=1.0, settle=2.0, progress=None,
+                 default_compression=None, default_tolerance_mm=None):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.default_sid_cm = default_sid_cm
+        self.default_compression = default_compression
+        self.default_tolerance_mm = default_tolerance_mm
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.interval = interval
+        self.settle = settle
+        self.progress = progress
+        self.journals = {folder: Journal(os.path.join(folder, JOURNAL_NAME)) for folder in self.folders}
+        # Ruta -> (tamaño, mtime_ns, desde cuándo no cambia)
+        self._candidates = {}
+        self._in_flight = {}
+        # Ruta -> (clave, intentos, cuándo se puede reintentar) de los archivos que fallaron
+        self._failures = {}
+        # Carpeta -> última configuración válida y último error de su pf_watch.json
+        self._configs = {}
+        self._config_errors = {}
+
+    def scan(self):
+        """
+        Lists the files that are ready to convert: new, not in the journal and stable for `settle` seconds.
+
+        Returns:
+            list of tuple: (folder, path, key) of each ready file.
+        """
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for folder in self.folders:
+            journal = self.journals[folder]
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if not name.lower().endswith('.dcm') or name.endswith(OUTPUT_SUFFIX) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    key = (name, stat.st_size, stat.st_mtime_ns)
+                    if key in journal or entry.path in self._in_flight:
+                        continue
+                    failure = self._failures.get(entry.path)
+                    if failure is not None and failure[0] == key and (failure[1] >= MAX_ATTEMPTS or now < failure[2]):
+                        continue
+                    seen.add(entry.path)
+                    previous = self._candidates.get(entry.path)
+                    if previous is None or previous[:2] != key[1:]:
+                        self._candidates[entry.path] = (stat.st_size, stat.st_mtime_ns, now)
+                    elif now - previous[2] >= self.settle:
+                        ready.append((folder, entry.path, key))
+        # Olvidar los candidatos que desaparecieron
+        for path in set(self._candidates) - seen:
+            del self._candidates[path]
+        return ready
+
+    def run(self, once=False):
+        """
+        Watches the folders until interrupted.
+
+        Args:
+            once (bool): Stop when every file present has been converted, instead of watching forever.
+        """
+        pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = {}
+            while True:
+                configs = self.load_configs()
+                for folder, path, key in self.scan():
+                    # Cola acotada: no se encolan más de dos archivos por proceso
+                    if len(futures) >= 2 * self.max_workers:
+                        break
+                    del self._candidates[path]
+                    config = configs[folder]
+                    os.makedirs(config['output_dir'], exist_ok=True)
+                    future = pool.submit(convert_file, path, config['sid_mm'], config['output_dir'], config['bin_factor'],
+                                         config['compression'], config['tolerance_mm'])
+                    futures[future] = (folder, path, key)
+                    self._in_flight[path] = future
+
+                if futures:
+                    done, _ = wait(futures, timeout=self.interval, return_when=FIRST_COMPLETED)
+                    broken = False
+                    for future in done:
+                        folder, path, key = futures.pop(future)
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool as error:
+                            # Proceso del pool caído (p. ej. sin memoria): fallan todos los archivos en curso
+                            broken = True
+                            result = {'file': path, 'output': None, 'status': 'error', 'error': f"{type(error).__name__}: {error}"}
+                        del self._in_flight[path]
+                        self._finished(folder, path, key, result)
+                    if broken:
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool = ProcessPoolExecutor(max_workers=self.max_workers)
+                elif once and not self._candidates:
+                    return
+                else:
+                    time.sleep(self.interval)
+        finally:
+            pool.shutdown(wait=True)
+
+    def load_configs(self):
+        """
+        Reads the configuration of every folder, keeping the last valid one of a folder whose pf_watch.json is invalid.
+
+        A pf_watch.json being saved, or with an error, is reported once and does not stop the watcher; until it is
+        fixed the folder keeps its previous configuration (the defaults if it never had a valid one).
+
+        Returns:
+            dict: Folder -> configuration, as returned by `load_folder_config`.
+        """
+        for folder in self.folders:
+            try:
+                self._configs[folder] = load_folder_config(folder, self.default_sid_cm, self.default_compression,
+                                                           self.default_tolerance_mm)
+                self._config_errors.pop(folder, None)
+            except (ValueError, TypeError, OSError) as error:
+                message = f"{type(error).__name__}: {error}"
+                if self._config_errors.get(folder) != message:
+                    self._config_errors[folder] = message
+                    print(f"ERROR  {os.path.join(folder, CONFIG_NAME)}: {message} (se sigue usando la configuración anterior)",
+                          file=sys.stderr, flush=True)
+                self._configs.setdefault(folder, {
+                    'sid_mm': float(self.default_sid_cm) * 10,
+                    'output_dir': folder,
+                    'bin_factor': 2,
+                    'compression': self.default_compression,
+                    'tolerance_mm': self.default_tolerance_mm,
+                })
+        return dict(self._configs)
+
+    def _finished(self, folder, path, key, result):
+        """Journals a converted file, or schedules the retry of a failed one, and reports the result."""
+        if result['status'] == 'ok':
+            self._failures.pop(path, None)
+            self.journals[folder].record(key, result)
+        else:
+            failure = self._failures.get(path)
+            attempts = failure[1] + 1 if failure is not None and failure[0] == key else 1
+            self._failures[path] = (key, attempts, time.monotonic() + RETRY_DELAY * 2 ** (attempts - 1))
+        if self.progress is not None:
+            self.progress(result)
+
+
+def _print_result(result):
+    if result['status'] == 'ok':
+        print(f"OK     {result['file']} -> {result['output']} ({result['seconds']} s)", flush=True)
+        if result.get('analysis_error'):
+            print(f"       Picket fence: {result['analysis_error']}", flush=True)
+        elif 'leaves_out' in result:
+            out, no_peak = result['leaves_out'], result.get('leaves_no_peak')
+            max_error = result['max_error_mm']
+            print(f"       Picket fence: error máx. {'-' if max_error is None else f'{max_error:.3f}'} mm"
+                  + (f", láminas fuera de tolerancia: {', '.join(map(str, out))}" if out else "")
+                  + (f", láminas sin pico: {', '.join(map(str, no_peak))}" if no_peak else ""), flush=True)
+    else:
+        print(f"ERROR  {result['file']}: {result['error']}", file=sys.stderr, flush=True)
+
+
+def _print_and_upload(uploader, result):
+    _print_result(result)
+    if result['status'] == 'ok':
+        try:
+            uploader.submit(result['output'])
+        except OSError as error:
+            # La salida ya no está (p. ej. la movió QATrack): se informa y se sigue vigilando
+            print(f"ERROR  {result['output']}: no se pudo encolar la subida: {type(error).__name__}: {error}",
+                  file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversión automática de placas CR a imágenes para QATrack.")
+    parser.add_argument('folders', nargs='+', help="Carpetas donde el lector CR deja las imágenes")
+    parser.add_argument('--sid', type=float, default=DEFAULT_SID_CM, help="Distancia de la placa CR en cm, si la carpeta no tiene pf_watch.json")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Cantidad de procesos (por defecto, uno por núcleo)")
+    parser.add_argument('--interval', type=float, default=1.0, help="Segundos entre revisiones de las carpetas")
+    parser.add_argument('--settle', type=float, default=2.0, help="Segundos sin cambios antes de convertir un archivo")
+    parser.add_argument('--once', action='store_true', help="Convertir lo que haya y terminar")
+    parser.add_argument('--compression', choices=('rle', 'deflated'), help="Comprimir sin pérdida las imágenes convertidas")
+    parser.add_argument('--tolerance', type=float, default=None, help="Analizar el picket fence con esta tolerancia en mm (ver pf_analysis)")
+    parser.add_argument('--upload', action='store_true', help="Subir las imágenes convertidas a QATrack+ (ver qatrack_upload)")
+    args = parser.parse_args(argv)
+
+    uploader = None
+    if args.upload:
+        import qatrack_upload
+        try:
+            config = qatrack_upload.load_config()
+        except (FileNotFoundError, ValueError) as error:
+            print(f"Configuración de QATrack+ inválida: {error}", file=sys.stderr)
+            return 2
+        uploader = qatrack_upload.Uploader(config, progress=qatrack_upload._print_result)
+        # Lo que quedó pendiente de una corrida anterior sale junto con lo nuevo
+        uploader.resume()
+    progress = _print_result if uploader is None else functools.partial(_print_and_upload, uploader)
+
+    watcher = FolderWatcher(args.folders, args.sid, args.jobs, args.interval, args.settle, progress=progress,
+                           default_compression=args.compression, default_tolerance_mm=args.tolerance)
+    print(f"Vigilando {', '.join(watcher.folders)} (Ctrl+C para terminar)", flush=True)
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        print("Terminado.")
+    finally:
+        if uploader is not None:
+            uploader.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Catálogo SQLite de los planes exportados.
+
+Lee sólo el encabezado de cada plan (sin píxeles y sin leer los valores
+grandes, como el XML del bloque ExtendedIF) y guarda en una base SQLite los
+UIDs, el equipo, los campos (nombre, ángulos de gantry y colimador del primer
+punto de control, tabla de tolerancia y RTImageSID) y si el plan tiene el
+bloque ExtendedIF. Volver a indexar sólo lee los archivos nuevos o cambiados
+(ruta + mtime + tamaño) y borra los que ya no están.
+
+Las consultas devuelven rutas, que se pueden pasar directo al modo batch:
+
+    python plan_catalog.py index "C:/QA/planes" -r
+    python plan_catalog.py query --machine QBA_600CD_523 --tolerance-not T_QA
+    python plan_catalog.py query --machine QBA_600CD_523 --paths | python batch_modifDICOM.py reglas.json -
+
+La base por defecto es ~/.modificadorDCM/catalogo.sqlite (o MODIFDCM_CATALOG).
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+CATALOG_PATH = os.environ.get('MODIFDCM_CATALOG') or os.path.join(os.path.expanduser('~'), '.modificadorDCM', 'catalogo.sqlite')
+
+# Con menos archivos que esto, leerlos en un pool de procesos no compensa arrancarlo
+POOL_THRESHOLD = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sop_instance_uid TEXT,
+    study_instance_uid TEXT,
+    series_instance_uid TEXT,
+    plan_label TEXT,
+    patient_id TEXT,
+    n_beams INTEGER,
+    has_extended_if INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS beams (
+    path TEXT NOT NULL REFERENCES plans(path) ON DELETE CASCADE,
+    beam_number INTEGER,
+    beam_name TEXT,
+    machine_name TEXT,
+    gantry_angle REAL,
+    collimator_angle REAL,
+    tolerance_table_number INTEGER,
+    tolerance_table_label TEXT,
+    rtimage_sid REAL
+);
+CREATE INDEX IF NOT EXISTS beams_path ON beams(path);
+CREATE INDEX IF NOT EXISTS beams_machine ON beams(machine_name);
+CREATE INDEX IF NOT EXISTS beams_tolerance ON beams(tolerance_table_label);
+CREATE INDEX IF NOT EXISTS plans_series ON plans(series_instance_uid);
+"""
+
+
+def connect(path=None):
+    """
+    Opens (creating it if needed) the catalog database.
+
+    Args:
+        path (str, optional): Path of the database. Defaults to CATALOG_PATH.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    path = path or CATALOG_PATH
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _number(value):
+    return float(value) if value is not None and value != '' else None
+
+
+def _sql(value):
+    """Converts a pydicom value (IS, DS, UID, PersonName...) to a plain SQLite value."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+
+
+def read_plan_header(path):
+    """
+    Reads the catalog fields of one plan. Runs in a worker process and never raises.
+
+    Args:
+        path (str): Path of the plan.
+
+    Returns:
+        tuple: (plan row, list of beam rows), as inserted in the `plans` and `beams` tables.
+    """
+    import pydicom
+
+    stat = os.stat(path)
+    try:
+        dicom_info = pydicom.dcmread(path, force=True, stop_before_pixels=True, defer_size='1 KB')
+    except Exception as error:
+        return (path, stat.st_mtime_ns, stat.st_size, None, None, None, None, None, None, None,
+                f"{type(error).__name__}: {error}"), []
+
+    tolerance_labels = {}
+    for tolerance_table in dicom_info.get('ToleranceTableSequence', []):
+        tolerance_labels[tolerance_table.get('ToleranceTableNumber')] = tolerance_table.get('ToleranceTableLabel')
+
+    beams = []
+    for beam in dicom_info.get('BeamSequence', []):
+        control_points = beam.get('ControlPointSequence') or [{}]
+        first = control_points[0]
+        tolerance_number = beam.get('ReferencedToleranceTableNumber')
+        sid = None
+        for verification_image in beam.get('PlannedVerificationImageSequence', []):
+            if 'RTImageSID' in verification_image:
+                sid = _number(verification_image.RTImageSID)
+                break
+        beams.append(tuple(_sql(value) for value in (
+            path,
+            beam.get('BeamNumber'),
+            beam.get('BeamName'),
+            beam.get('TreatmentMachineName'),
+            _number(first.get('GantryAngle')),
+            _number(first.get('BeamLimitingDeviceAngle')),
+            tolerance_number,
+            tolerance_labels.get(tolerance_number),
+            sid,
+        )))
+
+    plan = tuple(_sql(value) for value in (
+        path,
+        stat.st_mtime_ns,
+        stat.st_size,
+        dicom_info.get('SOPInstanceUID'),
+        dicom_info.get('StudyInstanceUID'),
+        dicom_info.get('SeriesInstanceUID'),
+        dicom_info.get('RTPlanLabel'),
+        dicom_info.get('PatientID'),
+        len(beams),
+        int(0x32531000 in dicom_info or 0x32531002 in dicom_info),
+        None,
+    ))
+    return plan, beams
+
+
+def _scan(roots, recursive=False):
+    """Returns {path: (mtime_ns, size)} of the .dcm files under `roots`."""
+    found = {}
+    pending = [os.path.abspath(root) for root in roots]
+    while pending:
+        root = pending.pop()
+        if os.path.isfile(root):
+            stat = os.stat(root)
+            found[root] = (stat.st_mtime_ns, stat.st_size)
+            continue
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        pending.append(entry.path)
+                elif entry.name.lower().endswith('.dcm'):
+                    stat = entry.stat()
+                    found[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+def index(connection, roots, recursive=False, max_workers=None):
+    """
+    Brings the catalog up to date with the plans under `roots`.
+
+    Only new or changed files (by mtime and size) are read. Plans of the catalog that were under a directory of
+    `roots` and are gone are removed.
+
+    Args:
+        connection (sqlite3.Connection): The catalog.
+        roots (list of str): Directories or files to index.
+        recursive (bool): Whether directories are searched recursively.
+        max_workers (int, optional): Processes used to read the headers. Defaults to the number of cores.
+
+    Returns:
+        dict: Counts of 'added', 'updated', 'removed' and 'unchanged' plans, and 'seconds'.
+    """
+    start = time.perf_counter()
+    found = _scan(roots, recursive)
+    known = {}
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isdir(root):
+            prefix = os.path.join(root, '')
+            # Rango sobre la clave primaria en lugar de LIKE, para usar el índice
+            rows = connection.execute('SELECT path, mtime_ns, size FROM plans WHERE path >= ? AND path < ?', (prefix, prefix + '\uffff'))
+            for path, mtime_ns, size in rows:
+                if recursive or os.path.dirname(path) == root:
+                    known[path] = (mtime_ns, size)
+        else:
+            for path, mtime_ns, size in connection.execute('SELECT path, mtime_ns, size FROM plans WHERE path = ?', (root,)):
+                known[path] = (mtime_ns, size)
+
+    to_read = sorted(path for path, key in found.items() if known.get(path) != key)
+    removed = [path for path in known if path not in found]
+
+    if len(to_read) >= POOL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            headers = list(pool.map(read_plan_header, to_read, chunksize=16))
+    else:
+        headers = [read_plan_header(path) for path in to_read]
+
+    with connection:
+        connection.executemany('DELETE FROM plans WHERE path = ?', [(path,) for path in removed + to_read])
+        connection.executemany('INSERT INTO plans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [plan for plan, _ in headers])
+        connection.executemany('INSERT INTO beams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [beam for _, beams in headers for beam in beams])
+
+    n_updated = sum(path in known for path in to_read)
+    return {
+        'added': len(to_read) - n_updated,
+        'updated': n_updated,
+        'removed': len(removed),
+        'unchanged': len(found) - len(to_read),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def find_plans(connection, machine=None, tolerance=None, tolerance_not=None, has_extended_if=None, path_like=None):
+    """
+    Returns the paths of the plans that match every given filter.
+
+    Args:
+        connection (sqlite3.Connection): The catalog.
+        machine (str, optional): Some beam has this TreatmentMachineName.
+        tolerance (str, optional): Some beam references the tolerance table with this label.
+        tolerance_not (str, optional): Some beam references another tolerance table (or none).
+        has_extended_if (bool, optional): Whether the plan has the ExtendedIF block.
+        path_like (str, optional): SQL LIKE pattern on the path.
+
+    Returns:
+        list of str: Matching plan paths, sorted.
+    """
+    conditions, parameters = ['p.error IS NULL'], []
+    if machine is not None:
+        conditions.append('EXISTS (SELECT 1 FROM beams b WHERE b.path = p.path AND b.machine_name = ?)')
+        parameters.append(machine)
+    if tolerance is not None:
+        conditions.append('EXISTS (SELECT 1 FROM beams b WHERE b.path = p.path AND b.tolerance_table_label = ?)')
+        parameters.append(tolerance)
+    if tolerance_not is not None:
+        conditions.append('EXISTS (SELECT 1 FROM beams b WHERE b.path = p.path AND b.tolerance_table_label IS NOT ?)')
+        parameters.append(tolerance_not)
+    if has_extended_if is not None:
+        conditions.append('p.has_extended_if = ?')
+        parameters.append(int(has_extended_if))
+    if path_like is not None:
+        conditions.append('p.path LIKE ?')
+        parameters.append(path_like)
+    query = f"SELECT p.path FROM plans p WHERE {' AND '.join(conditions)} ORDER BY p.path"
+    return [path for (path,) in connection.execute(query, parameters)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Catálogo SQLite de planes RT exportados.")
+    parser.add_argument('--catalog', default=None, help="Base de datos del catálogo (por defecto, ~/.modificadorDCM/catalogo.sqlite)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help="Indexar (o actualizar) directorios o archivos")
+    index_parser.add_argument('roots', nargs='+', help="Directorios o archivos con los planes")
+    index_parser.add_argument('-r', '--recursive', action='store_true', help="Buscar planes en subdirectorios")
+    index_parser.add_argument('-j', '--jobs', type=int, default=None, help="Cantidad de procesos (por defecto, uno por núcleo)")
+    query_parser = subparsers.add_parser('query', help="Buscar planes")
+    query_parser.add_argument('--machine', help="TreatmentMachineName de algún campo")
+    query_parser.add_argument('--tolerance', help="Etiqueta de la tabla de tolerancia de algún campo")
+    query_parser.add_argument('--tolerance-not', help="Algún campo usa una tabla de tolerancia distinta de ésta")
+    query_parser.add_argument('--extended-if', choices=('si', 'no'), help="Con o sin el bloque ExtendedIF")
+    query_parser.add_argument('--path-like', help="Patrón SQL LIKE sobre la ruta")
+    query_parser.add_argument('--paths', action='store_true', help="Imprimir sólo las rutas (para batch_modifDICOM.py ... -)")
+    args = parser.parse_args(argv)
+
+    connection = connect(args.catalog)
+    if args.command == 'index':
+        counts = index(connection, args.roots, args.recursive, args.jobs)
+        print(f"{counts['added']} nuevos, {counts['updated']} actualizados, {counts['removed']} borrados, "
+              f"{counts['unchanged']} sin cambios ({counts['seconds']} s)")
+        return 0
+
+    has_extended_if = None if args.extended_if is None else args.extended_if == 'si'
+    paths = find_plans(connection, args.machine, args.tolerance, args.tolerance_not, has_extended_if, args.path_like)
+    for path in paths:
+        if args.paths:
+            print(path)
+        else:
+            beams = connection.execute('SELECT beam_name, machine_name, gantry_angle, collimator_angle, tolerance_table_label, '
+                                       'rtimage_sid FROM beams WHERE path = ? ORDER BY beam_number', (path,)).fetchall()
+            print(path)
+            for beam_name, machine_name, gantry, collimator, tolerance_label, sid in beams:
+                print(f"    {beam_name}: {machine_name}, gantry {gantry}, colimador {collimator}, tolerancia {tolerance_label}, SID {sid}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+Vista previa rápida de placas CR grandes.
+
+En lugar de pasarle a `imshow` la imagen completa (y una segunda copia
+recortada), se arma una vez por imagen una pirámide de resoluciones por
+promedio de bloques 2×2 (`resample.bin_image`) y cada panel muestra sólo el
+nivel que alcanza para los píxeles de pantalla de la zona visible. Al hacer zoom
+o cambiar el tamaño de la ventana se cambia de nivel sin volver a procesar la
+imagen.
+
+El contraste (ventana) sale del histograma del nivel más grueso, dentro de la
+zona recortada, descartando los extremos, y el recorte se dibuja como un
+rectángulo sobre la imagen original.
+"""
+import math
+
+import numpy as np
+
+import resample
+
+# El nivel más grueso tiene al menos este tamaño (en su lado menor)
+MIN_SIZE = 128
+# Fracción de píxeles que queda fuera de la ventana por abajo y por arriba
+WINDOW_CLIP = 0.005
+
+
+def histogram_window(values, clip=WINDOW_CLIP):
+    """
+    Returns a display window that leaves out the `clip` fraction of the darkest and brightest pixels.
+
+    Args:
+        values (numpy.ndarray): The pixels, usually a coarse pyramid level.
+        clip (float): Fraction of pixels left out at each end.
+
+    Returns:
+        tuple: (vmin, vmax), with vmax > vmin.
+    """
+    values = np.asarray(values).ravel()
+    if values.size == 0:
+        return 0, 1
+    if values.dtype.kind in 'ui':
+        # Histograma exacto por valor: el nivel grueso tiene pocos miles de píxeles
+        offset = int(values.min())
+        counts = np.bincount(values.astype(np.int64) - offset)
+        edges = np.arange(offset, offset + counts.size + 1)
+    else:
+        counts, edges = np.histogram(values, bins=1024)
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    low = edges[np.searchsorted(cumulative, clip * total, side='right')]
+    high = edges[min(np.searchsorted(cumulative, (1 - clip) * total, side='left') + 1, len(edges) - 1)]
+    if high <= low:
+        high = low + 1
+    return low, high
+
+
+class Pyramid:
+    """
+    Block-mean resolution pyramid of an image.
+
+    Level 0 is the image itself (not copied); each following level averages 2×2 blocks of the previous one, down to
+    `min_size` pixels on the shorter side.
+
+    Args:
+        image (numpy.ndarray): The image (rows, columns).
+        min_size (int): Minimum size of the coarsest level.
+    """
+
+    def __init__(self, image, min_size=MIN_SIZE):
+        self.levels = [image]
+        while min(self.levels[-1].shape) >= 2 * min_size:
+            self.levels.append(resample.bin_image(self.levels[-1], 2))
+
+    @property
+    def shape(self):
+        """Shape of the full resolution image."""
+        return self.levels[0].shape
+
+    def level_for(self, rows, columns, screen_rows, screen_columns):
+        """
+        Returns the coarsest level that still has a pixel per screen pixel.
+
+        Args:
+            rows, columns (float): Size of the visible area, in full resolution pixels.
+            screen_rows, screen_columns (float): Size of the axes on screen, in pixels.
+
+        Returns:
+            int: The level index.
+        """
+        # La imagen se ajusta a los ejes manteniendo la relación de aspecto
+        scale = min(screen_rows / max(rows, 1), screen_columns / max(columns, 1))
+        if scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / scale))), len(self.levels) - 1)
+
+    def window(self, rows=slice(None), columns=slice(None), clip=WINDOW_CLIP):
+        """
+        Returns the display window of a region, from the histogram of the coarsest level.
+
+        Args:
+            rows, columns (slice): The region, in full resolution pixels. Defaults to the whole image.
+            clip (float): Fraction of pixels left out at each end.
+
+        Returns:
+            tuple: (vmin, vmax).
+        """
+        level = len(self.levels) - 1
+        factor = 2 ** level
+        region = self.levels[level][_scale_slice(rows, factor), _scale_slice(columns, factor)]
+        return histogram_window(region if region.size else self.levels[level], clip)
+
+
+def _scale_slice(region, factor):
+    """Converts a slice in full resolution pixels to the level whose blocks are `factor` pixels wide."""
+    start = region.start // factor if region.start is not None else None
+    stop = -(-region.stop // factor) if region.stop is not None else None
+    return slice(start, stop)
+
+
+class _LevelView:
+    """
+    Shows a region of a pyramid on some axes, switching levels as the axes are zoomed or resized.
+
+    Only the visible part of the chosen level is handed to matplotlib; the image is positioned in full resolution
+    pixel coordinates, so overlays and zoom limits don't depend on the level.
+    """
+
+    def __init__(self, axes, pyramid, rows, columns, vmin, vmax):
+        self.axes = axes
+        self.pyramid = pyramid
+        height, width = pyramid.shape
+        self.rows = range(height)[rows]
+        self.columns = range(width)[columns]
+        self.key = None
+        self.image = axes.imshow(np.zeros((1, 1), dtype=pyramid.levels[0].dtype), cmap='gray', vmin=vmin, vmax=vmax,
+                                 interpolation='nearest')
+        axes.set_xlim(self.columns.start - 0.5, self.columns.stop - 0.5)
+        axes.set_ylim(self.rows.stop - 0.5, self.rows.start - 0.5)
+        axes.set_autoscale_on(False)
+        self.update()
+        axes.callbacks.connect('xlim_changed', self.update)
+        axes.callbacks.connect('ylim_changed', self.update)
+        axes.figure.canvas.mpl_connect('resize_event', self.update)
+
+    def update(self, *args):
+        """Shows the level and the part of it that match the current limits and size of the axes."""
+        x0, x1 = sorted(self.axes.get_xlim())
+        y0, y1 = sorted(self.axes.get_ylim())
+        row_start = max(int(math.floor(y0 + 0.5)), self.rows.start)
+        row_stop = min(int(math.ceil(y1 + 0.5)), self.rows.stop)
+        column_start = max(int(math.floor(x0 + 0.5)), self.columns.start)
+        column_stop = min(int(math.ceil(x1 + 0.5)), self.columns.stop)
+        if row_stop <= row_start or column_stop <= column_start:
+            return
+
+        bbox = self.axes.get_window_extent()
+        level = self.pyramid.level_for(row_stop - row_start, column_stop - column_start, bbox.height, bbox.width)
+        factor = 2 ** level
+        data = self.pyramid.levels[level]
+        # Bloques enteros del nivel que cubren la zona visible (una vista, sin copia)
+        block_rows = slice(row_start // factor, min(-(-row_stop // factor), data.shape[0]))
+        block_columns = slice(column_start // factor, min(-(-column_stop // factor), data.shape[1]))
+        key = (level, block_rows.start, block_rows.stop, block_columns.start, block_columns.stop)
+        if key == self.key:
+            return
+        self.key = key
+        self.image.set_data(data[block_rows, block_columns])
+        self.image.set_extent((block_columns.start * factor - 0.5, block_columns.stop * factor - 0.5,
+                               block_rows.stop * factor - 0.5, block_rows.start * factor - 0.5))
+
+
+def show_crop(pixel_array, rows, columns, pyramid=None, figsize=(10, 5)):
+    """
+    Shows an image with its crop outlined, next to the cropped region.
+
+    Args:
+        pixel_array (numpy.ndarray): The full image (rows, columns).
+        rows, columns (slice): The crop, as returned by `autocrop.find_exposed_region`.
+        pyramid (Pyramid, optional): Pyramid of `pixel_array`, if already built.
+        figsize (tuple): Size of the figure in inches.
+
+    Returns:
+        matplotlib.figure.Figure: The figure (not shown yet; call `plt.show()`).
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
+
+    pyramid = pyramid or Pyramid(pixel_array)
+    vmin, vmax = pyramid.window(rows, columns)
+    figure, (full_axes, crop_axes) = plt.subplots(1, 2, figsize=figsize)
+
+    full_axes.set_title('Original Image')
+    full_view = _LevelView(full_axes, pyramid, slice(None), slice(None), vmin, vmax)
+    crop_rows, crop_columns = range(pyramid.shape[0])[rows], range(pyramid.shape[1])[columns]
+    full_axes.add_patch(Rectangle((crop_columns.start - 0.5, crop_rows.start - 0.5), len(crop_columns), len(crop_rows),
+                                  fill=False, edgecolor='red', linewidth=1))
+
+    crop_axes.set_title('Cropped Image')
+    crop_view = _LevelView(crop_axes, pyramid, rows, columns, vmin, vmax)
+    # Las vistas viven mientras viva la figura (los callbacks de matplotlib son referencias débiles)
+    figure._level_views = (full_view, crop_view)
+    return figure
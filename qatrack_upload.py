@@ -0,0 +1,490 @@
+"""
+Subida a QATrack+ de las imágenes convertidas (<nombre>-a_QATrack.dcm).
+
+Cada imagen se sube como una nueva sesión de la lista de tests configurada, por
+la API REST de QATrack+ (POST /api/qa/testlistinstances/ con el archivo en
+base64 en el test de tipo "upload"). Las conexiones HTTP(S) se mantienen
+abiertas y se reutilizan entre subidas y varias imágenes se suben a la vez (con
+un límite).
+
+Crear una sesión no es idempotente: una subida se reintenta (con espera
+exponencial) sólo si es seguro que el servidor no la procesó, es decir si no se
+pudo conectar o enviar el pedido, o si respondió 408, 429 o 503 con
+Retry-After. Si el pedido llegó y la respuesta no (timeout, conexión cortada,
+500, 502, 504), la imagen queda "a verificar": no se reenvía hasta revisar en
+QATrack+ que la sesión no se haya creado (--resend-unverified).
+
+La cola de subidas se guarda en ~/.modificadorDCM/qatrack_cola.jsonl: si el
+programa se corta o QATrack+ no responde, lo pendiente se sube en la próxima
+corrida. Un archivo se vuelve a subir sólo si se reemplazó por otro.
+
+La configuración está en ~/.modificadorDCM/qatrack.json (o en
+MODIFDCM_QATRACK_CONFIG):
+
+    {
+        "url": "https://qatrack.hospital.local",
+        "token": "0123456789abcdef...",
+        "unit_test_collection": 42,
+        "test": "picket_fence_cr"
+    }
+
+Uso:
+    python qatrack_upload.py "C:/QATrack/entrada/*-a_QATrack.dcm" -j 4
+    python qatrack_upload.py            (sólo lo pendiente de corridas anteriores)
+"""
+import argparse
+import base64
+import glob
+import http.client
+import json
+import os
+import queue
+import random
+import select
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+USER_DIR = os.path.join(os.path.expanduser('~'), '.modificadorDCM')
+CONFIG_PATH = os.environ.get('MODIFDCM_QATRACK_CONFIG') or os.path.join(USER_DIR, 'qatrack.json')
+QUEUE_PATH = os.path.join(USER_DIR, 'qatrack_cola.jsonl')
+TEST_LIST_INSTANCES = '/api/qa/testlistinstances/'
+
+PENDING = 'pendiente'
+UPLOADED = 'subido'
+FAILED = 'error'
+UNVERIFIED = 'verificar'
+
+# Respuestas que garantizan que el servidor no procesó el pedido
+RETRY_STATUSES = frozenset((408, 429))
+# Ídem, sólo si traen Retry-After (sin él, un 503 puede venir de un proxy después de procesarlo)
+RETRY_AFTER_STATUSES = frozenset((503,))
+
+
+class UploadError(Exception):
+    """
+    An upload failed.
+
+    `retryable` tells whether the server surely did not process the request, so sending it again is safe, and
+    `unverified` whether it may have processed it (the request went out and no reliable answer came back).
+    """
+
+    def __init__(self, message, retryable=False, unverified=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.unverified = unverified
+
+
+def load_config(path=None):
+    """
+    Reads the QATrack+ configuration.
+
+    Args:
+        path (str, optional): Defaults to `CONFIG_PATH`.
+
+    Returns:
+        dict: 'url', 'token', 'unit_test_collection' and 'test'.
+
+    Raises:
+        FileNotFoundError: If there is no configuration.
+        ValueError: If a key is missing.
+    """
+    path = path or CONFIG_PATH
+    with open(path, 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+    missing = [key for key in ('url', 'token', 'unit_test_collection', 'test') if not config.get(key)]
+    if missing:
+        raise ValueError(f"Faltan {missing} en {path}")
+    return config
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to one server, shared by several threads.
+
+    Each request takes an idle connection or opens a new one, and returns it when the response was read. A kept
+    connection that the server closed in the meantime is left out before sending; if it fails anyway, it is replaced
+    once, transparently, unless the request may have reached the server and is not idempotent.
+
+    Args:
+        base_url (str): E.g. 'https://qatrack.hospital.local'. A path prefix is kept.
+        timeout (float): Socket timeout in seconds.
+    """
+
+    def __init__(self, base_url, timeout=60):
+        parts = urllib.parse.urlsplit(base_url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = queue.LifoQueue()
+        self._context = ssl.create_default_context() if self.https else None
+
+    def _connect(self):
+        self.connections_opened += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self._context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        """
+        Sends a request and reads the whole response.
+
+        Args:
+            method (str): 'GET', 'POST'...
+            path (str): Path below the base URL.
+            body (bytes, optional): The request body.
+            headers (dict, optional): The request headers.
+            idempotent (bool): Whether the request may be repeated when a kept connection fails after sending it.
+
+        Returns:
+            tuple: (status, headers, body) of the response.
+
+        Raises:
+            OSError, http.client.HTTPException: If the connection failed. The exception has a `request_sent`
+                attribute: False if the request surely did not reach the server (it could not connect or send the
+                whole request), True if it may have.
+        """
+        connection, reused = self._take(), True
+        if connection is None:
+            connection, reused = self._connect(), False
+        while True:
+            sent = False
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                connection.request(method, self.prefix + path, body, headers or {})
+                # El pedido salió entero: de acá en más el servidor pudo haberlo procesado
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as error:
+                connection.close()
+                if not reused or (sent and not idempotent):
+                    error.request_sent = sent
+                    raise
+                # El servidor cerró la conexión mientras estaba libre: se repite una vez con una nueva
+                connection, reused = self._connect(), False
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                error.request_sent = sent
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle.put(connection)
+        return response.status, response.headers, data
+
+    def _take(self):
+        """Returns an idle connection that the server did not close in the meantime, or None."""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            try:
+                # Una conexión libre no tiene nada para leer: si lo tiene, el servidor la cerró
+                readable, _, _ = select.select([connection.sock], [], [], 0)
+            except (OSError, ValueError):
+                readable = True
+            if not readable:
+                return connection
+            connection.close()
+
+    def close(self):
+        """Closes the idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class UploadQueue:
+    """
+    Persistent queue of the files to upload (JSON lines, append-only).
+
+    The state of a file is the one of its last line. Files are identified by path, size and modification time, so a
+    replaced file is uploaded again.
+
+    Args:
+        path (str): The queue file.
+    """
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        n_lines = 0
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as queue_file:
+                for line in queue_file:
+                    n_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Última línea cortada por un corte de luz
+                        continue
+                    self._entries[entry['file']] = entry
+        if n_lines > 2 * len(self._entries) + 100:
+            self._compact()
+
+    def _compact(self):
+        """Rewrites the file with only the last line of each file."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as queue_file:
+            for entry in self._entries.values():
+                queue_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(temporary, self.path)
+
+    def _write(self, entry):
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as queue_file:
+                queue_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._entries[entry['file']] = entry
+
+    def add(self, path):
+        """
+        Queues a file, unless that same file (same size and modification time) is already queued, uploaded or to
+        be verified.
+
+        Args:
+            path (str): The file.
+
+        Returns:
+            bool: Whether the file was queued.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        previous = self._entries.get(path)
+        if previous is not None and (previous['size'], previous['mtime_ns']) == (stat.st_size, stat.st_mtime_ns) \
+                and previous['state'] in (PENDING, UPLOADED, UNVERIFIED):
+            return False
+        self._write({'file': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'state': PENDING})
+        return True
+
+    def mark(self, path, state, **details):
+        """Records the new state of a queued file, with extra details (error, URL...)."""
+        entry = dict(self._entries[path], state=state, error=None)
+        entry.update(details)
+        self._write(entry)
+
+    def pending(self, include_failed=False, include_unverified=False):
+        """
+        Returns the files still to upload, in the order they were queued.
+
+        Args:
+            include_failed (bool): Also the files that failed with a permanent error.
+            include_unverified (bool): Also the files that may have been uploaded (checked by hand in QATrack+).
+        """
+        states = (PENDING,) + ((FAILED,) if include_failed else ()) + ((UNVERIFIED,) if include_unverified else ())
+        return [path for path, entry in self._entries.items() if entry['state'] in states]
+
+
+def build_payload(config, path):
+    """
+    Builds the test list instance of one image, as the QATrack+ API expects it.
+
+    Args:
+        config (dict): See `load_config`.
+        path (str): The converted image.
+
+    Returns:
+        bytes: The JSON body.
+    """
+    with open(path, 'rb') as image_file:
+        content = base64.b64encode(image_file.read()).decode('ascii')
+    # Fecha de la conversión como fecha del control
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path)))
+    payload = {
+        'unit_test_collection': f"{config['url'].rstrip('/')}/api/qa/unittestcollections/{config['unit_test_collection']}/",
+        'work_started': when,
+        'work_completed': when,
+        'in_progress': False,
+        'include_for_scheduling': True,
+        'tests': {config['test']: {'filename': os.path.basename(path), 'value': content, 'encoding': 'base64'}},
+    }
+    return json.dumps(payload).encode('utf-8')
+
+
+class Uploader:
+    """
+    Uploads the queued images to QATrack+ over a pool of keep-alive connections.
+
+    Args:
+        config (dict): See `load_config`.
+        upload_queue (UploadQueue, optional): Defaults to the per-user queue.
+        max_workers (int): Images uploaded at the same time, and connections kept open.
+        max_attempts (int): Attempts per image for transient errors.
+        backoff (float): Seconds before the first retry; doubled (with jitter) on each retry.
+        progress (callable, optional): Called with each result.
+    """
+
+    def __init__(self, config, upload_queue=None, max_workers=4, max_attempts=5, backoff=1.0, progress=None):
+        self.config = config
+        self.queue = upload_queue or UploadQueue()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.progress = progress
+        self.pool = ConnectionPool(config['url'])
+        self._headers = {'Authorization': f"Token {config['token']}", 'Content-Type': 'application/json',
+                         'Accept': 'application/json'}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _post(self, body):
+        try:
+            status, headers, data = self.pool.request('POST', TEST_LIST_INSTANCES, body, self._headers,
+                                                      idempotent=False)
+        except (OSError, http.client.HTTPException) as error:
+            sent = getattr(error, 'request_sent', True)
+            raise UploadError(f"{type(error).__name__}: {error}", retryable=not sent, unverified=sent) from error
+        if status in (200, 201):
+            return json.loads(data or b'{}')
+        message = f"HTTP {status}: {data[:200].decode('utf-8', 'replace')}"
+        retry_after = headers.get('Retry-After')
+        retryable = status in RETRY_STATUSES or (status in RETRY_AFTER_STATUSES and bool(retry_after))
+        error = UploadError(message, retryable=retryable, unverified=status >= 500 and not retryable)
+        error.retry_after = retry_after
+        raise error
+
+    def upload(self, path):
+        """
+        Uploads one queued image, retrying the errors the server surely did not process, and records the outcome in
+        the queue. Never raises.
+
+        Args:
+            path (str): The image, as queued.
+
+        Returns:
+            dict: 'file', 'status' ('ok' or 'error'), 'error', 'url' (of the new test list instance), 'attempts'
+            and 'seconds'.
+        """
+        start = time.perf_counter()
+        result = {'file': path, 'status': 'ok', 'error': None, 'url': None, 'attempts': 0}
+        try:
+            body = build_payload(self.config, path)
+            for attempt in range(1, self.max_attempts + 1):
+                result['attempts'] = attempt
+                try:
+                    result['url'] = self._post(body).get('url')
+                    break
+                except UploadError as error:
+                    if not error.retryable or attempt == self.max_attempts:
+                        raise
+                    delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                    retry_after = getattr(error, 'retry_after', None)
+                    if retry_after and retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+                    time.sleep(delay)
+        except Exception as error:
+            result['status'] = 'error'
+            result['error'] = f"{type(error).__name__}: {error}" if not isinstance(error, UploadError) else str(error)
+            # Los transitorios quedan pendientes para la próxima corrida; los que pudieron llegar, a verificar
+            if isinstance(error, UploadError) and error.unverified:
+                result['error'] += " (verificar en QATrack+ si se creó la sesión antes de reenviarla)"
+                state = UNVERIFIED
+            elif isinstance(error, UploadError) and error.retryable:
+                state = PENDING
+            else:
+                state = FAILED
+            self.queue.mark(path, state, error=result['error'])
+        else:
+            self.queue.mark(path, UPLOADED, url=result['url'])
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        if self.progress is not None:
+            self.progress(result)
+        return result
+
+    def submit(self, path):
+        """
+        Queues an image and schedules its upload in the background.
+
+        Args:
+            path (str): The converted image.
+
+        Returns:
+            concurrent.futures.Future or None: The upload, or None if the image was already queued or uploaded.
+        """
+        if not self.queue.add(path):
+            return None
+        return self._executor.submit(self.upload, os.path.abspath(path))
+
+    def resume(self, include_failed=False, include_unverified=False):
+        """
+        Schedules in the background the uploads left pending in the queue, e.g. by a previous run.
+
+        Args:
+            include_failed (bool): Also retry the images that failed with a permanent error.
+            include_unverified (bool): Also send again the images that may have been uploaded already.
+
+        Returns:
+            list of concurrent.futures.Future: The uploads.
+        """
+        return [self._executor.submit(self.upload, path)
+                for path in self.queue.pending(include_failed, include_unverified)]
+
+    def upload_pending(self, include_failed=False, include_unverified=False):
+        """
+        Uploads everything pending in the queue and waits for it, see `resume`.
+
+        Returns:
+            list of dict: One result per image, see `upload`.
+        """
+        return [future.result() for future in self.resume(include_failed, include_unverified)]
+
+    def close(self):
+        """Waits for the scheduled uploads and closes the connections."""
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _print_result(result):
+    if result['status'] == 'ok':
+        print(f"OK     {result['file']} -> {result['url']} ({result['seconds']} s)", flush=True)
+    else:
+        print(f"ERROR  {result['file']}: {result['error']}", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Subida a QATrack+ de las imágenes convertidas.")
+    parser.add_argument('files', nargs='*', help="Imágenes o patrones glob (además de lo pendiente de corridas anteriores)")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="Subidas simultáneas")
+    parser.add_argument('--config', help="Configuración de QATrack+ (por defecto, ~/.modificadorDCM/qatrack.json)")
+    parser.add_argument('--retry-failed', action='store_true', help="Reintentar también las que fallaron con error permanente")
+    parser.add_argument('--resend-unverified', action='store_true', help="Reenviar también las que pudieron haberse subido (revisadas en QATrack+)")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+    except (FileNotFoundError, ValueError) as error:
+        print(f"Configuración de QATrack+ inválida: {error}", file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    with Uploader(config, max_workers=args.jobs, progress=_print_result) as uploader:
+        for pattern in args.files:
+            for path in sorted(glob.glob(pattern)):
+                uploader.queue.add(path)
+        results = uploader.upload_pending(args.retry_failed, args.resend_unverified)
+    n_errors = sum(result['status'] != 'ok' for result in results)
+    print(f"{len(results) - n_errors} subidas, {n_errors} con error, {uploader.pool.connections_opened} conexión(es), "
+          f"{time.perf_counter() - start:.2f} s.")
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
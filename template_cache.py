@@ -0,0 +1,206 @@
+"""
+Caché de los planes base (PlanBase_*_QA.dcm) que usa `change_machine`.
+
+Los planes base viven en el share de red. Para no leerlos por SMB en cada
+conversión se guardan en dos niveles:
+
+* una copia espejo en disco local, revalidada con un `os.stat` del original
+  (tamaño + mtime), que además permite trabajar si el share no responde;
+* un LRU en memoria con el Dataset ya parseado, indexado por ruta + mtime + tamaño.
+
+Cada llamada a `get_template` devuelve una copia profunda del Dataset cacheado,
+así las conversiones pueden modificarlo libremente.
+
+`prefetch` carga y parsea plantillas en hilos de fondo (p. ej. las de todos los
+equipos mientras el usuario contesta los diálogos). Cada plantilla se carga con
+su propio lock: varias se leen del share a la vez y un `get_template` de una
+plantilla que se está precargando espera esa carga en lugar de repetirla.
+"""
+import copy
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import pydicom
+
+MIRROR_DIR = os.environ.get('MODIFDCM_MIRROR_DIR') or os.path.join(os.path.expanduser('~'), '.modificadorDCM', 'plantillas')
+
+
+class TemplateCache:
+    """
+    Two-level cache (in-memory LRU + local disk mirror) of parsed template plans.
+
+    Args:
+        mirror_dir (str): Directory of the local mirror.
+        maxsize (int): Maximum number of parsed templates kept in memory.
+        revalidate_seconds (float): During this time after a check the source is not stat'ed again.
+    """
+
+    def __init__(self, mirror_dir=MIRROR_DIR, maxsize=8, revalidate_seconds=30.0):
+        self.mirror_dir = mirror_dir
+        self.maxsize = maxsize
+        self.revalidate_seconds = revalidate_seconds
+        self._parsed = OrderedDict()
+        self._checked = {}
+        self._lock = threading.RLock()
+        # Un lock por ruta: la lectura por SMB y el parseo no bloquean las demás plantillas
+        self._loading = {}
+
+    def get_template(self, path):
+        """
+        Returns a private deep copy of the template plan at `path`.
+
+        Args:
+            path (str): Path of the template plan (usually on the network share).
+
+        Returns:
+            pydicom.dataset.FileDataset: A copy of the parsed template.
+
+        Raises:
+            FileNotFoundError: If the source is unreachable and there is no local copy.
+        """
+        dataset = self._load(path)
+        with self._lock:
+            return copy.deepcopy(dataset)
+
+    def prefetch(self, paths):
+        """
+        Loads and parses templates on background threads, so a later `get_template` finds them in memory.
+
+        Errors are ignored here: `get_template` reports them when the template is actually needed.
+
+        Args:
+            paths (iterable of str): Paths of the template plans.
+
+        Returns:
+            list of threading.Thread: The (daemon) loading threads, one per path.
+        """
+        threads = []
+        for path in paths:
+            thread = threading.Thread(target=self._prefetch_one, args=(path,), name='prefetch_plantilla', daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _prefetch_one(self, path):
+        try:
+            self._load(path)
+        except Exception:
+            pass
+
+    def clear(self):
+        """Empties the in-memory cache. The disk mirror is kept."""
+        with self._lock:
+            self._parsed.clear()
+            self._checked.clear()
+
+    def _load(self, path):
+        with self._lock:
+            loading = self._loading.setdefault(path, threading.Lock())
+        with loading:
+            key, local_path = self._resolve(path)
+            with self._lock:
+                if key in self._parsed:
+                    self._parsed.move_to_end(key)
+                    return self._parsed[key]
+
+            dataset = pydicom.dcmread(local_path, force=True)
+            # Convertir ya los elementos crudos (en el hilo que carga), no en la primera copia
+            for _ in dataset:
+                pass
+            with self._lock:
+                self._parsed[key] = dataset
+                if len(self._parsed) > self.maxsize:
+                    self._parsed.popitem(last=False)
+            return dataset
+
+    def _resolve(self, path):
+        """Returns the cache key of `path` and the local file to parse it from."""
+        checked = self._checked.get(path)
+        if checked is not None and time.monotonic() - checked[0] < self.revalidate_seconds:
+            return checked[1], checked[2]
+
+        mirror_path, meta_path = self._mirror_paths(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            key, local_path = self._offline(path, mirror_path, meta_path)
+        else:
+            key = (path, st.st_mtime_ns, st.st_size)
+            if self._read_meta(meta_path) != [st.st_mtime_ns, st.st_size] or not os.path.exists(mirror_path):
+                self._refresh_mirror(path, mirror_path, meta_path, st)
+            local_path = mirror_path
+
+        self._checked[path] = (time.monotonic(), key, local_path)
+        return key, local_path
+
+    def _offline(self, path, mirror_path, meta_path):
+        """Falls back to the mirror, or to the copy next to the scripts, when the share is unreachable."""
+        meta = self._read_meta(meta_path)
+        if meta is not None and os.path.exists(mirror_path):
+            return (path, meta[0], meta[1]), mirror_path
+
+        bundled = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.basename(path.replace('\\', '/')))
+        if os.path.exists(bundled):
+            st = os.stat(bundled)
+            return (bundled, st.st_mtime_ns, st.st_size), bundled
+        raise FileNotFoundError(f"No se puede acceder a la plantilla {path} y no hay copia local.")
+
+    def _mirror_paths(self, path):
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        file_name = os.path.basename(path.replace('\\', '/'))
+        base = os.path.join(self.mirror_dir, f"{digest}_{file_name}")
+        return base, base + '.json'
+
+    @staticmethod
+    def _read_meta(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            return [meta['mtime_ns'], meta['size']]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _refresh_mirror(self, path, mirror_path, meta_path, st):
+        # Copia a un temporal y reemplazo atómico: otro proceso puede estar leyendo el espejo
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        tmp_path = f"{mirror_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, mirror_path)
+        tmp_meta = meta_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as meta_file:
+            json.dump({'source': path, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}, meta_file)
+        os.replace(tmp_meta, meta_path)
+
+
+_default_cache = TemplateCache()
+
+
+def get_template(path):
+    """
+    Returns a private copy of the template plan at `path` using the process-wide cache.
+
+    Args:
+        path (str): Path of the template plan.
+
+    Returns:
+        pydicom.dataset.FileDataset: A copy of the parsed template.
+    """
+    return _default_cache.get_template(path)
+
+
+def prefetch(paths):
+    """
+    Loads templates into the process-wide cache on background threads, see `TemplateCache.prefetch`.
+
+    Args:
+        paths (iterable of str): Paths of the template plans.
+
+    Returns:
+        list of threading.Thread: The loading threads.
+    """
+    return _default_cache.prefetch(paths)
@@ -0,0 +1,137 @@
+"""
+Pruebas de `qatrack_upload` contra un QATrack+ de mentira (http.server local con keep-alive).
+
+Uso:
+    python -m pytest test_qatrack_upload.py
+"""
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import qatrack_upload
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """Answers each POST with the next response of the server script (201 when it runs out)."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.client_address, json.loads(body)))
+            status, headers = server.script.pop(0) if server.script else (201, {})
+        data = json.dumps({'url': f"http://qatrack/api/qa/testlistinstances/{len(server.requests)}/"}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class UploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StandIn)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.script = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.work_dir = tempfile.mkdtemp()
+        self.queue_path = os.path.join(self.work_dir, 'cola.jsonl')
+        self.images = []
+        for index in range(3):
+            path = os.path.join(self.work_dir, f"placa{index}-a_QATrack.dcm")
+            with open(path, 'wb') as image_file:
+                image_file.write(b'DICM' * (index + 1))
+            self.images.append(path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def config(self, port=None):
+        return {'url': f"http://127.0.0.1:{port or self.server.server_port}", 'token': 'abc', 'unit_test_collection': 7,
+                'test': 'picket_fence_cr'}
+
+    def uploader(self, config=None, **kwargs):
+        kwargs.setdefault('max_workers', 1)
+        kwargs.setdefault('backoff', 0.01)
+        return qatrack_upload.Uploader(config or self.config(), qatrack_upload.UploadQueue(self.queue_path), **kwargs)
+
+    def state(self, path):
+        return qatrack_upload.UploadQueue(self.queue_path)._entries[os.path.abspath(path)]['state']
+
+    def test_connection_reused(self):
+        with self.uploader() as uploader:
+            for path in self.images:
+                uploader.queue.add(path)
+            results = uploader.upload_pending()
+        self.assertEqual([result['status'] for result in results], ['ok'] * 3)
+        self.assertEqual(uploader.pool.connections_opened, 1)
+        self.assertEqual(len({address for address, _ in self.server.requests}), 1)
+        payload = self.server.requests[0][1]
+        self.assertEqual(payload['tests']['picket_fence_cr']['filename'], os.path.basename(self.images[0]))
+
+    def test_503_with_retry_after_is_retried(self):
+        self.server.script = [(503, {'Retry-After': '0'})]
+        with self.uploader() as uploader:
+            uploader.queue.add(self.images[0])
+            result, = uploader.upload_pending()
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['attempts'], 2)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.state(self.images[0]), qatrack_upload.UPLOADED)
+
+    def test_500_is_left_to_verify(self):
+        self.server.script = [(500, {})]
+        with self.uploader() as uploader:
+            uploader.queue.add(self.images[0])
+            result, = uploader.upload_pending()
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(result['attempts'], 1)
+        self.assertEqual(self.state(self.images[0]), qatrack_upload.UNVERIFIED)
+
+        # Ni la próxima corrida ni volver a encolarla la reenvían
+        with self.uploader() as uploader:
+            self.assertFalse(uploader.queue.add(self.images[0]))
+            self.assertEqual(uploader.upload_pending(include_failed=True), [])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_queue_resumed_after_refused_connection(self):
+        with self.uploader(self.config(_free_port()), max_attempts=2) as uploader:
+            uploader.queue.add(self.images[0])
+            result, = uploader.upload_pending()
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(self.state(self.images[0]), qatrack_upload.PENDING)
+        self.assertEqual(self.server.requests, [])
+
+        with self.uploader() as uploader:
+            futures = uploader.resume()
+        self.assertEqual([future.result()['status'] for future in futures], ['ok'])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.state(self.images[0]), qatrack_upload.UPLOADED)
+
+
+if __name__ == '__main__':
+    unittest.main()